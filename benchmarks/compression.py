@@ -0,0 +1,47 @@
+"""Saved size and save time of each compression profile
+
+Saves the KDBX3 and KDBX4 test databases with extra entries once per
+profile.
+
+    python benchmarks/compression.py [entries]
+"""
+
+import os
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+from pykeepass import PyKeePass
+from pykeepass.entry import Entry
+from pykeepass.kdbx_parsing import compression_profiles
+
+tests_dir = Path(__file__).resolve().parent.parent / 'tests'
+
+
+def main(entries=3000, repeat=5):
+    for database, keyfile in (('test3.kdbx', 'test3.key'), ('test4.kdbx', 'test4.key')):
+        kp = PyKeePass(tests_dir / database, 'password', tests_dir / keyfile)
+        for i in range(entries):
+            kp.root_group.append(Entry(
+                'entry{}'.format(i), 'user{}'.format(i), os.urandom(8).hex(),
+                url='https://example.com/{}'.format(i), notes='notes ' * 20, kp=kp
+            ))
+        # derive the transformed key once, so only the payload is timed
+        kp.save(BytesIO())
+
+        print("{} with {} entries".format(database, entries))
+        for profile in compression_profiles:
+            times = []
+            for _ in range(repeat):
+                stream = BytesIO()
+                start = time.perf_counter()
+                kp.save(stream, compression=profile)
+                times.append(time.perf_counter() - start)
+            print("  {:8} {:8.0f} KB {:8.1f} ms".format(
+                profile, len(stream.getvalue()) / 2**10, min(times) * 1e3
+            ))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
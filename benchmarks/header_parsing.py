@@ -0,0 +1,110 @@
+"""Compare construct's interpreted and compiled parsing of the header and
+payload block structs with the hand-written FastParsed parsers
+
+Only the item structs are compiled.  The RepeatUntil lambdas around them
+and the outer Header struct cannot be compiled, so the compiled items are
+parsed in a Python loop.
+
+    python benchmarks/header_parsing.py
+"""
+
+import hashlib
+import io
+import os
+import struct
+import time
+from pathlib import Path
+
+from construct import RepeatUntil
+
+from pykeepass.kdbx_parsing import KDBX, kdbx3, kdbx4
+
+tests_dir = Path(__file__).resolve().parent.parent / 'tests'
+
+
+def header_data(database, keyfile):
+    kdbx = KDBX.parse_file(
+        tests_dir / database, password='password', keyfile=tests_dir / keyfile,
+        transformed_key=None, decrypt=False
+    )
+    # skip signatures and version
+    return kdbx.header.data[12:]
+
+
+def payload_blocks(with_index):
+    blocks = []
+    for index, length in enumerate([2**10] * 64 + [0]):
+        data = os.urandom(length)
+        prefix = struct.pack('<I', index) if with_index else b''
+        blocks.append(prefix + hashlib.sha256(data).digest() + struct.pack('<I', length) + data)
+    return b''.join(blocks)
+
+
+def inner_header_data():
+    items = [
+        (0x01, struct.pack('<I', 3)),
+        (0x02, os.urandom(64)),
+        (0x03, b'\x01' + os.urandom(2**10)),
+        (0x03, b'\x01' + os.urandom(2**10)),
+        (0x00, b''),
+    ]
+    return b''.join(struct.pack('<BI', t, len(d)) + d for t, d in items)
+
+
+def compiled_list(item, last):
+    compiled = item.compile()
+
+    def parse(data):
+        stream = io.BytesIO(data)
+        items = []
+        while True:
+            items.append(compiled.parse_stream(stream, _index=len(items)))
+            if last(items[-1]):
+                return items
+    return parse
+
+
+def per_call(func, data, number=1000):
+    start = time.perf_counter()
+    for _ in range(number):
+        func(data)
+    return (time.perf_counter() - start) / number
+
+
+def main():
+    def is_end(key):
+        return lambda item: item[key] == 'end'
+
+    def is_last_block(item):
+        return len(item.block_data) == 0
+
+    cases = [
+        ('KDBX3 DynamicHeaderItem', kdbx3.DynamicHeaderItem, is_end('id'),
+         kdbx3.parse_dynamic_header_items, header_data('test3.kdbx', 'test3.key')),
+        ('KDBX4 DynamicHeaderItem', kdbx4.DynamicHeaderItem, is_end('id'),
+         kdbx4.parse_dynamic_header_items, header_data('test4.kdbx', 'test4.key')),
+        ('KDBX3 PayloadBlock', kdbx3.PayloadBlock, is_last_block,
+         kdbx3.parse_payload_blocks, payload_blocks(True)),
+        ('KDBX4 EncryptedPayloadBlock', kdbx4.EncryptedPayloadBlock, is_last_block,
+         kdbx4.parse_encrypted_payload_blocks, payload_blocks(False)),
+        ('KDBX4 InnerHeaderItem', kdbx4.InnerHeaderItem, is_end('type'),
+         kdbx4.parse_inner_header_items, inner_header_data()),
+    ]
+    print("{:28} {:>12} {:>12} {:>12}".format('us per parse', 'interpreted', 'compiled', 'hand-written'))
+    for name, item, last, fast_parse, data in cases:
+        interpreted = RepeatUntil(lambda obj, lst, ctx: last(obj), item).parse
+        compiled = compiled_list(item, last)
+
+        def hand_written(data):
+            return fast_parse(io.BytesIO(data), None)
+
+        expected = interpreted(data)
+        assert list(compiled(data)) == list(expected), name
+        assert list(hand_written(data)) == list(expected), name
+        print("{:28} {:12.1f} {:12.1f} {:12.1f}".format(
+            name, *(per_call(f, data) * 1e6 for f in (interpreted, compiled, hand_written))
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Time importing pykeepass in a fresh interpreter
+
+Each statement runs in a new process, best of several runs, with the
+startup time of an empty interpreter subtracted.  The last statement
+loads everything `import pykeepass` loaded before imports were lazy.
+
+    python benchmarks/import_time.py
+"""
+
+import subprocess
+import sys
+import time
+
+statements = [
+    'import pykeepass',
+    'from pykeepass import PyKeePass',
+    'import pykeepass, argon2; pykeepass.PyKeePass, pykeepass.icons, pykeepass.__version__',
+]
+
+
+def run(statement, repeat=10):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    baseline = run('pass')
+    for statement in statements:
+        print("{:7.1f} ms  {}".format((run(statement) - baseline) * 1e3, statement))
+
+
+if __name__ == '__main__':
+    main()
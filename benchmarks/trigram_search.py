@@ -0,0 +1,65 @@
+"""Compare regex entry searches with and without a trigram index
+
+Adds entries with generated titles to the KDBX4 test database and times
+find_entries(title=..., regex=True) scanning with re:test, then with a
+trigram index on titles.
+
+    python benchmarks/trigram_search.py [entries]
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+from pykeepass import PyKeePass
+from pykeepass.entry import Entry
+
+tests_dir = Path(__file__).resolve().parent.parent / 'tests'
+
+words = ['mail', 'bank', 'shop', 'cloud', 'forum', 'news', 'git', 'vpn', 'chat', 'photo']
+
+# (pattern, flags)
+queries = [
+    ('.*foo.*', None),
+    ('.*BANK-SHOP-1234.*', 'i'),
+    ('19999', None),
+    ('bank-shop', None),
+    ('(mail|bank)-vpn', None),
+    ('ma', None),
+]
+
+
+def per_call(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def main(entries=20000):
+    kp = PyKeePass(tests_dir / 'test4.kdbx', 'password', tests_dir / 'test4.key')
+    rng = random.Random(1)
+    for i in range(entries):
+        title = '{}-{}-{}'.format(rng.choice(words), rng.choice(words), i)
+        kp.root_group.append(Entry(title, 'user{}'.format(i), 'password', kp=kp))
+
+    def search(pattern, flags):
+        return lambda: kp.find_entries(title=pattern, regex=True, flags=flags)
+
+    scans = [per_call(search(*query), 5) for query in queries]
+    kp.add_trigram_index('title')
+    build = per_call(search('zzz', None), 1)
+    print("{} entries, index built in {:.0f} ms".format(entries, build * 1e3))
+    print("{:32} {:>8} {:>12} {:>12}".format('title', 'matches', 're:test ms', 'trigram ms'))
+    for query, scan in zip(queries, scans):
+        indexed = per_call(search(*query), 20)
+        pattern, flags = query
+        label = pattern + (" (flags='{}')".format(flags) if flags else '')
+        print("{:32} {:8} {:12.2f} {:12.2f}".format(
+            label, len(search(*query)()), scan * 1e3, indexed * 1e3
+        ))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,61 @@
+"""Time Twofish-CBC encryption and saving of a Twofish database
+
+Compares the table driven TwofishCBC chaining mode with the per-block
+pytwofish CBC code it replaced.
+
+    python benchmarks/twofish_save.py [entries]
+"""
+
+import os
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+from pykeepass import PyKeePass
+from pykeepass.kdbx_parsing import twofish
+
+tests_dir = Path(__file__).resolve().parent.parent / 'tests'
+
+
+def time_encrypt(chain, size):
+    key, iv = os.urandom(32), os.urandom(16)
+    cipher = twofish.Twofish.new(key, mode=twofish.Twofish.MODE_CBC, IV=iv)
+    data = os.urandom(size)
+    start = time.perf_counter()
+    chain(cipher.cipher, 16, iv).update(data, 'e')
+    return (time.perf_counter() - start) / (size // 16)
+
+
+def time_save(kp):
+    stream = BytesIO()
+    start = time.perf_counter()
+    kp.save(stream)
+    return time.perf_counter() - start, len(stream.getvalue())
+
+
+def main(entries=2000):
+    print("per block encryption")
+    reference = time_encrypt(twofish.CBC, 2**16)
+    table = time_encrypt(twofish.TwofishCBC, 2**20)
+    print("  pytwofish CBC: {:6.1f} us".format(reference * 1e6))
+    print("  TwofishCBC:    {:6.1f} us ({:.1f}x)".format(table * 1e6, reference / table))
+
+    kp = PyKeePass(tests_dir / 'test4_twofish.kdbx', 'password', tests_dir / 'test4.key')
+    for i in range(entries):
+        kp.add_entry(
+            kp.root_group, 'entry{}'.format(i), 'user{}'.format(i), 'password',
+            notes=os.urandom(256).hex(), force_creation=True
+        )
+    print("save with {} entries".format(entries))
+    with mock.patch.object(twofish, 'TwofishCBC', twofish.CBC):
+        reference, size = time_save(kp)
+    table, size = time_save(kp)
+    print("  payload:       {:6.2f} MB".format(size / 2**20))
+    print("  pytwofish CBC: {:6.2f} s".format(reference))
+    print("  TwofishCBC:    {:6.2f} s ({:.1f}x)".format(table, reference / table))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
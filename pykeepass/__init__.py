@@ -2,11 +2,39 @@
 .. include:: ../README.md
 """
 
-from .pykeepass import PyKeePass, create_database
-from .entry import Entry
-from .group import Group
-from .attachment import Attachment
-from .icons import icons
-from .version import __version__
-
-__all__ = ["__version__", "PyKeePass", "Entry", "Group", "Attachment", "icons", "create_database"]
+import importlib
+
+# public names and the modules they come from.  Modules are imported on
+# first access, so that `import pykeepass` does not load lxml, construct
+# and the cipher libraries
+_lazy_names = {
+    "__version__": ".version",
+    "PyKeePass": ".pykeepass",
+    "HeaderInfo": ".pykeepass",
+    "create_database": ".pykeepass",
+    "probe_header": ".pykeepass",
+    "probe_headers": ".pykeepass",
+    "Entry": ".entry",
+    "Group": ".group",
+    "Attachment": ".attachment",
+    "icons": ".icons",
+    "TransformedKeyCache": ".keycache",
+}
+
+__all__ = [
+    "__version__", "PyKeePass", "Entry", "Group", "Attachment", "icons", "create_database",
+    "TransformedKeyCache", "HeaderInfo", "probe_header", "probe_headers"
+]
+
+
+def __getattr__(name):
+    if name not in _lazy_names:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_lazy_names[name], __name__), name)
+    # cache in module namespace, so __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -6,6 +6,8 @@ from datetime import datetime, timezone
 from lxml import etree
 from lxml.builder import E
 
+from .kdbx_parsing import lazy_offset
+
 
 class BaseElement:
     """Entry and Group inherit from this class"""
@@ -62,6 +64,11 @@ class BaseElement:
     parentgroup = group
 
     def dump_xml(self, pretty_print=False):
+        # decrypt values kept encrypted by lazy unprotect
+        if self._kp is not None:
+            self._kp._unprotect(
+                self._element.iterfind('.//Value[@{}]'.format(lazy_offset))
+            )
         return etree.tostring(self._element, pretty_print=pretty_print)
 
     @property
@@ -74,7 +81,10 @@ class BaseElement:
     def uuid(self, uuid):
         """Set element uuid. `uuid` is a uuid.UUID object"""
         b64_uuid = base64.b64encode(uuid.bytes).decode('utf-8')
-        return self._set_subelement_text('UUID', b64_uuid)
+        old_b64_uuid = self._get_subelement_text('UUID')
+        self._set_subelement_text('UUID', b64_uuid)
+        self._kp._uuid_index.discard(self._element, old_b64_uuid, recursive=False)
+        self._kp._uuid_index.add(self._element, recursive=False)
 
     @property
     def icon(self):
@@ -160,6 +170,7 @@ class BaseElement:
         self._set_times_property('LastModificationTime', value)
 
     def delete(self):
+        self._kp._unindex_element(self._element)
         self._element.getparent().remove(self._element)
 
     def __unicode__(self):
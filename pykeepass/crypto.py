@@ -0,0 +1,208 @@
+"""
+Cipher backends used for database payloads and protected values
+
+Each algorithm can have several registered backends.  The first time an
+algorithm is used, backends whose library cannot be imported are skipped and
+the fastest of the remaining ones is picked with a short self-benchmark.
+
+Algorithms:
+
+- `aes256`: AES-256 in CBC mode, payload cipher
+- `chacha20`: ChaCha20 with 12 byte nonce, payload and protected value cipher
+- `twofish`: Twofish in CBC mode, payload cipher
+- `salsa20`: Salsa20 with 8 byte nonce, KDBX3 protected value cipher
+
+Examples:
+``` python
+>>> from pykeepass import crypto
+>>> def fast_twofish(key, iv):
+...     import fasttwofish
+...     return fasttwofish.new(key, fasttwofish.MODE_CBC, iv)
+>>> crypto.register_backend('twofish', 'fasttwofish', fast_twofish)
+>>> crypto.use_backend('twofish', 'fasttwofish') # skip benchmark
+```
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Cryptodome.Cipher import AES, ChaCha20, Salsa20
+
+log = logging.getLogger(__name__)
+
+# key and IV/nonce sizes used for self-benchmark
+key_sizes = {
+    'aes256': (32, 16),
+    'chacha20': (32, 12),
+    'twofish': (32, 16),
+    'salsa20': (32, 8),
+}
+
+# size of data encrypted and decrypted by self-benchmark
+benchmark_size = 2**14
+
+_backends = {algorithm: OrderedDict() for algorithm in key_sizes}
+_selected = {}
+_lock = threading.Lock()
+
+
+def register_backend(algorithm, name, factory):
+    """Register a cipher implementation
+
+    Args:
+        algorithm (`str`): one of 'aes256', 'chacha20', 'twofish', 'salsa20'
+        name (`str`): name of backend.  Registering an existing name replaces
+            that backend
+        factory (callable): `factory(key, iv)` returns a new cipher object
+            with `encrypt(data)` and `decrypt(data)` methods which keep
+            the cipher state between calls.  Should raise `ImportError` if
+            the underlying library is not installed
+    """
+    if algorithm not in key_sizes:
+        raise ValueError("Unknown algorithm {}".format(algorithm))
+    with _lock:
+        _backends[algorithm][name] = factory
+        # new backend may be faster, select again on next use
+        _selected.pop(algorithm, None)
+
+
+def use_backend(algorithm, name=None):
+    """Force a backend for an algorithm
+
+    Args:
+        algorithm (`str`): algorithm name
+        name (`str`, optional): name of a registered backend.  If None,
+            the backend is selected automatically on next use
+    """
+    if algorithm not in key_sizes:
+        raise ValueError("Unknown algorithm {}".format(algorithm))
+    with _lock:
+        if name is None:
+            _selected.pop(algorithm, None)
+        elif name not in _backends[algorithm]:
+            raise ValueError("No backend {} for {}".format(name, algorithm))
+        else:
+            _selected[algorithm] = name
+
+
+def _benchmark(algorithm, name, factory):
+    """Time encryption and decryption with a backend.  Returns None if the
+    backend is unavailable, fails or does not round trip"""
+
+    key_size, iv_size = key_sizes[algorithm]
+    key, iv = os.urandom(key_size), os.urandom(iv_size)
+    data = os.urandom(benchmark_size)
+    try:
+        start = time.perf_counter()
+        ciphertext = factory(key, iv).encrypt(data)
+        plaintext = factory(key, iv).decrypt(ciphertext)
+        elapsed = time.perf_counter() - start
+    except ImportError:
+        log.debug("Cipher backend {} for {} is not installed".format(name, algorithm))
+        return None
+    except Exception:
+        # a broken installation should not prevent using another backend
+        log.warning(
+            "Cipher backend {} for {} failed".format(name, algorithm),
+            exc_info=True
+        )
+        return None
+    if plaintext != data:
+        log.warning("Cipher backend {} failed self-test for {}".format(name, algorithm))
+        return None
+    return elapsed
+
+
+def get_backend(algorithm):
+    """Name of the backend used for an algorithm, selecting it if necessary
+
+    Args:
+        algorithm (`str`): algorithm name
+
+    Returns:
+        `str`: backend name
+    """
+    with _lock:
+        if algorithm in _selected:
+            return _selected[algorithm]
+
+        backends = _backends[algorithm]
+        if len(backends) == 1:
+            name = next(iter(backends))
+        else:
+            timings = {
+                name: _benchmark(algorithm, name, factory)
+                for name, factory in backends.items()
+            }
+            timings = {name: t for name, t in timings.items() if t is not None}
+            if not timings:
+                raise RuntimeError("No cipher backend available for {}".format(algorithm))
+            name = min(timings, key=timings.get)
+
+        log.debug("Using {} backend for {}".format(name, algorithm))
+        _selected[algorithm] = name
+        return name
+
+
+def new_cipher(algorithm, key, iv):
+    """Create cipher with the selected backend
+
+    Args:
+        algorithm (`str`): algorithm name
+        key (`bytes`): cipher key
+        iv (`bytes`): IV or nonce
+
+    Returns:
+        cipher object with `encrypt` and `decrypt` methods
+    """
+    return _backends[algorithm][get_backend(algorithm)](key, iv)
+
+
+# -------------------- Built-in Backends --------------------
+
+class CryptographyCipher:
+    """Adapt a `cryptography` Cipher to the encrypt/decrypt interface"""
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.encryptor = None
+        self.decryptor = None
+
+    def encrypt(self, data):
+        if self.encryptor is None:
+            self.encryptor = self.cipher.encryptor()
+        return self.encryptor.update(data)
+
+    def decrypt(self, data):
+        if self.decryptor is None:
+            self.decryptor = self.cipher.decryptor()
+        return self.decryptor.update(data)
+
+
+def cryptography_aes(key, iv):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return CryptographyCipher(Cipher(algorithms.AES(key), modes.CBC(iv)))
+
+
+def cryptography_chacha20(key, nonce):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    # cryptography takes a 32 bit block counter followed by a 96 bit nonce
+    return CryptographyCipher(
+        Cipher(algorithms.ChaCha20(key, b'\x00' * 4 + nonce), mode=None)
+    )
+
+
+def pykeepass_twofish(key, iv):
+    from .kdbx_parsing.twofish import Twofish
+    return Twofish.new(key, mode=Twofish.MODE_CBC, IV=iv)
+
+
+register_backend('aes256', 'cryptodome', lambda key, iv: AES.new(key, AES.MODE_CBC, iv))
+register_backend('aes256', 'cryptography', cryptography_aes)
+register_backend('chacha20', 'cryptodome', lambda key, nonce: ChaCha20.new(key=key, nonce=nonce))
+register_backend('chacha20', 'cryptography', cryptography_chacha20)
+register_backend('twofish', 'pykeepass', pykeepass_twofish)
+register_backend('salsa20', 'cryptodome', lambda key, nonce: Salsa20.new(key=key, nonce=nonce))
@@ -7,6 +7,7 @@ from lxml.objectify import ObjectifiedElement
 
 from . import attachment
 from .baseelement import BaseElement
+from .kdbx_parsing import lazy_offset
 
 logger = logging.getLogger(__name__)
 reserved_keys = [
@@ -88,8 +89,11 @@ class Entry(BaseElement):
             `str` or `None`: field value
         """
 
-        field = self._xpath('String/Key[text()="{}"]/../Value'.format(key), history=True, first=True)
+        field = self._xpath('String/Key[text()=$key]/../Value', key=key, first=True)
         if field is not None:
+            # decrypt value kept encrypted by lazy unprotect
+            if lazy_offset in field.attrib:
+                self._kp._unprotect([field])
             return field.text
 
     def _set_string_field(self, key, value, protected=None):
@@ -104,16 +108,20 @@ class Entry(BaseElement):
 
         Note: pykeepass does not support memory protection
         """
-        field = self._xpath('String/Key[text()="{}"]/..'.format(key), history=True, first=True)
+        field = self._xpath('String/Key[text()=$key]/..', key=key, first=True)
 
         protected_str = None
         if protected is None:
-            protected_field = self._xpath('String/Key[text()="{}"]/../Value'.format(key), first=True)
+            protected_field = self._xpath('String/Key[text()=$key]/../Value', key=key, first=True)
             if protected_field is not None:
                 protected_str = protected_field.attrib.get("Protected")
         else:
             protected_str = str(protected)
 
+        indexes = self._kp._string_indexes(key)
+        for index in indexes:
+            index.discard(self._element, recursive=False)
+
         if field is not None:
             self._element.remove(field)
 
@@ -122,6 +130,9 @@ class Entry(BaseElement):
         else:
             self._element.append(E.String(E.Key(key), E.Value(value, Protected=protected_str)))
 
+        for index in indexes:
+            index.add(self._element, recursive=False)
+
     def _get_string_field_keys(self, exclude_reserved=False):
         results = [x.find('Key').text for x in self._element.findall('String')]
         if exclude_reserved:
@@ -354,9 +365,11 @@ class Entry(BaseElement):
     def delete_custom_property(self, key):
         if key not in self._get_string_field_keys(exclude_reserved=True):
             raise AttributeError('No such key: {}'.format(key))
-        prop = self._xpath('String/Key[text()="{}"]/..'.format(key), first=True)
+        prop = self._xpath('String/Key[text()=$key]/..', key=key, first=True)
         if prop is None:
             raise AttributeError('Could not find property element')
+        for index in self._kp._string_indexes(key):
+            index.discard(self._element, recursive=False)
         self._element.remove(prop)
 
     def is_custom_property_protected(self, key):
@@ -377,7 +390,7 @@ class Entry(BaseElement):
 
     def _is_property_protected(self, key):
         """Whether a property is protected."""
-        field = self._xpath('String/Key[text()="{}"]/../Value'.format(key), first=True)
+        field = self._xpath('String/Key[text()=$key]/../Value', key=key, first=True)
         if field is not None:
             return field.attrib.get("Protected", "False") == "True"
         return False
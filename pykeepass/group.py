@@ -97,8 +97,10 @@ class Group(BaseElement):
         if isinstance(entries, list):
             for e in entries:
                 self._element.append(e._element)
+                self._kp._index_element(e._element)
         else:
             self._element.append(entries._element)
+            self._kp._index_element(entries._element)
 
     def __str__(self):
         # filter out NoneTypes and join into string
@@ -0,0 +1,365 @@
+import re
+
+from .xpath import compile_xpath
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# characters which case-insensitive matching treats as equal are folded to the
+# same character.  Only ASCII letters are folded, plus the non-ASCII
+# characters which Python's re.IGNORECASE matches to them
+fold_table = str.maketrans(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ\u0130\u0131\u017f\u212a',
+    'abcdefghijklmnopqrstuvwxyziisk'
+)
+
+
+def _in_tree(elem, root):
+    """Whether an element is attached to the tree below `root` and not part
+    of an entry history"""
+    parent = elem.getparent()
+    while parent is not None and parent.tag != 'History':
+        if parent is root:
+            return True
+        parent = parent.getparent()
+    return False
+
+
+def _position(elem):
+    """Child indexes from the root down to an element"""
+    position = []
+    parent = elem.getparent()
+    while parent is not None:
+        position.append(parent.index(elem))
+        elem, parent = parent, parent.getparent()
+    return position[::-1]
+
+
+def document_order(elements, root, tag):
+    """Sort elements into document order
+
+    Args:
+        elements (`list` of `lxml.etree.Element`): elements below `root`
+        root (`lxml.etree.Element`): common ancestor of the elements
+        tag (`str`): tag of the elements
+
+    Returns:
+        `list` of `lxml.etree.Element`
+    """
+    # finding the index of an element is linear in the number of siblings,
+    # so many elements are put in order by walking the tree instead
+    if len(elements) < 2:
+        return list(elements)
+    if len(elements) <= 16:
+        return sorted(elements, key=_position)
+    elements = set(elements)
+    return [elem for elem in root.iter(tag) if elem in elements]
+
+
+def regex_literal(pattern, flags=None):
+    """Text matched by a regular expression of the form `^text$`
+
+    Args:
+        pattern (`str`): regular expression
+        flags (`str`, optional): XPath regex flags.  Only 'i' is allowed
+
+    Returns:
+        `str` or `None`: the text, or None if the expression matches
+            anything else
+    """
+    if set(flags or '') - {'i'}:
+        return None
+    if not pattern.startswith('^') or not pattern.endswith('$') or pattern.endswith('\\$'):
+        return None
+    text = []
+    chars = iter(pattern[1:-1])
+    for c in chars:
+        if c == '\\':
+            c = next(chars)
+            # escaped letters and digits are classes or backreferences
+            if c.isalnum():
+                return None
+        elif c in '.^$*+?{}[]|()':
+            return None
+        text.append(c)
+    return ''.join(text)
+
+
+def regex_substrings(pattern, flags=None):
+    """Substrings which every text matched by a regular expression contains
+
+    Only runs of literal characters outside of groups, alternations and
+    repeats are extracted.  With case-insensitive matching, non-ASCII
+    characters also end a run.
+
+    Args:
+        pattern (`str`): regular expression
+        flags (`str`, optional): XPath regex flags
+
+    Returns:
+        `list` of `str`: substrings of at least three characters
+    """
+    if set(flags or '') - {'i', 'g'}:
+        return []
+    try:
+        ignorecase = 'i' in (flags or '') or re.compile(pattern).flags & re.IGNORECASE
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    substrings = []
+    run = ''
+    for op, av in parsed:
+        if op == sre_parse.LITERAL and not (ignorecase and av >= 128):
+            run += chr(av)
+        else:
+            substrings.append(run)
+            run = ''
+    substrings.append(run)
+    return [substring for substring in substrings if len(substring) >= 3]
+
+
+class UUIDIndex:
+    """Map of UUIDs to Entry and Group elements
+
+    The index is built with a single pass over the tree on first lookup and
+    kept up to date by `Group.append`, `BaseElement.delete` and the `uuid`
+    setter.  History entries are not indexed.
+
+    Elements can still be changed through lxml directly, so a hit is only
+    returned after checking that the element is attached to the tree and
+    still has the UUID.  UUIDs shared by several elements are not looked up
+    in the index.  On a miss the caller falls back to XPath.
+    """
+
+    tags = ('Entry', 'Group')
+
+    def __init__(self):
+        self._root = None
+        self._elements = None
+        self._duplicates = None
+
+    def _build(self, root):
+        self._root = root
+        self._elements = {tag: {} for tag in self.tags}
+        self._duplicates = {tag: set() for tag in self.tags}
+        for elem in root.iter(*self.tags):
+            self.add(elem, recursive=False)
+
+    def get(self, root, tag, uuid_str):
+        """Look up an element by UUID
+
+        Args:
+            root (`lxml.etree.Element`): root element of the database tree
+            tag (`str`): 'Entry' or 'Group'
+            uuid_str (`str`): base64 encoded UUID as stored in the XML
+
+        Returns:
+            `lxml.etree.Element` or `None`
+        """
+        if self._root is not root:
+            self._build(root)
+        if uuid_str in self._duplicates[tag]:
+            return None
+        elem = self._elements[tag].get(uuid_str)
+        if elem is None:
+            return None
+        # element must not be removed or moved into history
+        if elem.findtext('UUID') == uuid_str and _in_tree(elem, root):
+            return elem
+        # stale, changed outside of pykeepass
+        del self._elements[tag][uuid_str]
+        return None
+
+    def add(self, elem, recursive=True):
+        """Index an element added to the tree
+
+        Args:
+            elem (`lxml.etree.Element`): Entry or Group element
+            recursive (`bool`): also index entries and groups below `elem`
+        """
+        if self._elements is None:
+            return
+        elems = elem.iter(*self.tags) if recursive else (elem,)
+        for elem in elems:
+            parent = elem.getparent()
+            if parent is not None and parent.tag == 'History':
+                continue
+            uuid_str = elem.findtext('UUID')
+            if uuid_str is None:
+                continue
+            elements = self._elements[elem.tag]
+            indexed = elements.get(uuid_str)
+            if (indexed is not None and indexed is not elem
+                    and indexed.findtext('UUID') == uuid_str
+                    and _in_tree(indexed, self._root)):
+                # every element with this UUID must be found by XPath
+                self._duplicates[elem.tag].add(uuid_str)
+            elements[uuid_str] = elem
+
+    def discard(self, elem, uuid_str=None, recursive=True):
+        """Remove an element removed from the tree
+
+        Args:
+            elem (`lxml.etree.Element`): Entry or Group element
+            uuid_str (`str`, optional): UUID the element was indexed under,
+                if it differs from the current one
+            recursive (`bool`): also remove entries and groups below `elem`
+        """
+        if self._elements is None:
+            return
+        elems = elem.iter(*self.tags) if recursive else (elem,)
+        for child in elems:
+            key = child.findtext('UUID')
+            if child is elem and uuid_str is not None:
+                key = uuid_str
+            elements = self._elements[child.tag]
+            if elements.get(key) is child:
+                del elements[key]
+
+
+class FieldIndex:
+    """Map of string field values to Entry elements
+
+    The index is built with a single pass over the tree on first lookup and
+    kept up to date by `Entry._set_string_field`, `Group.append` and
+    `BaseElement.delete`.  History entries are not indexed.  Lookups return
+    candidates which must still be checked against the tree.
+
+    Args:
+        key (`str`): string field name, such as 'Title'
+        casefold (`bool`): index values folded with `fold_table`, so that
+            lookups of ASCII values are case-insensitive like
+            `re.IGNORECASE`
+    """
+
+    def __init__(self, key, casefold=False):
+        self.key = key
+        self.casefold = casefold
+        self._root = None
+        self._values = None
+
+    def _tokens(self, value):
+        """Keys a field value is indexed under"""
+        return (value.translate(fold_table) if self.casefold else value,)
+
+    def _index(self, elem, value):
+        for token in self._tokens(value):
+            self._values.setdefault(token, set()).add(elem)
+
+    def _build(self, root):
+        self._root = root
+        self._values = {}
+        # selecting the keys with XPath is faster than walking every String
+        for key in compile_xpath('/descendant::Key[text()=$key]')(root, key=self.key):
+            string = key.getparent()
+            elem = string.getparent()
+            if string.tag != 'String' or elem.tag != 'Entry' or elem.getparent().tag == 'History':
+                continue
+            value = key.getnext()
+            if value is None or value.tag != 'Value':
+                value = string.find('Value')
+            self._index(elem, (value.text or '') if value is not None else '')
+
+    def get(self, root, value):
+        """Look up entries by field value
+
+        Args:
+            root (`lxml.etree.Element`): root element of the database tree
+            value (`str`): field value
+
+        Returns:
+            `list` of `lxml.etree.Element`: candidate entries, in no
+                particular order
+        """
+        if self._root is not root:
+            self._build(root)
+        value, = self._tokens(value)
+        return list(self._values.get(value, ()))
+
+    def add(self, elem, recursive=True):
+        """Index entries added to the tree or changed
+
+        Args:
+            elem (`lxml.etree.Element`): Entry or Group element
+            recursive (`bool`): also index entries below `elem`
+        """
+        if self._values is None:
+            return
+        elems = elem.iter('Entry') if recursive else (elem,)
+        for elem in elems:
+            if not _in_tree(elem, self._root):
+                continue
+            for value in self._field_values(elem):
+                self._index(elem, value)
+
+    def discard(self, elem, recursive=True):
+        """Remove entries removed from the tree, or about to change
+
+        Args:
+            elem (`lxml.etree.Element`): Entry or Group element
+            recursive (`bool`): also remove entries below `elem`
+        """
+        if self._values is None:
+            return
+        elems = elem.iter('Entry') if recursive else (elem,)
+        for elem in elems:
+            for value in self._field_values(elem):
+                for token in self._tokens(value):
+                    elements = self._values.get(token)
+                    if elements is not None:
+                        elements.discard(elem)
+                        if not elements:
+                            del self._values[token]
+
+    def _field_values(self, elem):
+        return [
+            string.findtext('Value') or ''
+            for string in elem.iterfind('String')
+            if string.findtext('Key') == self.key
+        ]
+
+
+class TrigramIndex(FieldIndex):
+    """Map of the three character substrings of a string field to Entry
+    elements, used to narrow down substring and regular expression searches
+
+    Values are folded character by character with `fold_table`, so the
+    index also serves case-insensitive searches.
+
+    Args:
+        key (`str`): string field name, such as 'Title'
+    """
+
+    def _tokens(self, value):
+        value = value.translate(fold_table)
+        return {value[i:i + 3] for i in range(len(value) - 2)}
+
+    def search(self, root, substrings):
+        """Look up entries containing substrings of a field value
+
+        Args:
+            root (`lxml.etree.Element`): root element of the database tree
+            substrings (`list` of `str`): text which the field value contains
+
+        Returns:
+            `list` of `lxml.etree.Element` or `None`: candidate entries in no
+                particular order, or None if the substrings are too short to
+                narrow down the search
+        """
+        if self._root is not root:
+            self._build(root)
+        tokens = set()
+        for substring in substrings:
+            tokens.update(self._tokens(substring))
+        if not tokens:
+            return None
+        # intersect starting from the rarest trigram
+        sets = sorted((self._values.get(token, set()) for token in tokens), key=len)
+        elements = set(sets[0])
+        for other in sets[1:]:
+            if not elements:
+                break
+            elements &= other
+        return list(elements)
@@ -1,4 +1,21 @@
-from .kdbx import KDBX
+from .common import (
+    MappedFile,
+    compression_profiles,
+    compression_settings,
+    lazy_offset,
+    protected_streams,
+)
+from .kdbx import KDBX, Header, KDBXCredentialCheck
 from .kdbx4 import kdf_uuids
 
-__all__ = ["KDBX", "kdf_uuids"]
+__all__ = [
+    "KDBX",
+    "Header",
+    "KDBXCredentialCheck",
+    "MappedFile",
+    "compression_profiles",
+    "compression_settings",
+    "kdf_uuids",
+    "lazy_offset",
+    "protected_streams",
+]
@@ -1,18 +1,22 @@
 import base64
 import codecs
 import hashlib
+import hmac
 import io
 import logging
+import mmap
 import re
+import struct
 import zlib
 from binascii import Error as BinasciiError
-from collections import OrderedDict
-from copy import deepcopy
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from construct import (
     Adapter,
     BitsSwapped,
     BitStruct,
+    Construct,
     Container,
     Flag,
     GreedyBytes,
@@ -20,29 +24,21 @@ from construct import (
     ListContainer,
     Mapping,
     Padding,
+    Prefixed,
+    StreamError,
+    Subconstruct,
     Switch,
 )
-from Cryptodome.Cipher import AES, ChaCha20, Salsa20
+from Cryptodome.Cipher import AES
 from Cryptodome.Util import Padding as CryptoPadding
 from lxml import etree
 
-from .twofish import Twofish
+from ..crypto import new_cipher
+from ..exceptions import CredentialsError, HeaderChecksumError, PayloadChecksumError
 
 log = logging.getLogger(__name__)
 
 
-class HeaderChecksumError(Exception):
-    pass
-
-
-class CredentialsError(Exception):
-    pass
-
-
-class PayloadChecksumError(Exception):
-    pass
-
-
 class DynamicDict(Adapter):
     """ListContainer <---> Container
     Convenience mapping so we dont have to iterate ListContainer to find
@@ -88,7 +84,7 @@ def Reparsed(subcon_out):
         Takes in bytes and reparses it with subcon_out"""
 
         def _decode(self, data, con, path):
-            return subcon_out.parse(data, **con)
+            return subcon_out.parse_stream(BufferStream(data), **con)
 
         def _encode(self, obj, con, path):
             return subcon_out.build(obj, **con)
@@ -96,12 +92,146 @@ def Reparsed(subcon_out):
     return Reparsed
 
 
+# -------------------- Fast Parsing --------------------
+
+class FastParseError(Exception):
+    """Data not handled by a hand-written parser, see FastParsed"""
+
+
+class ReplayedStream:
+    """Keeps data read from a stream which cannot seek, so that it can be
+    read again after replay(), see FastParsed"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        # bytes objects as returned by stream, so recording does not copy
+        self.chunks = deque()
+        self.replaying = False
+        self.position = 0
+
+    def replay(self):
+        self.replaying = True
+        return self
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if not self.replaying:
+            data = self.stream.read(size)
+            self.chunks.append(data)
+            return data
+
+        data = b''
+        while self.chunks and (size < 0 or len(data) < size):
+            chunk = self.chunks.popleft()
+            if size >= 0 and len(data) + len(chunk) > size:
+                self.chunks.appendleft(chunk[size - len(data):])
+                chunk = chunk[:size - len(data)]
+            data += chunk
+        if size < 0:
+            data += self.stream.read()
+        elif len(data) < size:
+            data += self.stream.read(size - len(data))
+        self.position += len(data)
+        return data
+
+
+class FastParsed(Subconstruct):
+    """Parse with fast_parse(stream, context), a hand-written equivalent of
+    subcon which returns the same result without construct's per-field
+    overhead.  If it raises FastParseError (e.g. on truncated or unusual
+    data), the data is read again by subcon, so subcon stays the reference
+    and reports errors.  Building always uses subcon.
+
+    The `fast_parse=False` parse parameter disables fast_parse"""
+
+    def __init__(self, fast_parse, subcon):
+        super().__init__(subcon)
+        self.fast_parse = fast_parse
+
+    def _parse(self, stream, context, path):
+        if not context_param(context, 'fast_parse', True):
+            return self.subcon._parsereport(stream, context, path)
+
+        try:
+            seekable = stream.seekable()
+        except AttributeError:
+            seekable = False
+        if seekable:
+            position = stream.tell()
+            try:
+                return self.fast_parse(stream, context)
+            except FastParseError:
+                stream.seek(position)
+        else:
+            # e.g. the payload while it is decrypted or decompressed
+            replayed = ReplayedStream(stream)
+            try:
+                return self.fast_parse(replayed, context)
+            except FastParseError:
+                stream = replayed.replay()
+        return self.subcon._parsereport(stream, context, path)
+
+
+def read_exact(stream, size):
+    """Read exactly size bytes from stream"""
+
+    data = stream.read(size)
+    if len(data) != size:
+        raise FastParseError("Unexpected end of data")
+    return data
+
+
+def unpack_exact(fmt, data):
+    """Unpack a single value from data of exactly its size"""
+
+    if len(data) != struct.calcsize(fmt):
+        raise FastParseError("Unexpected data length {}".format(len(data)))
+    return struct.unpack(fmt, data)[0]
+
+
+def decode_mapping(mapping, value):
+    """Name of value in a construct Mapping dict"""
+
+    for name, mapped in mapping.items():
+        if mapped == value:
+            return name
+    raise FastParseError("Unknown value {!r}".format(value))
+
+
+def parse_header_items(stream, fmt, key, ids, parsers):
+    """Parse type-length-value header items up to and including the 'end'
+    item.  fmt unpacks an item type and data length, ids is the Mapping
+    dict of item types and parsers maps item types to functions parsing
+    item data.  Items of other types keep their data as bytes"""
+
+    items = ListContainer()
+    size = struct.calcsize(fmt)
+    while True:
+        item_type, length = struct.unpack(fmt, read_exact(stream, size))
+        item = Container()
+        item[key] = decode_mapping(ids, item_type)
+        data = read_exact(stream, length)
+        parser = parsers.get(item[key])
+        item.data = parser(data) if parser is not None else data
+        items.append(item)
+        if item[key] == 'end':
+            return items
+
+
 # is the payload compressed?
 CompressionFlags = BitsSwapped(
     BitStruct("compression" / Flag, Padding(8 * 4 - 1))
 )
 
 
+def parse_compression_flags(data):
+    """Hand-written CompressionFlags"""
+
+    return Container(compression=bool(unpack_exact('<I', data) & 1))
+
+
 # -------------------- Key Computation --------------------
 def aes_kdf(key, rounds, key_composite):
     """Set up a context for AES128-ECB encryption to find transformed_key"""
@@ -116,6 +246,32 @@ def aes_kdf(key, rounds, key_composite):
     return hashlib.sha256(transformed_key).digest()
 
 
+def cached_kdf(context, key_composite, kdf_parameters, kdf):
+    """Run kdf on key_composite unless the key_cache passed to the parser or
+    builder already holds the result.
+    kdf_parameters identifies the KDF, salt and parameters in the header.
+
+    While parsing, a derived key is not stored but appended to the new_keys
+    list passed to the parser (if any), so the caller can store it once the
+    credentials have been verified"""
+
+    key_cache = context._._.get('key_cache')
+    if key_cache is not None:
+        transformed_key = key_cache.get(key_composite, kdf_parameters)
+        if transformed_key is not None:
+            return transformed_key
+
+    transformed_key = kdf(key_composite)
+    if context._parsing:
+        new_keys = context._._.get('new_keys')
+        if new_keys is not None:
+            new_keys.append((key_composite, kdf_parameters, transformed_key))
+    elif key_cache is not None:
+        key_cache.set(key_composite, kdf_parameters, transformed_key)
+
+    return transformed_key
+
+
 def compute_key_composite(password=None, keyfile=None):
     """Compute composite key.
     Used in header verification and payload decryption."""
@@ -202,10 +358,61 @@ class XML(Adapter):
         return etree.tostring(tree)
 
 
+class XMLStream(Construct):
+    """Stream <---> lxml etree
+    Parse directly from the rest of the stream and serialize directly into
+    it, so the XML is never held in memory as a single bytes object"""
+
+    def _parse(self, stream, con, path):
+        parser = etree.XMLParser(remove_blank_text=True)
+        return etree.parse(stream, parser)
+
+    def _build(self, tree, stream, con, path):
+        # lxml serializes to file objects in small pieces
+        tree.write(stream)
+        return tree
+
+
+invalid_xml_chars = re.compile(
+    '[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+'
+)
+
+# attribute holding the keystream offset of a protected value which is kept
+# encrypted until it is read (lazy unprotect)
+lazy_offset = 'PyKeePassOffset'
+
+
+def strip_invalid_xml_chars(text):
+    # https://stackoverflow.com/questions/8733233
+    if invalid_xml_chars.search(text):
+        return invalid_xml_chars.sub('', text)
+    return text
+
+
+def log_unprotect_error(tree, elem):
+    # FIXME: this should be a warning eventually, need to fix all databases in tests/ first
+    log.error(
+        "Element at {} marked as protected, but could not unprotect".format(tree.getpath(elem))
+    )
+
+
+def context_param(con, name, default=None):
+    """Look up a parse parameter from any enclosing context"""
+
+    while con is not None:
+        if name in con:
+            return con[name]
+        con = con.get('_')
+    return default
+
+
 class UnprotectedStream(Adapter):
     """lxml etree <---> unprotected lxml etree
     Iterate etree for Protected elements and decrypt using cipher
-    provided by get_cipher"""
+    provided by get_cipher
+
+    With the `lazy_unprotect` parse parameter, values keep their ciphertext
+    and only their keystream offset is recorded, see `unprotect_values`"""
 
     protected_xpath = '//Value[@Protected=\'True\']'
 
@@ -214,63 +421,149 @@ class UnprotectedStream(Adapter):
         self.protected_stream_key = protected_stream_key
 
     def _decode(self, tree, con, path):
-        cipher = self.get_cipher(self.protected_stream_key(con))
+        # protected values are encrypted with one keystream in document
+        # order, so decrypt them all with a single call and slice the result
+        elems = []
+        ciphertexts = []
         for elem in tree.xpath(self.protected_xpath):
             if elem.text is not None:
                 try:
-                    result = cipher.decrypt(base64.b64decode(elem.text)).decode('utf-8')
-                    # strip invalid XML characters - https://stackoverflow.com/questions/8733233
-                    result = re.sub(
-                        '[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+',
-                        '',
-                        result
-                    )
-                    elem.text = result
-                except (UnicodeDecodeError, BinasciiError, ValueError):
-                    # FIXME: this should be a warning eventually, need to fix all databases in tests/ first
-                    log.error(
-                        "Element at {} marked as protected, but could not unprotect".format(tree.getpath(elem))
-                    )
-        return tree
+                    ciphertexts.append(base64.b64decode(elem.text))
+                    elems.append(elem)
+                except BinasciiError:
+                    log_unprotect_error(tree, elem)
+
+        if context_param(con, 'lazy_unprotect', False):
+            offset = 0
+            for elem, ciphertext in zip(elems, ciphertexts):
+                elem.set(lazy_offset, str(offset))
+                offset += len(ciphertext)
+            return tree
 
-    def _encode(self, tree, con, path):
-        tree_copy = deepcopy(tree)
         cipher = self.get_cipher(self.protected_stream_key(con))
-        for elem in tree_copy.xpath(self.protected_xpath):
-            if elem.text is not None:
-                elem.text = base64.b64encode(
-                    cipher.encrypt(
-                        elem.text.encode('utf-8')
-                    )
-                )
-        return tree_copy
+        plaintext = cipher.decrypt(b''.join(ciphertexts))
+
+        offset = 0
+        for elem, ciphertext in zip(elems, ciphertexts):
+            end = offset + len(ciphertext)
+            try:
+                elem.text = strip_invalid_xml_chars(plaintext[offset:end].decode('utf-8'))
+            except UnicodeDecodeError:
+                log_unprotect_error(tree, elem)
+            offset = end
+        return tree
+
+    def _build(self, tree, stream, con, path):
+        # encrypt values in place and restore them once the tree has been
+        # serialized, instead of encrypting a deep copy of the whole tree
+        protected_stream_key = self.protected_stream_key(con)
+        elems = [elem for elem in tree.xpath(self.protected_xpath) if elem.text is not None]
+        offsets = [elem.attrib.pop(lazy_offset, None) for elem in elems]
+        originals = [(elem, elem.text, offset) for elem, offset in zip(elems, offsets)]
+        try:
+            # values kept encrypted by lazy unprotect are decrypted together,
+            # with one pass over the keystream
+            lazy = [n for n, offset in enumerate(offsets) if offset is not None]
+            values = self.unprotect_values(
+                protected_stream_key,
+                [(int(offsets[n]), elems[n].text) for n in lazy]
+            )
+            texts = [elem.text for elem in elems]
+            for n, value in zip(lazy, values):
+                if value is None:
+                    log_unprotect_error(tree, elems[n])
+                else:
+                    texts[n] = value
+
+            cipher = self.get_cipher(protected_stream_key)
+            for elem, text in zip(elems, texts):
+                elem.text = base64.b64encode(cipher.encrypt(text.encode('utf-8')))
+            self.subcon._build(tree, stream, con, path)
+        finally:
+            for elem, text, offset in originals:
+                elem.text = text
+                if offset is not None:
+                    elem.set(lazy_offset, offset)
+        return tree
+
+    @classmethod
+    def unprotect_values(cls, protected_stream_key, values):
+        """Decrypt protected values kept encrypted by lazy unprotect
+
+        Values are decrypted in keystream order with a single cipher, so the
+        keystream is only generated once.
+
+        Args:
+            protected_stream_key (`bytes`): key of protected value stream
+            values (`list` of (`int`, `str`)): keystream offset and base64
+                encoded ciphertext of each value
+
+        Returns:
+            `list` of `str`: values in the given order, None for values
+                which could not be decrypted
+        """
+        results = [None] * len(values)
+        decrypted = {}
+        cipher = None
+        position = 0
+        for n in sorted(range(len(values)), key=lambda n: values[n][0]):
+            offset, text = values[n]
+            # copies of a value (e.g. in entry history) share its offset
+            if (offset, text) in decrypted:
+                results[n] = decrypted[offset, text]
+                continue
+            try:
+                ciphertext = base64.b64decode(text)
+            except BinasciiError:
+                continue
+            if cipher is None or offset < position:
+                cipher = cls.get_cipher(protected_stream_key)
+                position = 0
+            if offset > position:
+                if hasattr(cipher, 'seek'):
+                    cipher.seek(offset)
+                else:
+                    # no random access, skip keystream by decrypting zeros
+                    cipher.decrypt(bytes(offset - position))
+            plaintext = cipher.decrypt(ciphertext)
+            position = offset + len(ciphertext)
+            try:
+                results[n] = strip_invalid_xml_chars(plaintext.decode('utf-8'))
+            except UnicodeDecodeError:
+                continue
+            decrypted[offset, text] = results[n]
+        return results
 
 
 class ARCFourVariantStream(UnprotectedStream):
-    def get_cipher(self, protected_stream_key):
+    @staticmethod
+    def get_cipher(protected_stream_key):
         raise Exception("ARCFourVariant not implemented")
 
 
 # https://github.com/dlech/KeePass2.x/blob/97141c02733cd3abf8d4dce1187fa7959ded58a8/KeePassLib/Cryptography/CryptoRandomStream.cs#L115-L119
 class Salsa20Stream(UnprotectedStream):
-    def get_cipher(self, protected_stream_key):
+    @staticmethod
+    def get_cipher(protected_stream_key):
         key = hashlib.sha256(protected_stream_key).digest()
-        return Salsa20.new(
-            key=key,
-            nonce=b'\xE8\x30\x09\x4B\x97\x20\x5D\x2A'
-        )
+        return new_cipher('salsa20', key, b'\xE8\x30\x09\x4B\x97\x20\x5D\x2A')
 
 
 # https://github.com/dlech/KeePass2.x/blob/97141c02733cd3abf8d4dce1187fa7959ded58a8/KeePassLib/Cryptography/CryptoRandomStream.cs#L103-L111
 class ChaCha20Stream(UnprotectedStream):
-    def get_cipher(self, protected_stream_key):
+    @staticmethod
+    def get_cipher(protected_stream_key):
         key_hash = hashlib.sha512(protected_stream_key).digest()
         key = key_hash[:32]
         nonce = key_hash[32:44]
-        return ChaCha20.new(
-            key=key,
-            nonce=nonce
-        )
+        return new_cipher('chacha20', key, nonce)
+
+
+protected_streams = {
+    'arcfourvariant': ARCFourVariantStream,
+    'salsa20': Salsa20Stream,
+    'chacha20': ChaCha20Stream,
+}
 
 
 def Unprotect(protected_stream_id, protected_stream_key, subcon):
@@ -278,14 +571,58 @@ def Unprotect(protected_stream_id, protected_stream_key, subcon):
 
     return Switch(
         protected_stream_id,
-        {'arcfourvariant': ARCFourVariantStream(protected_stream_key, subcon),
-         'salsa20': Salsa20Stream(protected_stream_key, subcon),
-         'chacha20': ChaCha20Stream(protected_stream_key, subcon),
-         },
+        {stream_id: stream(protected_stream_key, subcon)
+         for stream_id, stream in protected_streams.items()},
         default=subcon
     )
 
 
+# -------------------- Payload Verification --------------------
+
+class VerifiedBlocks(Adapter):
+    """Hashed Blocks <---> Hashed Blocks
+    Blocks are parsed without checking them, then all block hashes are
+    computed concurrently on a thread pool (hashlib releases the GIL for
+    large buffers).  Block hashes are filled in when building.
+
+    Args:
+        subcon: list of blocks, each with `block_data` and `hash_field`
+        hash_field (`str`): name of the block field holding the hash
+        compute_hash (callable): `compute_hash(con, index, block_data)`
+            returns the expected hash of a block
+    """
+
+    def __init__(self, subcon, hash_field, compute_hash):
+        super().__init__(subcon)
+        self.hash_field = hash_field
+        self.compute_hash = compute_hash
+
+    def compute_hashes(self, blocks, con):
+        def compute(index):
+            return self.compute_hash(con, index, blocks[index].block_data)
+
+        # not worth starting threads for the usual single block database
+        if len(blocks) <= 2:
+            return [compute(index) for index in range(len(blocks))]
+        with ThreadPoolExecutor() as executor:
+            return list(executor.map(compute, range(len(blocks))))
+
+    def _decode(self, blocks, con, path):
+        hashes = self.compute_hashes(blocks, con)
+        for index, (block, block_hash) in enumerate(zip(blocks, hashes)):
+            if not hmac.compare_digest(block[self.hash_field], block_hash):
+                raise PayloadChecksumError(
+                    "Error reading database contents at block {}".format(index)
+                )
+        return blocks
+
+    def _encode(self, blocks, con, path):
+        hashes = self.compute_hashes(blocks, con)
+        for block, block_hash in zip(blocks, hashes):
+            block[self.hash_field] = block_hash
+        return blocks
+
+
 # -------------------- Payload Encryption/Decompression --------------------
 
 class Concatenated(Adapter):
@@ -307,7 +644,14 @@ class Concatenated(Adapter):
 
 
 class DecryptedPayload(Adapter):
-    """Encrypted Bytes <---> Decrypted Bytes"""
+    """Encrypted Bytes <---> Decrypted Bytes
+
+    Set padded=False when subcon only covers the start of the payload, which
+    then has no padding to remove"""
+
+    def __init__(self, subcon, padded=True):
+        super().__init__(subcon)
+        self.padded = padded
 
     def _decode(self, payload_data, con, path):
         cipher = self.get_cipher(
@@ -315,6 +659,8 @@ class DecryptedPayload(Adapter):
             con._.header.value.dynamic_header.encryption_iv.data
         )
         payload_data = cipher.decrypt(payload_data)
+        if not self.padded:
+            return payload_data
         # FIXME: Construct ugliness.  Fixes #244.  First 32 bytes of decrypted kdbx3 payload
         # should be checked against stream_start_bytes for a CredentialsError.  Due to construct
         # limitations, we have to decrypt the whole payload in order to check the first 32 bytes.
@@ -322,7 +668,8 @@ class DecryptedPayload(Adapter):
         # be unpadded correctly.  Instead, catch the unpad ValueError exception raised by unpad()
         # and allow kdbx3.py to raise a ChecksumError
         try:
-            payload_data = self.unpad(payload_data)
+            # unpad a view to avoid copying the payload
+            payload_data = self.unpad(memoryview(payload_data))
         except ValueError:
             log.debug("Decryption unpadding failed")
 
@@ -338,34 +685,115 @@ class DecryptedPayload(Adapter):
 
         return payload_data
 
+    @classmethod
+    def decrypt_chunks(cls, chunks, master_key, encryption_iv):
+        """Decrypt an iterable of ciphertext chunks, carrying the cipher state
+        from one chunk to the next.  Yields plaintext with padding removed"""
+
+        cipher = cls.get_cipher(master_key, encryption_iv)
+        # ciphertext which does not fill a cipher block yet
+        pending = b''
+        # last plaintext block, which may hold the padding
+        held = b''
+        for chunk in chunks:
+            # chunks may be memoryviews of a MappedFile, which are only
+            # copied when joined with leftover ciphertext
+            pending = bytes(pending) + chunk if pending else chunk
+            length = len(pending) - len(pending) % cls.block_size
+            if length == 0:
+                continue
+            data = held + cipher.decrypt(pending[:length])
+            pending = pending[length:]
+            held = data[-cls.block_size:]
+            yield data[:-cls.block_size]
+        try:
+            yield cls.unpad(held)
+        except ValueError:
+            log.debug("Decryption unpadding failed")
+            yield held
+
 
 class AES256Payload(DecryptedPayload):
-    def get_cipher(self, master_key, encryption_iv):
-        return AES.new(master_key, AES.MODE_CBC, encryption_iv)
-    def pad(self, data):
+    block_size = 16
+    @staticmethod
+    def get_cipher(master_key, encryption_iv):
+        return new_cipher('aes256', master_key, encryption_iv)
+    @staticmethod
+    def pad(data):
         return CryptoPadding.pad(data, 16)
-    def unpad(self, data):
+    @staticmethod
+    def unpad(data):
         return CryptoPadding.unpad(data, 16)
 
 
 class ChaCha20Payload(DecryptedPayload):
-    def get_cipher(self, master_key, encryption_iv):
-        return ChaCha20.new(key=master_key, nonce=encryption_iv)
-    def pad(self, data):
+    block_size = 1
+    @staticmethod
+    def get_cipher(master_key, encryption_iv):
+        return new_cipher('chacha20', master_key, encryption_iv)
+    @staticmethod
+    def pad(data):
         return data
-    def unpad(self, data):
+    @staticmethod
+    def unpad(data):
         return data
 
 
 class TwoFishPayload(DecryptedPayload):
-    def get_cipher(self, master_key, encryption_iv):
-        return Twofish.new(master_key, mode=Twofish.MODE_CBC, IV=encryption_iv)
-    def pad(self, data):
+    block_size = 16
+    @staticmethod
+    def get_cipher(master_key, encryption_iv):
+        return new_cipher('twofish', master_key, encryption_iv)
+    @staticmethod
+    def pad(data):
         return CryptoPadding.pad(data, 16)
-    def unpad(self, data):
+    @staticmethod
+    def unpad(data):
         return CryptoPadding.unpad(data, 16)
 
 
+payload_ciphers = {
+    'aes256': AES256Payload,
+    'chacha20': ChaCha20Payload,
+    'twofish': TwoFishPayload
+}
+
+
+# zlib (level, strategy) of each compression profile.  None disables compression
+compression_profiles = {
+    'off': None,
+    'fast': (1, zlib.Z_DEFAULT_STRATEGY),
+    'default': (6, zlib.Z_DEFAULT_STRATEGY),
+    'max': (9, zlib.Z_DEFAULT_STRATEGY),
+}
+
+
+def compression_settings(compression):
+    """zlib (level, strategy) from a profile name, a level or a (level,
+    strategy) tuple.  True and False select the 'default' and 'off'
+    profiles.  None if compression is off"""
+
+    if isinstance(compression, bool):
+        compression = 'default' if compression else 'off'
+    if isinstance(compression, str):
+        if compression not in compression_profiles:
+            raise ValueError("Unknown compression profile {}".format(compression))
+        return compression_profiles[compression]
+    if isinstance(compression, int):
+        compression = (compression, zlib.Z_DEFAULT_STRATEGY)
+    level, strategy = compression
+    if not -1 <= level <= 9:
+        raise ValueError("Invalid compression level {}".format(level))
+    return level, strategy
+
+
+def new_compressobj(con):
+    """gzip compressor using the `compression_level` build parameter"""
+
+    level, strategy = context_param(con, 'compression_level', compression_profiles['default'])
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + 15, zlib.DEF_MEM_LEVEL, strategy)
+
+
 class Decompressed(Adapter):
     """Compressed Bytes <---> Decompressed Bytes"""
 
@@ -373,37 +801,342 @@ class Decompressed(Adapter):
         return zlib.decompress(data, 16 + 15)
 
     def _encode(self, data, con, path):
-        compressobj = zlib.compressobj(
-            6,
-            zlib.DEFLATED,
-            16 + 15,
-            zlib.DEF_MEM_LEVEL,
-            0
-        )
+        compressobj = new_compressobj(con)
         data = compressobj.compress(data)
         data += compressobj.flush()
         return data
 
 
+def decompress_chunks(chunks, max_length=2**20):
+    """Decompress an iterable of gzip chunks, yielding at most max_length
+    bytes at a time"""
+
+    decompressobj = zlib.decompressobj(16 + 15)
+    for chunk in chunks:
+        while chunk:
+            data = decompressobj.decompress(chunk, max_length)
+            chunk = decompressobj.unconsumed_tail
+            if data:
+                yield data
+    data = decompressobj.flush()
+    if data:
+        yield data
+
+
+# -------------------- Streaming --------------------
+
+class BufferStream(io.RawIOBase):
+    """Read-only file object over a bytes-like object.  Unlike io.BytesIO
+    it does not copy the buffer, and `read_view` returns slices of it
+    without copying them"""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(offset, 0)
+        return self.position
+
+    def read_view(self, size=-1):
+        """Like read, but returns a memoryview of the mapping"""
+        if size is None or size < 0:
+            size = len(self.view)
+        data = self.view[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def read(self, size=-1):
+        return bytes(self.read_view(size))
+
+    def readinto(self, buffer):
+        data = self.read_view(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class MappedFile(BufferStream):
+    """Read-only file object over a memory mapped file"""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(self.mmap)
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+            try:
+                self.mmap.close()
+            except BufferError:
+                # slices are still referenced, the mapping is closed when
+                # they are freed
+                log.debug("Memory mapped file still in use")
+        super().close()
+
+
+def read_view(stream, size):
+    """Read from stream without copying if it is a BufferStream"""
+
+    if isinstance(stream, BufferStream):
+        return stream.read_view(size)
+    return stream.read(size)
+
+
+class PrefixedBytes(Prefixed):
+    """Prefixed(lengthfield, GreedyBytes) which does not copy data read from
+    a BufferStream"""
+
+    def __init__(self, lengthfield):
+        super().__init__(lengthfield, GreedyBytes)
+
+    def _parse(self, stream, context, path):
+        length = self.lengthfield._parsereport(stream, context, path)
+        data = read_view(stream, length)
+        if len(data) != length:
+            raise StreamError(
+                "stream read less than specified amount, expected {}, found {}".format(
+                    length, len(data)
+                ),
+                path=path
+            )
+        return data
+
+
+class GreedyView(type(GreedyBytes)):
+    """GreedyBytes which does not copy data read from a BufferStream"""
+
+    def _parse(self, stream, context, path):
+        if isinstance(stream, BufferStream):
+            return stream.read_view()
+        return super()._parse(stream, context, path)
+
+
+class ChunkedStream(io.RawIOBase):
+    """Read-only file object over an iterator of bytes chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+        self.position = 0
+        # exception raised while producing chunks.  Readers such as construct
+        # and lxml replace it with their own error
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            try:
+                self.chunk = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+            except Exception as e:
+                self.error = e
+                raise
+        length = min(len(buffer), len(self.chunk))
+        buffer[:length] = self.chunk[:length]
+        self.chunk = self.chunk[length:]
+        self.position += length
+        return length
+
+    def drain(self):
+        """Consume remaining chunks"""
+        for _ in self.chunks:
+            pass
+        self.chunk = memoryview(b'')
+
+
+class ChunkedWriter:
+    """Write-only file object which transforms data and passes it on to
+    `out`, the next ChunkedWriter or the output stream.  Used to compress,
+    encrypt and frame the payload piece by piece while it is being built"""
+
+    def __init__(self, out):
+        self.out = out
+
+    def transform(self, data):
+        return data
+
+    def finish(self):
+        return b''
+
+    def write(self, data):
+        self.out.write(self.transform(data))
+        return len(data)
+
+    def close(self):
+        """Write remaining data and close the rest of the pipeline"""
+        self.out.write(self.finish())
+        if isinstance(self.out, ChunkedWriter):
+            self.out.close()
+
+
+class CompressedWriter(ChunkedWriter):
+    """gzip compress written data with compressobj"""
+
+    def __init__(self, out, compressobj):
+        super().__init__(out)
+        self.compressobj = compressobj
+
+    def transform(self, data):
+        return self.compressobj.compress(data)
+
+    def finish(self):
+        return self.compressobj.flush()
+
+
+class EncryptedWriter(ChunkedWriter):
+    """Encrypt written data with the cipher of a DecryptedPayload subclass,
+    padding the end of the data"""
+
+    def __init__(self, out, payload, master_key, encryption_iv):
+        super().__init__(out)
+        self.payload = payload
+        self.cipher = payload.get_cipher(master_key, encryption_iv)
+        # plaintext which does not fill a cipher block yet
+        self.pending = b''
+
+    def transform(self, data):
+        self.pending += data
+        length = len(self.pending) - len(self.pending) % self.payload.block_size
+        data, self.pending = self.pending[:length], self.pending[length:]
+        return self.cipher.encrypt(data) if data else b''
+
+    def finish(self):
+        return self.cipher.encrypt(self.payload.pad(self.pending))
+
+
+class BlockWriter(ChunkedWriter):
+    """Split written data into blocks of block_size bytes, each framed by
+    frame(index, block_data).  An empty block marks the end"""
+
+    def __init__(self, out, frame, block_size=2**20):
+        super().__init__(out)
+        self.frame = frame
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.index = 0
+
+    def blocks(self, final=False):
+        frames = []
+        while len(self.buffer) >= self.block_size or (final and self.buffer):
+            block_data = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            frames.append(self.frame(self.index, block_data))
+            self.index += 1
+        if final:
+            frames.append(self.frame(self.index, b''))
+        return b''.join(frames)
+
+    def transform(self, data):
+        self.buffer += data
+        return self.blocks()
+
+    def finish(self):
+        return self.blocks(final=True)
+
+
+class Streamed(Subconstruct):
+    """Parse subcon from a stream of chunks produced lazily from the
+    underlying stream by chunks(stream, context).  Used to decrypt and
+    decompress the payload piece by piece while it is being parsed.
+
+    When building, subcon is built into the ChunkedWriter returned by
+    writer(stream, context)"""
+
+    def __init__(self, chunks, writer, subcon):
+        super().__init__(subcon)
+        self.chunks = chunks
+        self.writer = writer
+
+    def _parse(self, stream, context, path):
+        chunked = ChunkedStream(self.chunks(stream, context))
+        try:
+            obj = self.subcon._parsereport(io.BufferedReader(chunked), context, path)
+        except Exception:
+            if chunked.error is not None:
+                raise chunked.error
+            raise
+        # anything left after the subcon still has to be read and verified
+        chunked.drain()
+        return obj
+
+    def _build(self, obj, stream, context, path):
+        writer = self.writer(stream, context)
+        self.subcon._build(obj, writer, context, path)
+        writer.close()
+        return obj
+
+
+def DecompressedReparsed(subcon_out):
+    class DecompressedReparsed(Decompressed):
+        """Compressed Bytes <---> Parsed subcon result
+        Decompresses bytes piece by piece while subcon_out is parsed from
+        them, so the decompressed bytes never exist as a whole"""
+
+        def _decode(self, data, con, path):
+            chunked = ChunkedStream(decompress_chunks([data]))
+            try:
+                return subcon_out.parse_stream(io.BufferedReader(chunked), **con)
+            except Exception:
+                if chunked.error is not None:
+                    raise chunked.error
+                raise
+
+        def _encode(self, obj, con, path):
+            return super()._encode(subcon_out.build(obj, **con), con, path)
+
+    return DecompressedReparsed
+
+
 # -------------------- Cipher Enums --------------------
 
 # payload encryption method
 # https://github.com/keepassxreboot/keepassxc/blob/8324d03f0a015e62b6182843b4478226a5197090/src/format/KeePass2.cpp#L24-L26
-CipherId = Mapping(
-    GreedyBytes,
-    {'aes256': b'1\xc1\xf2\xe6\xbfqCP\xbeX\x05!j\xfcZ\xff',
-     'twofish': b'\xadh\xf2\x9fWoK\xb9\xa3j\xd4z\xf9e4l',
-     'chacha20': b'\xd6\x03\x8a+\x8boL\xb5\xa5$3\x9a1\xdb\xb5\x9a'
-     }
-)
+cipher_ids = {
+    'aes256': b'1\xc1\xf2\xe6\xbfqCP\xbeX\x05!j\xfcZ\xff',
+    'twofish': b'\xadh\xf2\x9fWoK\xb9\xa3j\xd4z\xf9e4l',
+    'chacha20': b'\xd6\x03\x8a+\x8boL\xb5\xa5$3\x9a1\xdb\xb5\x9a'
+}
+CipherId = Mapping(GreedyBytes, cipher_ids)
+
+
+def parse_cipher_id(data):
+    """Hand-written CipherId"""
+
+    return decode_mapping(cipher_ids, data)
 
 # protected entry encryption method
 # https://github.com/dlech/KeePass2.x/blob/149ab342338ffade24b44aaa1fd89f14b64fda09/KeePassLib/Cryptography/CryptoRandomStream.cs#L35
-ProtectedStreamId = Mapping(
-    Int32ul,
-    {'none': 0,
-     'arcfourvariant': 1,
-     'salsa20': 2,
-     'chacha20': 3,
-     }
-)
+protected_stream_ids = {
+    'none': 0,
+    'arcfourvariant': 1,
+    'salsa20': 2,
+    'chacha20': 3,
+}
+ProtectedStreamId = Mapping(Int32ul, protected_stream_ids)
+
+
+def parse_protected_stream_id(data):
+    """Hand-written ProtectedStreamId"""
+
+    return decode_mapping(protected_stream_ids, unpack_exact('<I', data))
@@ -1,8 +1,10 @@
 from construct import Bytes, Check, Int16ul, RawCopy, Struct, Switch, this
 
 from .kdbx3 import Body as Body3
+from .kdbx3 import CredentialCheck as CredentialCheck3
 from .kdbx3 import DynamicHeader as DynamicHeader3
 from .kdbx4 import Body as Body4
+from .kdbx4 import CredentialCheck as CredentialCheck4
 from .kdbx4 import DynamicHeader as DynamicHeader4
 
 
@@ -10,22 +12,24 @@ from .kdbx4 import DynamicHeader as DynamicHeader4
 def check_signature(ctx):
     return ctx.sig1 == b'\x03\xd9\xa2\x9a' and ctx.sig2 == b'\x67\xFB\x4B\xB5'
 
-KDBX = Struct(
-    "header" / RawCopy(
-        Struct(
-            "sig1" / Bytes(4),
-            "sig2" / Bytes(4),
-            "sig_check" / Check(check_signature),
-            "minor_version" / Int16ul,
-            "major_version" / Int16ul,
-            "dynamic_header" / Switch(
-                this.major_version,
-                {3: DynamicHeader3,
-                 4: DynamicHeader4
-                 }
-            )
+Header = RawCopy(
+    Struct(
+        "sig1" / Bytes(4),
+        "sig2" / Bytes(4),
+        "sig_check" / Check(check_signature),
+        "minor_version" / Int16ul,
+        "major_version" / Int16ul,
+        "dynamic_header" / Switch(
+            this.major_version,
+            {3: DynamicHeader3,
+             4: DynamicHeader4
+             }
         )
-    ),
+    )
+)
+
+KDBX = Struct(
+    "header" / Header,
     "body" / Switch(
         this.header.value.major_version,
         {3: Body3,
@@ -33,3 +37,14 @@ KDBX = Struct(
          }
     )
 )
+
+# header and just enough of the body to check credentials
+KDBXCredentialCheck = Struct(
+    "header" / Header,
+    "body" / Switch(
+        this.header.value.major_version,
+        {3: CredentialCheck3,
+         4: CredentialCheck4
+         }
+    )
+)
@@ -2,46 +2,69 @@
 # keepass decrypt experimentation
 
 import hashlib
+import hmac
+import struct
 
 from construct import (
     Byte,
     Bytes,
     Checksum,
     Computed,
+    Container,
     GreedyBytes,
     If,
     IfThenElse,
     Int16ul,
     Int32ul,
     Int64ul,
+    ListContainer,
     Mapping,
-    Padding,
-    Pointer,
     Prefixed,
     RepeatUntil,
     Struct,
     Switch,
-    Tell,
-    len_,
     this,
 )
 
 from .common import (
     XML,
     AES256Payload,
+    BlockWriter,
     ChaCha20Payload,
     CipherId,
+    CompressedWriter,
     CompressionFlags,
     Concatenated,
-    Decompressed,
+    CredentialsError,
+    DecompressedReparsed,
     DynamicDict,
+    EncryptedWriter,
+    FastParsed,
+    FastParseError,
+    GreedyView,
+    PayloadChecksumError,
+    PrefixedBytes,
     ProtectedStreamId,
     Reparsed,
+    Streamed,
     TwoFishPayload,
     Unprotect,
+    VerifiedBlocks,
+    XMLStream,
     aes_kdf,
+    cached_kdf,
     compute_key_composite,
     compute_master,
+    decompress_chunks,
+    new_compressobj,
+    parse_cipher_id,
+    parse_compression_flags,
+    parse_header_items,
+    parse_protected_stream_id,
+    payload_ciphers,
+    read_exact,
+    read_view,
+    unpack_exact,
 )
 
 # -------------------- Key Derivation --------------------
@@ -62,10 +85,14 @@ def compute_transformed(context):
             password=context._._.password,
             keyfile=context._._.keyfile
         )
-        transformed_key = aes_kdf(
-            context._.header.value.dynamic_header.transform_seed.data,
-            context._.header.value.dynamic_header.transform_rounds.data,
-            key_composite
+        transform_seed = context._.header.value.dynamic_header.transform_seed.data
+        transform_rounds = context._.header.value.dynamic_header.transform_rounds.data
+        transformed_key = cached_kdf(
+            context,
+            key_composite,
+            # same names as KDBX4 AES-KDF parameters
+            {'$UUID': kdf_uuids['aes'], 'S': transform_seed, 'R': transform_rounds},
+            lambda key_composite: aes_kdf(transform_seed, transform_rounds, key_composite)
         )
 
     return transformed_key
@@ -74,22 +101,22 @@ def compute_transformed(context):
 # -------------------- Dynamic Header --------------------
 
 # https://github.com/dlech/KeePass2.x/blob/dbb9d60095ef39e6abc95d708fb7d03ce5ae865e/KeePassLib/Serialization/KdbxFile.cs#L234-L246
+dynamic_header_ids = {
+    'end': 0,
+    'comment': 1,
+    'cipher_id': 2,
+    'compression_flags': 3,
+    'master_seed': 4,
+    'transform_seed': 5,
+    'transform_rounds': 6,
+    'encryption_iv': 7,
+    'protected_stream_key': 8,
+    'stream_start_bytes': 9,
+    'protected_stream_id': 10,
+}
+
 DynamicHeaderItem = Struct(
-    "id" / Mapping(
-        Byte,
-        {'end': 0,
-         'comment': 1,
-         'cipher_id': 2,
-         'compression_flags': 3,
-         'master_seed': 4,
-         'transform_seed': 5,
-         'transform_rounds': 6,
-         'encryption_iv': 7,
-         'protected_stream_key': 8,
-         'stream_start_bytes': 9,
-         'protected_stream_id': 10,
-         }
-    ),
+    "id" / Mapping(Byte, dynamic_header_ids),
     "data" / Prefixed(
         Int16ul,
         Switch(
@@ -104,16 +131,43 @@ DynamicHeaderItem = Struct(
     ),
 )
 
+# hand-written parsers of DynamicHeaderItem data
+dynamic_header_parsers = {
+    'compression_flags': parse_compression_flags,
+    'cipher_id': parse_cipher_id,
+    'transform_rounds': lambda data: unpack_exact('<Q', data),
+    'protected_stream_id': parse_protected_stream_id,
+}
+
+
+def parse_dynamic_header_items(stream, con):
+    """Hand-written DynamicHeaderItem list, see FastParsed"""
+
+    return parse_header_items(stream, '<BH', 'id', dynamic_header_ids, dynamic_header_parsers)
+
+
 DynamicHeader = DynamicDict(
     'id',
-    RepeatUntil(
-        lambda item, a, b: item.id == 'end',
-        DynamicHeaderItem
+    FastParsed(
+        parse_dynamic_header_items,
+        RepeatUntil(
+            lambda item, a, b: item.id == 'end',
+            DynamicHeaderItem
+        )
     )
 )
 
 # -------------------- Payload Verification --------------------
 
+def compute_payload_block_hash(con, index, block_data):
+    """Compute hash of each payload block.  The final empty block has an
+    all-zero hash"""
+
+    if len(block_data) == 0:
+        return b'\x00' * 32
+    return hashlib.sha256(block_data).digest()
+
+
 # encrypted payload is split into multiple data blocks with hashes
 PayloadBlock = Struct(
     "block_index" / Checksum(
@@ -121,33 +175,40 @@ PayloadBlock = Struct(
         lambda this: this._index,
         this
     ),
-    "block_hash_offset" / Tell,
-    Padding(32),
-    "block_data" / Prefixed(Int32ul, GreedyBytes),
-    # block_hash has to be at the end with a pointer because it needs to
-    # come after other fields
-    "block_hash" / Pointer(
-        this.block_hash_offset,
-        IfThenElse(
-            len_(this.block_data) == 0,
-            Checksum(
-                Bytes(32),
-                lambda _: b'\x00' * 32,
-                this
-            ),
-            Checksum(
-                Bytes(32),
-                lambda block_data: hashlib.sha256(block_data).digest(),
-                this.block_data,
-                # exception=PayloadChecksumError
-            )
-        )
-    ),
+    "block_hash" / Bytes(32),
+    "block_data" / PrefixedBytes(Int32ul),
 )
 
-PayloadBlocks = RepeatUntil(
-    lambda item, a, b: len(item.block_data) == 0,  # and item.block_hash == b'\x00' * 32,
-    PayloadBlock
+
+def parse_payload_blocks(stream, con):
+    """Hand-written PayloadBlock list, see FastParsed"""
+
+    blocks = ListContainer()
+    while True:
+        block_index, block_hash, length = struct.unpack('<I32sI', read_exact(stream, 40))
+        if block_index != len(blocks):
+            # let construct report the ChecksumError
+            raise FastParseError("Unexpected block index {}".format(block_index))
+        block_data = read_view(stream, length)
+        if len(block_data) != length:
+            raise FastParseError("Unexpected end of data")
+        blocks.append(
+            Container(block_index=block_index, block_hash=block_hash, block_data=block_data)
+        )
+        if length == 0:
+            return blocks
+
+
+PayloadBlocks = VerifiedBlocks(
+    FastParsed(
+        parse_payload_blocks,
+        RepeatUntil(
+            lambda item, a, b: len(item.block_data) == 0,
+            PayloadBlock
+        )
+    ),
+    'block_hash',
+    compute_payload_block_hash
 )
 
 
@@ -167,31 +228,157 @@ UnpackedPayload = Reparsed(
         "xml" / Unprotect(
             this._._.header.value.dynamic_header.protected_stream_id.data,
             this._._.header.value.dynamic_header.protected_stream_key.data,
-            XML(
-                IfThenElse(
-                    this._._.header.value.dynamic_header.compression_flags.data.compression,
-                    Decompressed(Concatenated(PayloadBlocks)),
-                    Concatenated(PayloadBlocks)
-                )
+            IfThenElse(
+                this._._.header.value.dynamic_header.compression_flags.data.compression,
+                # XML is parsed while it is decompressed
+                DecompressedReparsed(XMLStream())(Concatenated(PayloadBlocks)),
+                XML(Concatenated(PayloadBlocks))
             )
         )
     )
 )
 
 
+# -------------------- Streamed Payload --------------------
+
+def check_stream_start(chunks, stream_start_bytes):
+    """Verify the decrypted payload starts with stream_start_bytes and
+    strip them"""
+
+    start = b''
+    chunks = iter(chunks)
+    for chunk in chunks:
+        start += chunk
+        if len(start) >= 32:
+            break
+    if start[:32] != stream_start_bytes:
+        raise CredentialsError("Invalid credentials")
+    yield start[32:]
+    yield from chunks
+
+
+def read_payload_blocks(chunks):
+    """Split decrypted payload into blocks and verify them one at a time"""
+
+    chunks = iter(chunks)
+    buffer = bytearray()
+    index = 0
+
+    def fill(length):
+        while len(buffer) < length:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise PayloadChecksumError("Payload is truncated at block {}".format(index))
+            buffer.extend(chunk)
+
+    while True:
+        fill(40)
+        block_index, block_hash, block_length = struct.unpack('<I32sI', buffer[:40])
+        fill(40 + block_length)
+        block_data = bytes(buffer[40:40 + block_length])
+        del buffer[:40 + block_length]
+        if block_index != index or not hmac.compare_digest(
+                block_hash, compute_payload_block_hash(None, index, block_data)):
+            raise PayloadChecksumError("Error reading database contents at block {}".format(index))
+        if len(block_data) == 0:
+            return
+        yield block_data
+        index += 1
+
+
+def decrypted_payload_chunks(stream, con):
+    """Decrypted and decompressed payload, produced piece by piece"""
+
+    dynamic_header = con._.header.value.dynamic_header
+    chunks = payload_ciphers[dynamic_header.cipher_id.data].decrypt_chunks(
+        iter(lambda: read_view(stream, 2**20), b''),
+        con.master_key,
+        dynamic_header.encryption_iv.data
+    )
+    chunks = read_payload_blocks(
+        check_stream_start(chunks, dynamic_header.stream_start_bytes.data)
+    )
+    if dynamic_header.compression_flags.data.compression:
+        chunks = decompress_chunks(chunks)
+    return chunks
+
+
+def payload_block_writer(stream, con):
+    """Compress, write in hashed blocks and encrypt payload as it is built"""
+
+    def frame(index, block_data):
+        return (
+            struct.pack('<I', index) +
+            compute_payload_block_hash(con, index, block_data) +
+            struct.pack('<I', len(block_data)) +
+            block_data
+        )
+
+    dynamic_header = con._.header.value.dynamic_header
+    encrypted = EncryptedWriter(
+        stream,
+        payload_ciphers[dynamic_header.cipher_id.data],
+        con.master_key,
+        dynamic_header.encryption_iv.data
+    )
+    encrypted.write(dynamic_header.stream_start_bytes.data)
+    writer = BlockWriter(encrypted, frame)
+    if dynamic_header.compression_flags.data.compression:
+        writer = CompressedWriter(writer, new_compressobj(con))
+    return writer
+
+
+StreamedPayload = Streamed(
+    decrypted_payload_chunks,
+    payload_block_writer,
+    Struct(
+        "xml" / Unprotect(
+            this._._.header.value.dynamic_header.protected_stream_id.data,
+            this._._.header.value.dynamic_header.protected_stream_key.data,
+            XMLStream()
+        )
+    )
+)
+
+
+# -------------------- Credential Verification --------------------
+
+# only the first cipher blocks of the payload are decrypted and compared
+# against stream_start_bytes
+CredentialCheck = Struct(
+    "transformed_key" / Computed(compute_transformed),
+    "master_key" / Computed(compute_master),
+    "cred_check" / Checksum(
+        Switch(
+            this._.header.value.dynamic_header.cipher_id.data,
+            {'aes256': AES256Payload(Bytes(32), padded=False),
+             'chacha20': ChaCha20Payload(Bytes(32), padded=False),
+             'twofish': TwoFishPayload(Bytes(32), padded=False),
+             }
+        ),
+        lambda stream_start_bytes: stream_start_bytes,
+        this._.header.value.dynamic_header.stream_start_bytes.data,
+    )
+)
+
+
 # -------------------- Main KDBX Structure --------------------
 
 Body = Struct(
     "transformed_key" / Computed(compute_transformed),
     "master_key" / Computed(compute_master),
     "payload" / If(this._._.decrypt,
-        UnpackedPayload(
-            Switch(
-                this._.header.value.dynamic_header.cipher_id.data,
-                {'aes256': AES256Payload(GreedyBytes),
-                 'chacha20': ChaCha20Payload(GreedyBytes),
-                 'twofish': TwoFishPayload(GreedyBytes),
-                 }
+        IfThenElse(
+            lambda this: this._._.get('streaming', False),
+            StreamedPayload,
+            UnpackedPayload(
+                Switch(
+                    this._.header.value.dynamic_header.cipher_id.data,
+                    {'aes256': AES256Payload(GreedyView()),
+                     'chacha20': ChaCha20Payload(GreedyView()),
+                     'twofish': TwoFishPayload(GreedyView()),
+                     }
+                )
             )
         )
     ),
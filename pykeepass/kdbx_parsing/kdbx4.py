@@ -5,12 +5,12 @@ import hashlib
 import hmac
 import struct
 
-import argon2
 from construct import (
     Byte,
     Bytes,
     Checksum,
     Computed,
+    Container,
     Flag,
     GreedyBytes,
     GreedyString,
@@ -20,34 +20,54 @@ from construct import (
     Int32ul,
     Int64sl,
     Int64ul,
+    ListContainer,
     Mapping,
     Padding,
     Peek,
-    Pointer,
     Prefixed,
     RepeatUntil,
     Struct,
     Switch,
-    Tell,
     this,
 )
 
 from .common import (
     XML,
     AES256Payload,
+    BlockWriter,
     ChaCha20Payload,
     CipherId,
+    CompressedWriter,
     CompressionFlags,
     Concatenated,
-    Decompressed,
+    DecompressedReparsed,
     DynamicDict,
+    EncryptedWriter,
+    FastParsed,
+    FastParseError,
+    PayloadChecksumError,
+    PrefixedBytes,
     ProtectedStreamId,
     Reparsed,
+    Streamed,
     TwoFishPayload,
     Unprotect,
+    VerifiedBlocks,
+    XMLStream,
     aes_kdf,
+    cached_kdf,
     compute_key_composite,
     compute_master,
+    decompress_chunks,
+    new_compressobj,
+    parse_cipher_id,
+    parse_compression_flags,
+    parse_header_items,
+    parse_protected_stream_id,
+    payload_ciphers,
+    read_exact,
+    read_view,
+    unpack_exact,
 )
 
 # -------------------- Key Derivation --------------------
@@ -68,29 +88,38 @@ def compute_transformed(context):
         keyfile=context._._.keyfile
     )
     kdf_parameters = context._.header.value.dynamic_header.kdf_parameters.data.dict
+    kdf_cache_parameters = {k: v.value for k, v in kdf_parameters.items()}
 
     if context._._.transformed_key is not None:
         transformed_key = context._._.transformed_key
     elif kdf_parameters['$UUID'].value in (kdf_uuids['argon2'], kdf_uuids['argon2id']):
-        transformed_key = argon2.low_level.hash_secret_raw(
-            secret=key_composite,
-            salt=kdf_parameters['S'].value,
-            hash_len=32,
-            type=(argon2.low_level.Type.ID if kdf_parameters['$UUID'].value == kdf_uuids['argon2id'] else argon2.low_level.Type.D),
-            time_cost=kdf_parameters['I'].value,
-            memory_cost=kdf_parameters['M'].value // 1024,
-            parallelism=kdf_parameters['P'].value,
-            version=kdf_parameters['V'].value
+        # imported only when opening Argon2 databases
+        import argon2
+        transformed_key = cached_kdf(
+            context,
+            key_composite,
+            kdf_cache_parameters,
+            lambda key_composite: argon2.low_level.hash_secret_raw(
+                secret=key_composite,
+                salt=kdf_parameters['S'].value,
+                hash_len=32,
+                type=(argon2.low_level.Type.ID if kdf_parameters['$UUID'].value == kdf_uuids['argon2id'] else argon2.low_level.Type.D),
+                time_cost=kdf_parameters['I'].value,
+                memory_cost=kdf_parameters['M'].value // 1024,
+                parallelism=kdf_parameters['P'].value,
+                version=kdf_parameters['V'].value
+            )
         )
     elif kdf_parameters['$UUID'].value == kdf_uuids['aeskdf']:
-        key_composite = compute_key_composite(
-            password=context._._.password,
-            keyfile=context._._.keyfile
-        )
-        transformed_key = aes_kdf(
-            kdf_parameters['S'].value,
-            kdf_parameters['R'].value,
-            key_composite
+        transformed_key = cached_kdf(
+            context,
+            key_composite,
+            kdf_cache_parameters,
+            lambda key_composite: aes_kdf(
+                kdf_parameters['S'].value,
+                kdf_parameters['R'].value,
+                key_composite
+            )
         )
     else:
         raise Exception('Unsupported key derivation method')
@@ -137,6 +166,52 @@ VariantDictionaryItem = Struct(
     "next_byte" / Peek(Byte)
 )
 
+# struct formats of VariantDictionaryItem numeric values
+variant_formats = {
+    0x04: '<I',
+    0x05: '<Q',
+    0x08: '<?',
+    0x0C: '<i',
+    0x0D: '<q',
+}
+
+
+def parse_variant_dictionary(data):
+    """Hand-written VariantDictionary"""
+
+    items = Container()
+    offset = 2
+    while True:
+        if len(data) < offset + 5:
+            raise FastParseError("Unexpected end of data")
+        item_type, key_length = struct.unpack_from('<BI', data, offset)
+        offset += 5
+        key = data[offset:offset + key_length]
+        offset += key_length
+        if len(data) < offset + 4 or len(key) != key_length:
+            raise FastParseError("Unexpected end of data")
+        value_length, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        value = data[offset:offset + value_length]
+        offset += value_length
+        # next_byte is peeked, so a following byte must exist
+        if len(data) <= offset or len(value) != value_length:
+            raise FastParseError("Unexpected end of data")
+        try:
+            key = key.decode('utf-8')
+            if item_type in variant_formats:
+                value = unpack_exact(variant_formats[item_type], value)
+            elif item_type == 0x18:
+                value = value.decode('utf-8')
+            elif item_type != 0x42:
+                raise FastParseError("Unknown value type {}".format(item_type))
+        except UnicodeDecodeError as e:
+            raise FastParseError(e)
+        items[key] = Container(type=item_type, key=key, value=value, next_byte=data[offset])
+        if data[offset] == 0x00:
+            return Container(version=data[:2], dict=items)
+
+
 # new dynamic dictionary structure added in KDBX4
 VariantDictionary = Struct(
     "version" / Bytes(2),
@@ -154,19 +229,19 @@ VariantDictionary = Struct(
 
 # https://github.com/dlech/KeePass2.x/blob/dbb9d60095ef39e6abc95d708fb7d03ce5ae865e/KeePassLib/Serialization/KdbxFile.cs#L234-L246
 
+dynamic_header_ids = {
+    'end': 0,
+    'comment': 1,
+    'cipher_id': 2,
+    'compression_flags': 3,
+    'master_seed': 4,
+    'encryption_iv': 7,
+    'kdf_parameters': 11,
+    'public_custom_data': 12
+}
+
 DynamicHeaderItem = Struct(
-    "id" / Mapping(
-        Byte,
-        {'end': 0,
-         'comment': 1,
-         'cipher_id': 2,
-         'compression_flags': 3,
-         'master_seed': 4,
-         'encryption_iv': 7,
-         'kdf_parameters': 11,
-         'public_custom_data': 12
-         }
-    ),
+    "id" / Mapping(Byte, dynamic_header_ids),
     "data" / Prefixed(
         Int32ul,
         Switch(
@@ -180,56 +255,95 @@ DynamicHeaderItem = Struct(
     )
 )
 
+# hand-written parsers of DynamicHeaderItem data
+dynamic_header_parsers = {
+    'compression_flags': parse_compression_flags,
+    'kdf_parameters': parse_variant_dictionary,
+    'cipher_id': parse_cipher_id,
+}
+
+
+def parse_dynamic_header_items(stream, con):
+    """Hand-written DynamicHeaderItem list, see FastParsed"""
+
+    return parse_header_items(stream, '<BI', 'id', dynamic_header_ids, dynamic_header_parsers)
+
+
 DynamicHeader = DynamicDict(
     'id',
-    RepeatUntil(
-        lambda item, a, b: item.id == 'end',
-        DynamicHeaderItem
+    FastParsed(
+        parse_dynamic_header_items,
+        RepeatUntil(
+            lambda item, a, b: item.id == 'end',
+            DynamicHeaderItem
+        )
     )
 )
 
 
 # -------------------- Payload Verification --------------------
-def compute_payload_block_hash(this):
+def compute_block_hmac(hmac_key, index, block_data):
+    """Compute HMAC of a single payload block.  hmac_key is derived from
+    master seed and transformed key and is the same for every block"""
+
+    h = hmac.new(
+        hashlib.sha512(struct.pack('<Q', index) + hmac_key).digest(),
+        struct.pack('<Q', index) + struct.pack('<I', len(block_data)),
+        hashlib.sha256
+    )
+    h.update(block_data)
+    return h.digest()
+
+
+def compute_hmac_key(context):
+    """Compute base key of the payload block HMACs.  The same for every
+    block, so only derived once per open"""
+
+    return hashlib.sha512(
+        context._.header.value.dynamic_header.master_seed.data +
+        context.transformed_key + b'\x01'
+    ).digest()
+
+
+def compute_payload_block_hash(con, index, block_data):
     """Compute hash of each payload block.
     Used to prevent payload corruption and tampering."""
 
-    return hmac.new(
-        hashlib.sha512(
-            struct.pack('<Q', this._index) +
-            hashlib.sha512(
-                this._._.header.value.dynamic_header.master_seed.data +
-                this._.transformed_key + b'\x01'
-            ).digest()
-        ).digest(),
-        struct.pack('<Q', this._index) +
-        struct.pack('<I', len(this.block_data)) +
-        this.block_data, hashlib.sha256
-    ).digest()
+    return compute_block_hmac(con.hmac_key, index, block_data)
 
 
 # -------------------- Payload Decryption/Decompression --------------------
 # encrypted payload is split into multiple data blocks with hashes
 EncryptedPayloadBlock = Struct(
-    "hmac_hash_offset" / Tell,
-    Padding(32),
-    "block_data" / Prefixed(Int32ul, GreedyBytes),
-    # hmac_hash has to be at the end with a pointer because it needs to
-    # come after other fields
-    "hmac_hash" / Pointer(
-        this.hmac_hash_offset,
-        Checksum(
-            Bytes(32),
-            compute_payload_block_hash,
-            this,
-            # exception=PayloadChecksumError
-        )
-    )
+    "hmac_hash" / Bytes(32),
+    "block_data" / PrefixedBytes(Int32ul),
 )
 
-EncryptedPayload = Concatenated(RepeatUntil(
-    lambda item, a, b: len(item.block_data) == 0,
-    EncryptedPayloadBlock
+
+def parse_encrypted_payload_blocks(stream, con):
+    """Hand-written EncryptedPayloadBlock list, see FastParsed"""
+
+    blocks = ListContainer()
+    while True:
+        hmac_hash, length = struct.unpack('<32sI', read_exact(stream, 36))
+        block_data = read_view(stream, length)
+        if len(block_data) != length:
+            raise FastParseError("Unexpected end of data")
+        blocks.append(Container(hmac_hash=hmac_hash, block_data=block_data))
+        if length == 0:
+            return blocks
+
+
+EncryptedPayload = Concatenated(VerifiedBlocks(
+    FastParsed(
+        parse_encrypted_payload_blocks,
+        RepeatUntil(
+            lambda item, a, b: len(item.block_data) == 0,
+            EncryptedPayloadBlock
+        )
+    ),
+    'hmac_hash',
+    compute_payload_block_hash
 ))
 
 DecryptedPayload = Switch(
@@ -241,15 +355,15 @@ DecryptedPayload = Switch(
 )
 
 
+inner_header_types = {
+    'end': 0x00,
+    'protected_stream_id': 0x01,
+    'protected_stream_key': 0x02,
+    'binary': 0x03
+}
+
 InnerHeaderItem = Struct(
-    "type" / Mapping(
-        Byte,
-        {'end': 0x00,
-         'protected_stream_id': 0x01,
-         'protected_stream_key': 0x02,
-         'binary': 0x03
-         }
-    ),
+    "type" / Mapping(Byte, inner_header_types),
     "data" / Prefixed(
         Int32ul,
         Switch(
@@ -261,9 +375,21 @@ InnerHeaderItem = Struct(
 )
 
 # another binary header inside decrypted and decompressed Payload
+def parse_inner_header_items(stream, con):
+    """Hand-written InnerHeaderItem list, see FastParsed"""
+
+    return parse_header_items(
+        stream, '<BI', 'type', inner_header_types,
+        {'protected_stream_id': parse_protected_stream_id}
+    )
+
+
 InnerHeader = DynamicDict(
     'type',
-    RepeatUntil(lambda item, a, b: item.type == 'end', InnerHeaderItem),
+    FastParsed(
+        parse_inner_header_items,
+        RepeatUntil(lambda item, a, b: item.type == 'end', InnerHeaderItem)
+    ),
     # FIXME - this is a hack because inner header is not truly a dict,
     #  it has multiple binary elements.
     lump=['binary']
@@ -280,12 +406,117 @@ UnpackedPayload = Reparsed(
     )
 )
 
+# inner header and XML are parsed while the payload is decompressed
+DecompressedPayload = DecompressedReparsed(
+    Struct(
+        "inner_header" / InnerHeader,
+        "xml" / Unprotect(
+            this.inner_header.protected_stream_id.data,
+            this.inner_header.protected_stream_key.data,
+            XMLStream()
+        )
+    )
+)
+
+
+# -------------------- Streamed Payload --------------------
+
+def read_payload_blocks(stream, con):
+    """Read and verify encrypted payload blocks one at a time"""
+
+    index = 0
+    while True:
+        hmac_hash = stream.read(32)
+        block_length = stream.read(4)
+        if len(block_length) < 4:
+            raise PayloadChecksumError("Payload is truncated at block {}".format(index))
+        block_data = read_view(stream, struct.unpack('<I', block_length)[0])
+        if not hmac.compare_digest(hmac_hash, compute_payload_block_hash(con, index, block_data)):
+            raise PayloadChecksumError("Error reading database contents at block {}".format(index))
+        if len(block_data) == 0:
+            return
+        yield block_data
+        index += 1
+
+
+def decrypted_payload_chunks(stream, con):
+    """Decrypted and decompressed payload, produced block by block"""
+
+    dynamic_header = con._.header.value.dynamic_header
+    payload = payload_ciphers[dynamic_header.cipher_id.data]
+    chunks = payload.decrypt_chunks(
+        read_payload_blocks(stream, con),
+        con.master_key,
+        dynamic_header.encryption_iv.data
+    )
+    if dynamic_header.compression_flags.data.compression:
+        chunks = decompress_chunks(chunks)
+    return chunks
+
+
+def payload_block_writer(stream, con):
+    """Compress, encrypt and write payload in HMAC blocks as it is built"""
+
+    def frame(index, block_data):
+        return (
+            compute_payload_block_hash(con, index, block_data) +
+            struct.pack('<I', len(block_data)) +
+            block_data
+        )
+
+    dynamic_header = con._.header.value.dynamic_header
+    writer = EncryptedWriter(
+        BlockWriter(stream, frame),
+        payload_ciphers[dynamic_header.cipher_id.data],
+        con.master_key,
+        dynamic_header.encryption_iv.data
+    )
+    if dynamic_header.compression_flags.data.compression:
+        writer = CompressedWriter(writer, new_compressobj(con))
+    return writer
+
+
+# inner header and XML are parsed while blocks are read (and built while
+# blocks are written), so that only about one block of the payload is held
+# in memory at a time
+StreamedPayload = Streamed(
+    decrypted_payload_chunks,
+    payload_block_writer,
+    Struct(
+        "inner_header" / InnerHeader,
+        "xml" / Unprotect(
+            this.inner_header.protected_stream_id.data,
+            this.inner_header.protected_stream_key.data,
+            XMLStream()
+        )
+    )
+)
+
+
+# -------------------- Credential Verification --------------------
+
+# header checksum and HMAC only, payload is not read
+CredentialCheck = Struct(
+    "transformed_key" / Computed(compute_transformed),
+    "sha256" / Checksum(
+        Bytes(32),
+        lambda data: hashlib.sha256(data).digest(),
+        this._.header.data,
+    ),
+    "cred_check" / Checksum(
+        Bytes(32),
+        compute_header_hmac_hash,
+        this,
+    ),
+)
+
 
 # -------------------- Main KDBX Structure --------------------
 
 Body = Struct(
     "transformed_key" / Computed(compute_transformed),
     "master_key" / Computed(compute_master),
+    "hmac_key" / Computed(compute_hmac_key),
     "sha256" / Checksum(
         Bytes(32),
         lambda data: hashlib.sha256(data).digest(),
@@ -301,11 +532,13 @@ Body = Struct(
         )
     ),
     "payload" / If(this._._.decrypt,
-        UnpackedPayload(
+        IfThenElse(
+            lambda this: this._._.get('streaming', False),
+            StreamedPayload,
             IfThenElse(
                 this._.header.value.dynamic_header.compression_flags.data.compression,
-                Decompressed(DecryptedPayload),
-                DecryptedPayload
+                DecompressedPayload(DecryptedPayload),
+                UnpackedPayload(DecryptedPayload)
             )
         )
     )
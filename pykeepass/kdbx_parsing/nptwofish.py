@@ -0,0 +1,103 @@
+# Twofish-CBC decryption vectorized with NumPy.
+#
+# CBC decryption has no dependency between blocks, so every block of the
+# payload is pushed through the Twofish rounds at once as arrays of 32-bit
+# words.  Key-dependent tables come from the pytwofish key schedule.
+# NumPy is an optional dependency, see twofish.py for the fallback.
+
+import numpy as np
+
+block_size = 16
+
+# number of blocks decrypted per pass, bounds the size of temporary arrays
+batch_blocks = 2**16
+
+
+def rotl32(x, n):
+    return (x << np.uint32(n)) | (x >> np.uint32(32 - n))
+
+
+def rotr32(x, n):
+    return (x >> np.uint32(n)) | (x << np.uint32(32 - n))
+
+
+class TwofishCBCDecrypter:
+    """Twofish in CBC mode, decryption only
+
+    Args:
+        cipher (`pytwofish.Twofish`): keyed cipher whose key schedule is used
+        IV (`bytes`): 16 byte initialization vector
+    """
+
+    def __init__(self, cipher, IV):
+        if len(IV) != block_size:
+            raise ValueError("the IV length should be {} bytes".format(block_size))
+
+        context = cipher.context
+        self.l_key = [np.uint32(k) for k in context.l_key]
+        self.mk_tab = [np.array(t, dtype=np.uint32) for t in context.mk_tab]
+        self.IV = np.frombuffer(IV, dtype='<u4').astype(np.uint32)
+        self.cache = b''
+
+    def g0(self, x):
+        mk0, mk1, mk2, mk3 = self.mk_tab
+        return (
+            mk0[x & 0xff] ^ mk1[(x >> 8) & 0xff] ^
+            mk2[(x >> 16) & 0xff] ^ mk3[x >> 24]
+        )
+
+    def g1(self, x):
+        mk0, mk1, mk2, mk3 = self.mk_tab
+        return (
+            mk0[x >> 24] ^ mk1[x & 0xff] ^
+            mk2[(x >> 8) & 0xff] ^ mk3[(x >> 16) & 0xff]
+        )
+
+    def decrypt_blocks(self, words):
+        """Twofish decrypt an (n, 4) array of little endian words"""
+
+        l_key = self.l_key
+        b0 = words[:, 0] ^ l_key[4]
+        b1 = words[:, 1] ^ l_key[5]
+        b2 = words[:, 2] ^ l_key[6]
+        b3 = words[:, 3] ^ l_key[7]
+
+        for i in range(7, -1, -1):
+            t1 = self.g1(b1)
+            t0 = self.g0(b0)
+            b2 = rotl32(b2, 1) ^ (t0 + t1 + l_key[4 * i + 10])
+            b3 = rotr32(b3 ^ (t0 + t1 + t1 + l_key[4 * i + 11]), 1)
+
+            t1 = self.g1(b3)
+            t0 = self.g0(b2)
+            b0 = rotl32(b0, 1) ^ (t0 + t1 + l_key[4 * i + 8])
+            b1 = rotr32(b1 ^ (t0 + t1 + t1 + l_key[4 * i + 9]), 1)
+
+        return np.stack((
+            b2 ^ l_key[0],
+            b3 ^ l_key[1],
+            b0 ^ l_key[2],
+            b1 ^ l_key[3],
+        ), axis=1)
+
+    def decrypt(self, data):
+        """Decrypt ciphertext.  Bytes which do not fill a block are cached
+        and decrypted with the next call"""
+
+        data = self.cache + bytes(data)
+        length = len(data) - len(data) % block_size
+        self.cache = data[length:]
+
+        plaintext = []
+        for start in range(0, length, batch_blocks * block_size):
+            end = min(start + batch_blocks * block_size, length)
+            words = np.frombuffer(data, dtype='<u4', count=(end - start) // 4, offset=start)
+            words = words.astype(np.uint32).reshape(-1, 4)
+            # each plaintext block is XORed with the previous ciphertext block
+            previous = np.vstack((self.IV, words[:-1]))
+            plaintext.append(
+                (self.decrypt_blocks(words) ^ previous).astype('<u4').tobytes()
+            )
+            self.IV = words[-1]
+
+        return b''.join(plaintext)
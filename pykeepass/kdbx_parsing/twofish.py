@@ -29,6 +29,12 @@ from Cryptodome.Util.strxor import strxor
 
 from . import pytwofish
 
+try:
+    from . import nptwofish
+except ImportError:
+    # NumPy is optional, CBC decryption falls back to pytwofish
+    nptwofish = None
+
 MODE_ECB = 1
 MODE_CBC = 2
 MODE_CFB = 3
@@ -285,14 +291,84 @@ class CBC:
             return decrypted_blocks
 
 
+class TwofishCBC(CBC):
+    """CBC chaining mode with table driven Twofish encryption
+
+    CBC encryption is sequential, so the cost per block is what matters.
+    Blocks are handled as integers with the key dependent g function
+    tables of the pytwofish key schedule (full keying), without creating
+    any objects per block.  Decryption is left to CBC.
+    """
+    def __init__(self, codebook, blocksize, IV):
+        CBC.__init__(self, codebook, blocksize, IV)
+        context = codebook.context
+        self.mk_tab = context.mk_tab
+        self.in_key = context.l_key[:4]
+        self.out_key = context.l_key[4:8]
+        self.round_keys = [tuple(context.l_key[i:i + 4]) for i in range(8, 40, 4)]
+
+    def update(self, data, ed):
+        if ed != 'e':
+            return CBC.update(self, data, ed)
+
+        data = self.cache + bytes(data)
+        length = len(data) - len(data) % 16
+        self.cache = data[length:]
+
+        M = 0xffffffff
+        mk0, mk1, mk2, mk3 = self.mk_tab
+        k0, k1, k2, k3 = self.in_key
+        k4, k5, k6, k7 = self.out_key
+        round_keys = self.round_keys
+        from_bytes = int.from_bytes
+        previous = from_bytes(self.IV, 'little')
+        blocks = []
+        for i in range(0, length, 16):
+            x = from_bytes(data[i:i + 16], 'little') ^ previous
+            b0 = (x & M) ^ k0
+            b1 = ((x >> 32) & M) ^ k1
+            b2 = ((x >> 64) & M) ^ k2
+            b3 = (x >> 96) ^ k3
+            for r0, r1, r2, r3 in round_keys:
+                t1 = mk0[b1 >> 24] ^ mk1[b1 & 0xff] ^ mk2[(b1 >> 8) & 0xff] ^ mk3[(b1 >> 16) & 0xff]
+                t0 = mk0[b0 & 0xff] ^ mk1[(b0 >> 8) & 0xff] ^ mk2[(b0 >> 16) & 0xff] ^ mk3[b0 >> 24]
+                x = b2 ^ ((t0 + t1 + r0) & M)
+                b2 = (x >> 1) | ((x << 31) & M)
+                b3 = (((b3 << 1) & M) | (b3 >> 31)) ^ ((t0 + 2 * t1 + r1) & M)
+
+                t1 = mk0[b3 >> 24] ^ mk1[b3 & 0xff] ^ mk2[(b3 >> 8) & 0xff] ^ mk3[(b3 >> 16) & 0xff]
+                t0 = mk0[b2 & 0xff] ^ mk1[(b2 >> 8) & 0xff] ^ mk2[(b2 >> 16) & 0xff] ^ mk3[b2 >> 24]
+                x = b0 ^ ((t0 + t1 + r2) & M)
+                b0 = (x >> 1) | ((x << 31) & M)
+                b1 = (((b1 << 1) & M) | (b1 >> 31)) ^ ((t0 + 2 * t1 + r3) & M)
+            previous = (b2 ^ k4) | ((b3 ^ k5) << 32) | ((b0 ^ k6) << 64) | ((b1 ^ k7) << 96)
+            blocks.append(previous.to_bytes(16, 'little'))
+
+        if blocks:
+            self.IV = blocks[-1]
+        return b''.join(blocks)
+
+
 class python_Twofish(BlockCipher):
     def __init__(self,key,mode,IV,counter,segment_size):
         if len(key) not in (16,24,32) and type(key) is not tuple:
                 raise ValueError("Key should be 128, 192 or 256 bits")
         cipher_module = pytwofish.Twofish
         self.blocksize = 16
+        self.decrypter = None
         BlockCipher.__init__(self,key,mode,IV,counter,cipher_module,segment_size)
-    
+        if mode == MODE_CBC:
+            self.chain = TwofishCBC(self.cipher, self.blocksize, self.IV)
+
+    def decrypt(self,ciphertext,n=''):
+        # CBC decryption is vectorized across blocks when NumPy is available
+        if self.mode == MODE_CBC and nptwofish is not None:
+            if self.decrypter is None:
+                self.decrypter = nptwofish.TwofishCBCDecrypter(self.cipher, self.chain.IV)
+            self.ed = 'd'
+            return self.decrypter.decrypt(ciphertext)
+        return BlockCipher.decrypt(self,ciphertext,n)
+
     @classmethod
     def new(cls, key,mode=MODE_ECB,IV=None,counter=None,segment_size=None):
         return cls(key,mode,IV,counter,segment_size)
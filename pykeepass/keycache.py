@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class TransformedKeyCache:
+    """Cache of transformed keys so that repeated opens of the same database
+    skip the key derivation function
+
+    Entries are keyed by a hash of the composite key (password and keyfile)
+    together with the KDF parameters from the database header, so a cached
+    key is only used when credentials, KDF, salt and KDF parameters all match.
+
+    Args:
+        maxsize (`int`, optional): maximum number of keys to keep.  Least
+            recently used keys are evicted first.  (default 128)
+        ttl (`float`, optional): seconds a key stays valid after it was
+            derived.  If None, keys never expire
+        filename (`str`, optional): path of an encrypted file used to persist
+            the cache between processes.  Requires `secret`
+        secret (`bytes` or `str`, optional): secret used to encrypt the cache
+            file.  This should not be the database password
+
+    Examples:
+    ``` python
+    >>> cache = TransformedKeyCache(ttl=3600)
+    >>> kp = PyKeePass('db.kdbx', password='somePassw0rd', key_cache=cache)
+    >>> kp.reload() # no key derivation
+    ```
+    """
+
+    def __init__(self, maxsize=128, ttl=None, filename=None, secret=None):
+        if filename is not None and not secret:
+            raise ValueError("A secret is required to persist the key cache")
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.filename = filename
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self._file_key = hashlib.sha256(secret).digest() if secret else None
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.filename is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _digest(key_composite, kdf_parameters):
+        """Hash composite key and KDF parameters into a cache key"""
+
+        h = hashlib.sha256(key_composite)
+        for name in sorted(kdf_parameters):
+            h.update(repr((name, kdf_parameters[name])).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key_composite, kdf_parameters):
+        """Look up a transformed key
+
+        Args:
+            key_composite (`bytes`): composite key of password and keyfile
+            kdf_parameters (`dict`): KDF UUID, salt and parameters
+
+        Returns:
+            `bytes` or `None`: cached transformed key
+        """
+        digest = self._digest(key_composite, kdf_parameters)
+        with self._lock:
+            item = self._keys.get(digest)
+            if item is None:
+                return None
+            transformed_key, created = item
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._keys[digest]
+                return None
+            self._keys.move_to_end(digest)
+            return transformed_key
+
+    def set(self, key_composite, kdf_parameters, transformed_key):
+        """Store a transformed key
+
+        Args:
+            key_composite (`bytes`): composite key of password and keyfile
+            kdf_parameters (`dict`): KDF UUID, salt and parameters
+            transformed_key (`bytes`): result of the KDF
+        """
+        digest = self._digest(key_composite, kdf_parameters)
+        with self._lock:
+            self._keys[digest] = (transformed_key, time.time())
+            self._keys.move_to_end(digest)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            if self.filename is not None:
+                self._dump()
+
+    def clear(self):
+        """Remove all keys from the cache (and cache file)"""
+        with self._lock:
+            self._keys.clear()
+            if self.filename is not None:
+                self._dump()
+
+    # ---------- Cache File ----------
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        nonce, tag, ciphertext = data[:16], data[16:32], data[32:]
+        cipher = AES.new(self._file_key, AES.MODE_GCM, nonce=nonce)
+        try:
+            keys = json.loads(cipher.decrypt_and_verify(ciphertext, tag))
+        except ValueError:
+            logger.warning("Could not decrypt key cache file {}".format(self.filename))
+            return
+
+        for digest, (transformed_key, created) in keys.items():
+            self._keys[digest] = (bytes.fromhex(transformed_key), created)
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def _dump(self):
+        keys = {
+            digest: (transformed_key.hex(), created)
+            for digest, (transformed_key, created) in self._keys.items()
+        }
+        nonce = get_random_bytes(16)
+        cipher = AES.new(self._file_key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(keys).encode('utf-8'))
+
+        # write to temporary file to prevent cache clobbering
+        filename_tmp = '{}.tmp'.format(self.filename)
+        fd = os.open(filename_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(nonce + tag + ciphertext)
+        os.replace(filename_tmp, self.filename)
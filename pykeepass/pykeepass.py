@@ -7,6 +7,8 @@ import struct
 import uuid
 import zlib
 from binascii import Error as BinasciiError
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -25,8 +27,27 @@ from .exceptions import (
     UnableToSendToRecycleBin,
 )
 from .group import Group
-from .kdbx_parsing import KDBX, kdf_uuids
-from .xpath import attachment_xp, entry_xp, group_xp, path_xp
+from .index import (
+    FieldIndex,
+    TrigramIndex,
+    UUIDIndex,
+    document_order,
+    regex_literal,
+    regex_substrings,
+)
+from .kdbx_parsing import (
+    KDBX,
+    Header,
+    KDBXCredentialCheck,
+    MappedFile,
+    compression_profiles,
+    compression_settings,
+    kdf_uuids,
+    lazy_offset,
+    protected_streams,
+)
+from .keycache import TransformedKeyCache
+from .xpath import attachment_xp, compile_xpath, entry_xp, group_xp, path_xp
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +55,16 @@ BLANK_DATABASE_FILENAME = "blank_database.kdbx"
 BLANK_DATABASE_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), BLANK_DATABASE_FILENAME)
 BLANK_DATABASE_PASSWORD = "password"
 
+# string fields searched by `find_entries` keywords
+string_field_keys = {
+    'title': 'Title',
+    'username': 'UserName',
+    'password': 'Password',
+    'url': 'URL',
+    'notes': 'Notes',
+    'otp': 'otp'
+}
+
 class PyKeePass:
     """Open a KeePass database
 
@@ -49,6 +80,21 @@ class PyKeePass:
         decrypt (`bool`, optional): whether to decrypt XML payload.
             Set `False` to access outer header information without decrypting
             database.
+        key_cache (`TransformedKeyCache`, optional): cache consulted before
+            running the key derivation function.  Also used by `reload` and
+            `save`.  If None, only the most recently derived key is kept so
+            that saving with unchanged credentials skips the KDF.
+        streaming (`bool`, optional): read, verify, decrypt and parse the
+            payload block by block so memory use stays close to the size of
+            the parsed XML tree.  (default `False`)
+        lazy_unprotect (`bool`, optional): keep protected values (e.g.
+            passwords) encrypted until they are first read.  Values are
+            decrypted when exporting XML or searching by a protected field.
+            (default `False`)
+        mmap (`bool`, optional): memory map the database file instead of
+            reading it into memory, so payload blocks are verified and
+            decrypted directly from the mapping.  Applies only when
+            `filename` is a path.  (default `False`)
 
     Raises:
         `CredentialsError`: raised when password/keyfile or transformed key
@@ -63,14 +109,24 @@ class PyKeePass:
     # TODO: raise, no filename provided, database not open
 
     def __init__(self, filename, password=None, keyfile=None,
-                 transformed_key=None, decrypt=True):
-
+                 transformed_key=None, decrypt=True, key_cache=None,
+                 streaming=False, lazy_unprotect=False, mmap=False):
+
+        # most recently derived key, used when no key_cache is given
+        self._last_key_cache = TransformedKeyCache(maxsize=1)
+        # string field name to FieldIndex and TrigramIndex, kept across reloads
+        self._field_indexes = {}
+        self._trigram_indexes = {}
         self.read(
             filename=filename,
             password=password,
             keyfile=keyfile,
             transformed_key=transformed_key,
-            decrypt=decrypt
+            decrypt=decrypt,
+            key_cache=key_cache,
+            streaming=streaming,
+            lazy_unprotect=lazy_unprotect,
+            mmap=mmap
         )
 
     def __enter__(self):
@@ -81,7 +137,8 @@ class PyKeePass:
         pass
 
     def read(self, filename=None, password=None, keyfile=None,
-             transformed_key=None, decrypt=True):
+             transformed_key=None, decrypt=True, key_cache=None,
+             streaming=False, lazy_unprotect=False, mmap=False):
         """
         See class docstring.
         """
@@ -89,11 +146,18 @@ class PyKeePass:
         # TODO: - raise, no filename provided, database not open
         self._password = password
         self._keyfile = keyfile
+        self._key_cache = self._last_key_cache if key_cache is None else key_cache
+        self._streaming = streaming
+        self._lazy_unprotect = lazy_unprotect
+        self._mmap = mmap
+        self._uuid_index = UUIDIndex()
         if filename:
             self.filename = filename
         else:
             filename = self.filename
 
+        # keys derived while parsing, cached once the credentials are verified
+        new_keys = []
         try:
             if hasattr(filename, "read"):
                 self.kdbx = KDBX.parse_stream(
@@ -101,15 +165,36 @@ class PyKeePass:
                     password=password,
                     keyfile=keyfile,
                     transformed_key=transformed_key,
-                    decrypt=decrypt
+                    decrypt=decrypt,
+                    key_cache=self._key_cache,
+                    new_keys=new_keys,
+                    streaming=streaming,
+                    lazy_unprotect=lazy_unprotect
                 )
+            elif mmap:
+                with MappedFile(filename) as f:
+                    self.kdbx = KDBX.parse_stream(
+                        f,
+                        password=password,
+                        keyfile=keyfile,
+                        transformed_key=transformed_key,
+                        decrypt=decrypt,
+                        key_cache=self._key_cache,
+                        new_keys=new_keys,
+                        streaming=streaming,
+                        lazy_unprotect=lazy_unprotect
+                    )
             else:
                 self.kdbx = KDBX.parse_file(
                     filename,
                     password=password,
                     keyfile=keyfile,
                     transformed_key=transformed_key,
-                    decrypt=decrypt
+                    decrypt=decrypt,
+                    key_cache=self._key_cache,
+                    new_keys=new_keys,
+                    streaming=streaming,
+                    lazy_unprotect=lazy_unprotect
                 )
 
         except CheckError as e:
@@ -127,20 +212,87 @@ class PyKeePass:
                 raise CredentialsError("Invalid credentials")
             elif e.path == '(parsing) -> body -> sha256':
                 raise HeaderChecksumError("Corrupted database")
-            elif e.path in (
-                    '(parsing) -> body -> payload -> hmac_hash', # KDBX4
-                    '(parsing) -> xml -> block_hash' # KDBX3
-                    ):
-                raise PayloadChecksumError("Error reading database contents")
             else:
                 raise
 
+        # credentials are not checked when the payload is not decrypted
+        if decrypt:
+            for new_key in new_keys:
+                self._key_cache.set(*new_key)
+
+    @staticmethod
+    def verify_credentials(filename, password=None, keyfile=None,
+                           transformed_key=None, key_cache=None):
+        """Check credentials without decrypting the database payload
+
+        For KDBX4 databases only the header HMAC is checked.  For KDBX3
+        databases only the first cipher blocks of the payload are decrypted.
+
+        Args:
+            filename (`str`): path to database or stream object
+            password (`str`, optional): database password
+            keyfile (`str`, optional): path to keyfile
+            transformed_key (`bytes`, optional): precomputed transformed
+                key.
+            key_cache (`TransformedKeyCache`, optional): cache consulted before
+                running the key derivation function
+
+        Returns:
+            `bool`: whether the credentials open the database
+
+        Raises:
+            `HeaderChecksumError`: raised when file is not a database or its
+                header is corrupted
+        """
+
+        kwargs = dict(
+            password=password,
+            keyfile=keyfile,
+            transformed_key=transformed_key,
+            key_cache=key_cache,
+            new_keys=[]
+        )
+        try:
+            if hasattr(filename, "read"):
+                KDBXCredentialCheck.parse_stream(filename, **kwargs)
+            else:
+                KDBXCredentialCheck.parse_file(filename, **kwargs)
+
+        except CheckError as e:
+            if e.path == '(parsing) -> header -> sig_check':
+                raise HeaderChecksumError("Not a KeePass database")
+            else:
+                raise
+
+        except ChecksumError as e:
+            if e.path == '(parsing) -> body -> cred_check':
+                return False
+            elif e.path == '(parsing) -> body -> sha256':
+                raise HeaderChecksumError("Corrupted database")
+            else:
+                raise
+
+        if key_cache is not None:
+            for new_key in kwargs['new_keys']:
+                key_cache.set(*new_key)
+
+        return True
+
     def reload(self):
         """Reload current database using previously given credentials """
 
-        self.read(self.filename, self.password, self.keyfile)
+        self.read(
+            self.filename,
+            self.password,
+            self.keyfile,
+            key_cache=self._key_cache,
+            streaming=self._streaming,
+            lazy_unprotect=self._lazy_unprotect,
+            mmap=self._mmap
+        )
 
-    def save(self, filename=None, transformed_key=None):
+    def save(self, filename=None, transformed_key=None, streaming=False,
+             compression=None):
         """Save current database object to disk.
 
         Args:
@@ -148,20 +300,55 @@ class PyKeePass:
                 If None, the path given when the database was opened is used.
                 PyKeePass.filename is unchanged.
             transformed_key (`bytes`, optional): precomputed transformed
-                key.
+                key.  If None, the key derived when opening or last saving
+                is reused as long as credentials and KDF parameters are unchanged.
+            streaming (`bool`, optional): serialize, compress, encrypt and
+                write the payload block by block instead of building the
+                whole file in memory.  (default `False`)
+            compression (`str`, `bool`, `int` or `tuple`, optional): payload
+                compression.  One of the profiles 'off', 'fast', 'default' or
+                'max', True or False for the 'default' and 'off' profiles, a
+                zlib level or a (level, strategy) tuple.  Turning
+                compression on or off is stored in the database header.  If
+                None, the current setting is kept and the 'default' profile
+                is used when compressing.
         """
 
         if not filename:
             filename = self.filename
 
+        kdbx = self.kdbx
+        if compression is None:
+            compression_level = compression_profiles['default']
+        else:
+            compression_level = compression_settings(compression)
+            compression_flags = kdbx.header.value.dynamic_header.compression_flags.data
+            if compression_flags.compression != (compression_level is not None):
+                # build from a changed copy of the header, which is only
+                # kept once the database has been saved
+                kdbx = Container(kdbx)
+                kdbx.header = header = Container(kdbx.header)
+                header.value = Container(header.value)
+                header.value.dynamic_header = Container(header.value.dynamic_header)
+                dynamic_header = header.value.dynamic_header
+                dynamic_header.compression_flags = Container(dynamic_header.compression_flags)
+                dynamic_header.compression_flags.data = Container(
+                    compression_flags, compression=compression_level is not None
+                )
+                # rebuild header from its value
+                header.pop('data', None)
+
         if hasattr(filename, "write"):
             KDBX.build_stream(
-                self.kdbx,
+                kdbx,
                 filename,
                 password=self.password,
                 keyfile=self.keyfile,
                 transformed_key=transformed_key,
-                decrypt=True
+                decrypt=True,
+                key_cache=self._key_cache,
+                streaming=streaming,
+                compression_level=compression_level
             )
         else:
             # save to temporary file to prevent database clobbering
@@ -169,17 +356,21 @@ class PyKeePass:
             filename_tmp = Path(filename).with_suffix('.tmp')
             try:
                 KDBX.build_file(
-                    self.kdbx,
+                    kdbx,
                     filename_tmp,
                     password=self.password,
                     keyfile=self.keyfile,
                     transformed_key=transformed_key,
-                    decrypt=True
+                    decrypt=True,
+                    key_cache=self._key_cache,
+                    streaming=streaming,
+                    compression_level=compression_level
                 )
             except Exception as e:
                 os.remove(filename_tmp)
                 raise e
             shutil.move(filename_tmp, filename)
+        self.kdbx.header = kdbx.header
 
     @property
     def version(self):
@@ -200,16 +391,7 @@ class PyKeePass:
     def kdf_algorithm(self):
         """`str`: key derivation algorithm used by database during decryption.
         Can be one of 'aeskdf', 'argon2', or 'argon2id'"""
-        if self.version == (3, 1):
-            return 'aeskdf'
-        elif self.version == (4, 0):
-            kdf_parameters = self.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
-            if kdf_parameters['$UUID'].value == kdf_uuids['argon2']:
-                return 'argon2'
-            elif kdf_parameters['$UUID'].value == kdf_uuids['argon2id']:
-                return 'argon2id'
-            elif kdf_parameters['$UUID'].value == kdf_uuids['aeskdf']:
-                return 'aeskdf'
+        return _kdf_algorithm(self.kdbx.header.value)
 
     @property
     def transformed_key(self):
@@ -243,6 +425,57 @@ class PyKeePass:
         """`lxml.etree._ElementTree`: database XML payload"""
         return self.payload.xml
 
+    @property
+    def _protected_stream(self):
+        """Cipher id and key used for protected values"""
+        if self.version >= (4, 0):
+            header = self.payload.inner_header
+        else:
+            header = self.kdbx.header.value.dynamic_header
+        return header.protected_stream_id.data, header.protected_stream_key.data
+
+    def _unprotect(self, elems):
+        """Decrypt protected values which were kept encrypted by lazy unprotect"""
+
+        stream_id, stream_key = self._protected_stream
+        stream = protected_streams[stream_id]
+        # decrypt all values with one pass over the keystream
+        elems = list(elems)
+        values = stream.unprotect_values(
+            stream_key,
+            [(int(elem.attrib.pop(lazy_offset)), elem.text) for elem in elems]
+        )
+        for elem, value in zip(elems, values):
+            if value is not None:
+                elem.text = value
+            else:
+                logger.error(
+                    "Element at {} marked as protected, but could not unprotect".format(
+                        self.tree.getpath(elem)
+                    )
+                )
+
+    def _unprotect_lazy(self, keys=None):
+        """Decrypt all protected values still kept encrypted
+
+        Args:
+            keys (`list` of `str`, optional): only decrypt values of these
+                string fields
+        """
+        if not self._lazy_unprotect or self.kdbx.body.payload is None:
+            return
+        variables = {}
+        if keys is None:
+            xp = '//Value[@{}]'.format(lazy_offset)
+        else:
+            xp = '|'.join(
+                '//String/Key[text()=$key{}]/../Value[@{}]'.format(n, lazy_offset)
+                for n in range(len(keys))
+            )
+            variables = {'key{}'.format(n): key for n, key in enumerate(keys)}
+        if xp:
+            self._unprotect(self._xpath(xp, **variables))
+
     @property
     def root_group(self):
         """`Group`: root Group of database"""
@@ -253,6 +486,9 @@ class PyKeePass:
         """`Group`: RecycleBin Group of database"""
         elem = self._xpath('/KeePassFile/Meta/RecycleBinUUID', first=True)
         recyclebin_uuid = uuid.UUID( bytes = base64.b64decode(elem.text) )
+        # KeePass stores a null UUID when there is no recycle bin
+        if recyclebin_uuid.int == 0:
+            return None
         return self.find_groups(uuid=recyclebin_uuid, first=True)
 
     @property
@@ -306,6 +542,7 @@ class PyKeePass:
         Returns:
             `str`: XML content of database
         """
+        self._unprotect_lazy()
         return etree.tostring(
             self.tree,
             pretty_print=True,
@@ -340,6 +577,11 @@ class PyKeePass:
             cast (`bool`): If True, matches are instead instantiated as
                 pykeepass Group, Entry, or Attachment objects.  An exception
                 is raised if a match cannot be cast.  (default `False`)
+            **kwargs: values of XPath variables used in `xpath_str` as `$name`
+
+        Compiled queries are cached by `xpath_str`, so values which change
+        between calls should be passed as variables rather than formatted
+        into the query.
 
         Returns:
             `list` of `Group`, `Entry`, `Attachment`, or `lxml.etree.Element`
@@ -347,24 +589,16 @@ class PyKeePass:
 
         if tree is None:
             tree = self.tree
+        if first:
+            # only the first match is returned, so only one is cast
+            xpath_str = '({})[1]'.format(xpath_str)
         logger.debug('xpath query: ' + xpath_str)
-        elements = tree.xpath(
-            xpath_str, namespaces={'re': 'http://exslt.org/regular-expressions'}
-        )
+        elements = compile_xpath(xpath_str)(tree, **kwargs)
 
-        res = []
-        for e in elements:
-            if cast:
-                if e.tag == 'Entry':
-                    res.append(Entry(element=e, kp=self))
-                elif e.tag == 'Group':
-                    res.append(Group(element=e, kp=self))
-                elif e.tag == 'Binary' and e.getparent().tag == 'Entry':
-                    res.append(Attachment(element=e, kp=self))
-                else:
-                    raise Exception('Could not cast element {}'.format(e))
-            else:
-                res.append(e)
+        if cast:
+            res = [self._cast(e) for e in elements]
+        else:
+            res = list(elements)
 
         # return first object in list or None
         if first:
@@ -372,6 +606,17 @@ class PyKeePass:
 
         return res
 
+    def _cast(self, element):
+        """Wrap an element in its Group, Entry or Attachment object"""
+        if element.tag == 'Entry':
+            return Entry(element=element, kp=self)
+        elif element.tag == 'Group':
+            return Group(element=element, kp=self)
+        elif element.tag == 'Binary' and element.getparent().tag == 'Entry':
+            return Attachment(element=element, kp=self)
+        else:
+            raise Exception('Could not cast element {}'.format(element))
+
     _xpath = xpath
 
     def _find(self, prefix, keys_xp, path=None, tree=None, first=False,
@@ -380,62 +625,189 @@ class PyKeePass:
 
         xp = ''
 
-        if not history:
-            prefix += '[not(ancestor::History)]'
+        # string field values compared by the query
+        string_values = {}
+        if keys_xp is entry_xp:
+            for k, v in kwargs.items():
+                if k in string_field_keys and v is not None:
+                    string_values[string_field_keys[k]] = str(v)
+            for k, v in (kwargs.get('string') or {}).items():
+                string_values[str(k)] = str(v)
+
+        # values compared by the query must be decrypted
+        if self._lazy_unprotect and keys_xp is entry_xp:
+            keys = list(string_values)
+            if path is not None:
+                keys.append('Title')
+            self._unprotect_lazy(keys)
+
+        # search values are bound to XPath variables, see xpath.py
+        variables = {'flags': flags or ''}
 
         if path is not None:
 
-            first = True
-
             xp += '/KeePassFile/Root/Group'
             # split provided path into group and element
             group_path = path[:-1]
             element = path[-1] if len(path) > 0 else ''
             # build xpath from group_path and element
-            for group in group_path:
-                xp += path_xp[regex]['group'].format(group, flags=flags)
+            for n, group in enumerate(group_path):
+                name = 'path{}'.format(n)
+                xp += path_xp[regex]['group'].format(name)
+                variables[name] = str(group)
             if 'Entry' in prefix:
-                xp += path_xp[regex]['entry'].format(element, flags=flags)
+                xp += path_xp[regex]['entry'].format('element')
+                variables['element'] = str(element)
             elif element and 'Group' in prefix:
-                xp += path_xp[regex]['group'].format(element, flags=flags)
-
-        else:
-            if tree is not None:
-                xp += '.'
-
-            xp += prefix
+                xp += path_xp[regex]['group'].format('element')
+                variables['element'] = str(element)
 
-            # handle searching custom string fields
-            if 'string' in kwargs:
-                for key, value in kwargs['string'].items():
-                    xp += keys_xp[regex]['string'].format(key, value, flags=flags)
+            return self._xpath(xp, first=True, cast=True, **variables)
 
-                kwargs.pop('string')
-
-            # convert uuid to base64 form before building xpath
-            if 'uuid' in kwargs:
-                kwargs['uuid'] = base64.b64encode(kwargs['uuid'].bytes).decode('utf-8')
-
-            # convert tags to semicolon separated string before building xpath
+        # conditions on matched elements, joined into a single predicate
+        conditions = []
+        if not history:
+            conditions.append('not(ancestor::History)')
+
+        # handle searching custom string fields
+        if 'string' in kwargs:
+            for n, (key, value) in enumerate(kwargs.pop('string').items()):
+                key_name, value_name = 'string_key{}'.format(n), 'string{}'.format(n)
+                conditions.append(keys_xp[regex]['string'].format(key_name, value_name))
+                variables[key_name] = str(key)
+                variables[value_name] = str(value)
+
+        # convert uuid to base64 form before building xpath
+        if 'uuid' in kwargs:
+            kwargs['uuid'] = base64.b64encode(kwargs['uuid'].bytes).decode('utf-8')
+
+        # build xpath to filter results with specified attributes
+        for key, value in kwargs.items():
+            if key not in keys_xp[regex]:
+                raise TypeError('Invalid keyword argument "{}"'.format(key))
+            if value is None:
+                continue
             # FIXME: this isn't a reliable way to search tags.  e.g. searching ['tag1', 'tag2'] will match 'tag1tag2
-            if 'tags' in kwargs:
-                kwargs['tags'] = ' and '.join(f'contains(text(),"{t}")' for t in kwargs['tags'])
+            if key == 'tags':
+                names = ['tag{}'.format(n) for n in range(len(value))]
+                conditions.append(keys_xp[regex][key].format(
+                    ' and '.join('contains(text(),${})'.format(name) for name in names)
+                ))
+                variables.update(zip(names, map(str, value)))
+            else:
+                conditions.append(keys_xp[regex][key].format(key))
+                variables[key] = str(value)
+
+        predicate = ' and '.join(conditions)
+        tag = prefix.lstrip('/')
+        recursive = prefix.startswith('//')
+        if tree is not None:
+            root = tree._element
+        else:
+            root = self.tree.getroot()
 
-            # build xpath to filter results with specified attributes
-            for key, value in kwargs.items():
-                if key not in keys_xp[regex]:
-                    raise TypeError('Invalid keyword argument "{}"'.format(key))
-                if value is not None:
-                    xp += keys_xp[regex][key].format(value, flags=flags)
+        # look up UUIDs in the index instead of scanning the tree
+        use_index = (
+            kwargs.get('uuid') is not None and not regex and not history
+            and tag in UUIDIndex.tags
+        )
+        if use_index:
+            elem = self._uuid_index.get(self.tree.getroot(), tag, kwargs['uuid'])
+            if elem is not None:
+                if recursive:
+                    in_scope = tree is None or any(a is root for a in elem.iterancestors())
+                else:
+                    in_scope = elem.getparent() is root
+                # indexed UUIDs are unique, no other element can match
+                if in_scope and compile_xpath(predicate)(elem, **variables):
+                    res = [self._cast(elem)]
+                else:
+                    res = []
+                if first:
+                    return res[0] if res else None
+                return res
+
+        # indexed fields narrow the search to a few entries
+        candidates = None
+        if keys_xp is entry_xp and not history:
+            for key, value in string_values.items():
+                index = self._field_indexes.get(key)
+                if index is None:
+                    continue
+                if regex:
+                    value = regex_literal(value, flags)
+                    if value is None:
+                        continue
+                    # only ASCII characters are folded like re.IGNORECASE
+                    if 'i' in (flags or '') and not (index.casefold and value.isascii()):
+                        continue
+                found = index.get(self.tree.getroot(), value)
+                if regex:
+                    # `$` also matches before a trailing newline
+                    found += index.get(self.tree.getroot(), value + '\n')
+                if candidates is None or len(found) < len(candidates):
+                    candidates = found
+            # substrings of the searched values narrow down by trigrams
+            for key, value in string_values.items():
+                index = self._trigram_indexes.get(key)
+                if index is None:
+                    continue
+                substrings = regex_substrings(value, flags) if regex else [value]
+                found = index.search(self.tree.getroot(), substrings)
+                if found is not None and (candidates is None or len(found) < len(candidates)):
+                    candidates = found
+        if candidates is not None:
+            test = compile_xpath(predicate)
+            if recursive:
+                elements = [
+                    elem for elem in candidates
+                    if any(a is root for a in elem.iterancestors())
+                    and test(elem, **variables)
+                ]
+            else:
+                elements = [
+                    elem for elem in candidates
+                    if elem.getparent() is root and test(elem, **variables)
+                ]
+            elements = document_order(elements, root, tag)
+            if first:
+                return self._cast(elements[0]) if elements else None
+            return [self._cast(elem) for elem in elements]
+
+        if first:
+            # test candidates in document order and stop at the first match.
+            # libxml2 collects the whole descendant axis even for `[1]`
+            if recursive:
+                candidates = root.iterdescendants(tag)
+            elif tree is not None:
+                candidates = root.iterchildren(tag)
+            else:
+                candidates = ()
+            test = compile_xpath(predicate) if predicate else None
+            for elem in candidates:
+                if test is None or test(elem, **variables):
+                    if use_index:
+                        self._uuid_index.add(elem, recursive=False)
+                    return self._cast(elem)
+            return None
+
+        if tree is not None:
+            xp += '.'
+        # `//Entry[...]` merges the matches of every parent node, which is
+        # quadratic in libxml2.  The descendant axis selects the same nodes
+        xp += '/descendant::' + tag if recursive else '/' + tag
+        if predicate:
+            xp += '[{}]'.format(predicate)
 
         res = self._xpath(
             xp,
             tree=tree._element if tree else None,
-            first=first,
             cast=True,
-            **kwargs
+            **variables
         )
-
+        if use_index:
+            for item in res:
+                self._uuid_index.add(item._element, recursive=False)
         return res
 
     def _can_be_moved_to_recyclebin(self, entry_or_group):
@@ -445,7 +817,7 @@ class PyKeePass:
         if recyclebin_group is None:
             return True
         uuid_str = base64.b64encode( entry_or_group.uuid.bytes).decode('utf-8')
-        elem = self._xpath('./UUID[text()="{}"]/..'.format(uuid_str), tree=recyclebin_group._element, first=True, cast=False)
+        elem = self._xpath('./UUID[text()=$uuid]/..', tree=recyclebin_group._element, first=True, cast=False, uuid=uuid_str)
         return elem is None
 
 
@@ -646,6 +1018,99 @@ class PyKeePass:
 
         return res
 
+    def add_field_index(self, field, casefold=False):
+        """Index entries by the value of a string field
+
+        Searches by `find_entries` for the exact value of an indexed field
+        look up matching entries in the index instead of checking every entry.
+        The index is built on first use and kept up to date when entries are
+        changed through pykeepass.  Changes made to the XML tree directly are
+        not seen by the index.
+
+        Args:
+            field (`str`): 'title', 'username', 'password', 'url', 'notes',
+                'otp' or the name of a custom string field
+            casefold (`bool`): index case-folded values, so that searches like
+                `title='^gmail$', regex=True, flags='i'` can also use the
+                index.  Only searches for ASCII text are case-insensitive,
+                others check every entry.  (default `False`)
+
+        Examples:
+        ``` python
+        >>> kp.add_field_index('username')
+        >>> kp.add_field_index('employee_id')
+        >>> kp.find_entries(string={'employee_id': '1234'})
+        [Entry: "employees/jdoe (jdoe)"]
+        ```
+        """
+        key = string_field_keys.get(field, field)
+        self._field_indexes[key] = FieldIndex(key, casefold=casefold)
+
+    def remove_field_index(self, field):
+        """Remove an index added with `add_field_index`
+
+        Args:
+            field (`str`): field name given to `add_field_index`
+        """
+        self._field_indexes.pop(string_field_keys.get(field, field), None)
+
+    def add_trigram_index(self, field):
+        """Index entries by the three character substrings of a string field
+
+        Regular expression searches by `find_entries` on an indexed field only
+        check entries which contain the literal text of the expression, such
+        as 'foo' in `title='.*foo.*'` or 'example.com' in
+        `url='example\\.com'`.  Expressions without three consecutive literal
+        characters outside of groups, alternations and repeats still check
+        every entry.  Exact searches use the index as well.  The index is
+        built on first use and kept up to date like the indexes of
+        `add_field_index`.
+
+        Args:
+            field (`str`): 'title', 'username', 'password', 'url', 'notes',
+                'otp' or the name of a custom string field
+
+        Examples:
+        ``` python
+        >>> kp.add_trigram_index('title')
+        >>> kp.find_entries(title='gmail', regex=True, flags='i')
+        [Entry: "social/gmail (myusername)"]
+        ```
+        """
+        key = string_field_keys.get(field, field)
+        self._trigram_indexes[key] = TrigramIndex(key)
+
+    def remove_trigram_index(self, field):
+        """Remove an index added with `add_trigram_index`
+
+        Args:
+            field (`str`): field name given to `add_trigram_index`
+        """
+        self._trigram_indexes.pop(string_field_keys.get(field, field), None)
+
+    def _string_indexes(self, key):
+        """Field and trigram indexes of a string field"""
+        return [
+            index for index in (self._field_indexes.get(key), self._trigram_indexes.get(key))
+            if index is not None
+        ]
+
+    def _index_element(self, element):
+        """Add an Entry or Group element moved into the tree to the indexes"""
+        self._uuid_index.add(element)
+        for index in self._field_indexes.values():
+            index.add(element)
+        for index in self._trigram_indexes.values():
+            index.add(element)
+
+    def _unindex_element(self, element):
+        """Remove an Entry or Group element from the indexes"""
+        self._uuid_index.discard(element)
+        for index in self._field_indexes.values():
+            index.discard(element)
+        for index in self._trigram_indexes.values():
+            index.discard(element)
+
 
     def add_entry(self, destination_group, title, username,
                   password, url=None, notes=None, expiry_time=None,
@@ -676,15 +1141,13 @@ class PyKeePass:
             `Entry`: newly added entry
         """
 
-        entries = self.find_entries(
+        if not force_creation and self.find_entries(
             title=title,
             username=username,
             first=True,
             group=destination_group,
             recursive=False
-        )
-
-        if entries and not force_creation:
+        ):
             raise Exception(
                 'An entry "{}" already exists in "{}"'.format(
                     title, destination_group
@@ -796,8 +1259,9 @@ class PyKeePass:
 
         Args:
             data (`bytes`): binary data
-            compressed (`bool`): whether binary data should be compressed.
-                (default `True`).  Applies only to KDBX3
+            compressed (`bool`, `str`, `int` or `tuple`): whether binary data
+                should be compressed, or the compression to use as for
+                `save`.  (default `True`).  Applies only to KDBX3
             protected (`bool`): whether protected flag should be set.  (default `True`).  Note
                 Applies only to KDBX4
 
@@ -815,12 +1279,17 @@ class PyKeePass:
                 '/KeePassFile/Meta/Binaries',
                 first=True
             )
+            settings = compression_settings(compressed)
+            compressed = settings is not None
             if compressed:
                 # gzip compression
+                level, strategy = settings
                 compressor = zlib.compressobj(
-                    zlib.Z_DEFAULT_COMPRESSION,
+                    level,
                     zlib.DEFLATED,
-                    zlib.MAX_WBITS | 16
+                    zlib.MAX_WBITS | 16,
+                    zlib.DEF_MEM_LEVEL,
+                    strategy
                 )
                 data = compressor.compress(data)
                 data += compressor.flush()
@@ -866,8 +1335,9 @@ class PyKeePass:
 
         # decrement references greater than this id
         binaries_gt = self._xpath(
-            '//Binary/Value[@Ref > "{}"]/..'.format(id),
-            cast=True
+            '//Binary/Value[@Ref > $id]/..',
+            cast=True,
+            id=id
         )
         for reference in binaries_gt:
             reference.id = reference.id - 1
@@ -921,6 +1391,7 @@ class PyKeePass:
     @password.setter
     def password(self, password):
         self._password = password
+        self._invalidate_key_cache()
         self.credchange_date = datetime.now(timezone.utc)
 
     @property
@@ -931,8 +1402,14 @@ class PyKeePass:
     @keyfile.setter
     def keyfile(self, keyfile):
         self._keyfile = keyfile
+        self._invalidate_key_cache()
         self.credchange_date = datetime.now(timezone.utc)
 
+    def _invalidate_key_cache(self):
+        """Forget the last derived key after a credential change.  A user
+        supplied cache may be shared with other databases and is left untouched"""
+        self._last_key_cache.clear()
+
     @property
     def credchange_required_days(self):
         """`int`: Days until password update should be required"""
@@ -1029,8 +1506,114 @@ class PyKeePass:
         else:
             return datetime.fromisoformat(text.replace('Z','+00:00')).replace(tzinfo=timezone.utc)
 
+def _kdf_algorithm(header):
+    """Name of the key derivation function from a parsed outer header"""
+
+    if header.major_version == 3:
+        return 'aeskdf'
+    elif header.major_version == 4:
+        kdf_parameters = header.dynamic_header.kdf_parameters.data.dict
+        if kdf_parameters['$UUID'].value == kdf_uuids['argon2']:
+            return 'argon2'
+        elif kdf_parameters['$UUID'].value == kdf_uuids['argon2id']:
+            return 'argon2id'
+        elif kdf_parameters['$UUID'].value == kdf_uuids['aeskdf']:
+            return 'aeskdf'
+
+
+@dataclass
+class HeaderInfo:
+    """Outer header information of a database, see `probe_header`"""
+
+    version: tuple
+    """`tuple` of `int`: major and minor version"""
+    encryption_algorithm: str
+    """`str`: one of 'aes256', 'chacha20', or 'twofish'"""
+    kdf_algorithm: str
+    """`str`: one of 'aeskdf', 'argon2', or 'argon2id'"""
+    salt: bytes
+    """`bytes`: salt of database kdf"""
+    kdf_parameters: dict = field(default_factory=dict)
+    """`dict`: remaining KDF parameters by their KDBX4 names.  e.g. 'R' (rounds)
+    for AES-KDF or 'I' (iterations), 'M' (memory), 'P' (parallelism) for Argon2"""
+
+
+def probe_header(filename):
+    """Read the outer header of a database without reading its payload
+
+    Args:
+        filename (`str`): path to database or stream object.  Stream objects
+            must be seekable and positioned at the start of the database
+
+    Returns:
+        `HeaderInfo`
+
+    Raises:
+        `HeaderChecksumError`: raised when file is not a KeePass database
+    """
+
+    try:
+        if hasattr(filename, "read"):
+            header = Header.parse_stream(filename).value
+        else:
+            with open(filename, 'rb') as f:
+                header = Header.parse_stream(f).value
+    except CheckError as e:
+        if e.path == '(parsing) -> sig_check':
+            raise HeaderChecksumError("Not a KeePass database")
+        else:
+            raise
+
+    dynamic_header = header.dynamic_header
+    if header.major_version == 3:
+        salt = dynamic_header.transform_seed.data
+        kdf_parameters = {'R': dynamic_header.transform_rounds.data}
+    else:
+        kdf_parameters = {
+            k: v.value for k, v in dynamic_header.kdf_parameters.data.dict.items()
+            if k not in ('$UUID', 'S')
+        }
+        salt = dynamic_header.kdf_parameters.data.dict['S'].value
+
+    return HeaderInfo(
+        version=(header.major_version, header.minor_version),
+        encryption_algorithm=dynamic_header.cipher_id.data,
+        kdf_algorithm=_kdf_algorithm(header),
+        salt=salt,
+        kdf_parameters=kdf_parameters
+    )
+
+
+def probe_headers(filenames, max_workers=None, return_exceptions=False):
+    """Read the outer headers of many databases concurrently
+
+    Args:
+        filenames (`list` of `str`): paths to databases
+        max_workers (`int`, optional): number of threads.  See
+            `concurrent.futures.ThreadPoolExecutor`
+        return_exceptions (`bool`): if True, exceptions are returned in place of
+            `HeaderInfo` for files which could not be probed instead of being raised.
+            (default `False`)
+
+    Returns:
+        `list` of `HeaderInfo` in the same order as `filenames`
+    """
+
+    def probe(filename):
+        try:
+            return probe_header(filename)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(probe, filenames))
+
+
 def create_database(
-        filename, password=None, keyfile=None, transformed_key=None
+        filename, password=None, keyfile=None, transformed_key=None,
+        compression=None
 ):
     """
     Create a new database at ``filename`` with supplied credentials.
@@ -1044,6 +1627,8 @@ def create_database(
             database is assumed to have no keyfile
         transformed_key (`bytes`, optional): precomputed transformed
             key.
+        compression (`str`, `int` or `tuple`, optional): payload
+            compression, see `PyKeePass.save`
 
     Returns:
         `PyKeePass`
@@ -1056,7 +1641,7 @@ def create_database(
     keepass_instance.password = password
     keepass_instance.keyfile = keyfile
 
-    keepass_instance.save(transformed_key)
+    keepass_instance.save(transformed_key=transformed_key, compression=compression)
     return keepass_instance
 
 def debug_setup():
@@ -1,65 +1,96 @@
+# XPath templates used by `PyKeePass._find`.  Search values are not
+# formatted into the templates, `{}` is replaced by the name of an XPath
+# variable (`$name`) which is bound to the value when the query runs.  The
+# query string then only depends on the shape of a search, so its compiled
+# form can be cached and reused.
+#
+# Search keys are conditions on the matched element.  `PyKeePass._find` joins
+# them with `and` into a single predicate, which it either appends to the
+# location path or tests on candidate elements one at a time to stop at the
+# first match.
+
+from functools import lru_cache
+
+from lxml import etree
+
+namespaces = {'re': 'http://exslt.org/regular-expressions'}
+
+
+@lru_cache(maxsize=512)
+def compile_xpath(xpath_str):
+    """Compile an XPath query, reusing the compiled query for repeated strings
+
+    Args:
+        xpath_str (`str`): XPath query, values given as `$name` variables
+
+    Returns:
+        `lxml.etree.XPath`
+    """
+    return etree.XPath(xpath_str, namespaces=namespaces)
+
+
 attachment_xp = {
     False: {
-        'id': '/Value[@Ref="{}"]/..',
-        'filename': '/Key[text()="{}"]/..'
+        'id': 'Value[@Ref=${}]',
+        'filename': 'Key[text()=${}]'
     },
     True: {
-        'id': '/Value[re:test(@Ref, "{}", "{flags}")]/..',
-        'filename': '/Key[re:test(text(), "{}", "{flags}")]/..'
+        'id': 'Value[re:test(@Ref, ${}, $flags)]',
+        'filename': 'Key[re:test(text(), ${}, $flags)]'
     }
 }
 
 path_xp = {
     False: {
-        'group': '/Group/Name[text()="{}"]/..',
-        'entry': '/Entry/String/Key[text()="Title"]/../Value[text()="{}"]/../..',
+        'group': '/Group[Name[text()=${}]]',
+        'entry': '/Entry[String[Key[text()="Title"] and Value[text()=${}]]]',
     },
     True: {
-        'group': '/Group/Name[re:test(text(), "{}", "{flags}")]/..',
-        'entry': '/Entry/String/Key[text()="Title"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
+        'group': '/Group[Name[re:test(text(), ${}, $flags)]]',
+        'entry': '/Entry[String[Key[text()="Title"] and Value[re:test(text(), ${}, $flags)]]]',
     }
 }
 
 entry_xp = {
     False: {
-        'title': '/String/Key[text()="Title"]/../Value[text()="{}"]/../..',
-        'username': '/String/Key[text()="UserName"]/../Value[text()="{}"]/../..',
-        'password': '/String/Key[text()="Password"]/../Value[text()="{}"]/../..',
-        'url': '/String/Key[text()="URL"]/../Value[text()="{}"]/../..',
-        'notes': '/String/Key[text()="Notes"]/../Value[text()="{}"]/../..',
-        'uuid': '/UUID[text()="{}"]/..',
-        'tags': '/Tags[{}]/..',
-        'string': '/String/Key[text()="{}"]/../Value[text()="{}"]/../..',
-        'autotype_sequence': '/AutoType/DefaultSequence[text()="{}"]/../..',
-        'autotype_window': '/AutoType/Association/Window[text()="{}"]/../../..',
-        'autotype_enabled': '/AutoType/Enabled[text()="{}"]/../..',
-        'otp': '/String/Key[text()="otp"]/../Value[text()="{}"]/../..',
+        'title': 'String[Key[text()="Title"] and Value[text()=${}]]',
+        'username': 'String[Key[text()="UserName"] and Value[text()=${}]]',
+        'password': 'String[Key[text()="Password"] and Value[text()=${}]]',
+        'url': 'String[Key[text()="URL"] and Value[text()=${}]]',
+        'notes': 'String[Key[text()="Notes"] and Value[text()=${}]]',
+        'uuid': 'UUID[text()=${}]',
+        'tags': 'Tags[{}]',
+        'string': 'String[Key[text()=${}] and Value[text()=${}]]',
+        'autotype_sequence': 'AutoType/DefaultSequence[text()=${}]',
+        'autotype_window': 'AutoType/Association/Window[text()=${}]',
+        'autotype_enabled': 'AutoType/Enabled[text()=${}]',
+        'otp': 'String[Key[text()="otp"] and Value[text()=${}]]',
     },
     True: {
-        'title': '/String/Key[text()="Title"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'username': '/String/Key[text()="UserName"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'password': '/String/Key[text()="Password"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'url': '/String/Key[text()="URL"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'notes': '/String/Key[text()="Notes"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'uuid': '/UUID[re:test(text(), "{}", "{flags}")]/..',
-        'tags': '/Tags[{}]/..', # no regular expression support for tags
-        'string': '/String/Key[text()="{}"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
-        'autotype_sequence': '/AutoType/DefaultSequence[re:test(text(), "{}", "{flags}")]/../..',
-        'autotype_window': '/AutoType/Association/Window[re:test(text(), "{}", "{flags}")]/../../..',
-        'autotype_enabled': '/AutoType/Enabled[re:test(text(), "{}", "{flags}")]/../..',
-        'otp': '/String/Key[text()="otp"]/../Value[re:test(text(), "{}", "{flags}")]/../..',
+        'title': 'String[Key[text()="Title"] and Value[re:test(text(), ${}, $flags)]]',
+        'username': 'String[Key[text()="UserName"] and Value[re:test(text(), ${}, $flags)]]',
+        'password': 'String[Key[text()="Password"] and Value[re:test(text(), ${}, $flags)]]',
+        'url': 'String[Key[text()="URL"] and Value[re:test(text(), ${}, $flags)]]',
+        'notes': 'String[Key[text()="Notes"] and Value[re:test(text(), ${}, $flags)]]',
+        'uuid': 'UUID[re:test(text(), ${}, $flags)]',
+        'tags': 'Tags[{}]', # no regular expression support for tags
+        'string': 'String[Key[text()=${}] and Value[re:test(text(), ${}, $flags)]]',
+        'autotype_sequence': 'AutoType/DefaultSequence[re:test(text(), ${}, $flags)]',
+        'autotype_window': 'AutoType/Association/Window[re:test(text(), ${}, $flags)]',
+        'autotype_enabled': 'AutoType/Enabled[re:test(text(), ${}, $flags)]',
+        'otp': 'String[Key[text()="otp"] and Value[re:test(text(), ${}, $flags)]]',
     }
 }
 
 group_xp = {
     False: {
-        'name': '/Name[text()="{}"]/..',
-        'uuid': '/UUID[text()="{}"]/..',
-        'notes': '/Notes[text()="{}"]/..',
+        'name': 'Name[text()=${}]',
+        'uuid': 'UUID[text()=${}]',
+        'notes': 'Notes[text()=${}]',
     },
     True: {
-        'name': '/Name[re:test(text(), "{}", "{flags}")]/..',
-        'uuid': '/UUID[re:test(text(), "{}", "{flags}")]/..',
-        'notes': '/Notes[re:test(text(), "{}", "{flags}")]/..',
+        'name': 'Name[re:test(text(), ${}, $flags)]',
+        'uuid': 'UUID[re:test(text(), ${}, $flags)]',
+        'notes': 'Notes[re:test(text(), ${}, $flags)]',
     }
 }
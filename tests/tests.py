@@ -1,16 +1,45 @@
+import base64
 import logging
 import os
 import shutil
+import struct
+import subprocess
+import sys
 import unittest
 import uuid
+import zlib
+from copy import deepcopy
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
+from io import BufferedReader, BytesIO
 from pathlib import Path
+from unittest import mock
 
-from pykeepass import PyKeePass, icons
+import argon2
+from construct import ChecksumError, GreedyBytes, StreamError
+from lxml import etree
+from pykeepass import PyKeePass, TransformedKeyCache, crypto, icons, probe_header, probe_headers
 from pykeepass.entry import Entry
-from pykeepass.exceptions import BinaryError, CredentialsError, HeaderChecksumError
+from pykeepass.exceptions import (
+    BinaryError,
+    CredentialsError,
+    HeaderChecksumError,
+    PayloadChecksumError,
+)
 from pykeepass.group import Group
+from pykeepass.index import UUIDIndex, regex_substrings
+from pykeepass.xpath import compile_xpath
+from pykeepass.kdbx_parsing import KDBX, MappedFile, kdbx3, kdbx4, lazy_offset, pytwofish, twofish
+from pykeepass.kdbx_parsing.common import ChaCha20Stream, ChunkedStream, GreedyView, Salsa20Stream
+
+try:
+    from pykeepass.kdbx_parsing import nptwofish
+except ImportError:
+    nptwofish = None
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
 
 """
 Missing Tests:
@@ -120,6 +149,171 @@ class EntryFindTests3(KDBX3Tests):
         self.assertEqual(uu, results.uuid)
         self.assertEqual('foobar_user', results.username)
 
+    def test_find_entries_by_uuid_index(self):
+        uu = uuid.UUID('cc5f7ecd-2a00-48ca-9621-c222a347b0bb')
+        entry = self.kp.find_entries(uuid=uu, first=True)
+        group = self.kp.find_groups(name='foobar_group', first=True)
+
+        # index hits do not search the tree
+        with mock.patch.object(self.kp, '_xpath', side_effect=AssertionError):
+            self.assertEqual(self.kp.find_entries(uuid=uu), [entry])
+            self.assertEqual(self.kp.find_groups(uuid=group.uuid, first=True), group)
+            self.assertEqual(self.kp.find_entries(uuid=uu, title='nonexistent'), [])
+
+        # added, moved, renamed, trashed and deleted elements
+        new = self.kp.add_entry(group, 'uuid_index_entry', 'user', 'pass')
+        self.assertEqual(self.kp.find_entries(uuid=new.uuid, first=True), new)
+        self.assertIsNone(self.kp.find_entries(uuid=new.uuid, group=self.kp.root_group, recursive=False, first=True))
+        self.kp.move_entry(new, self.kp.root_group)
+        self.assertEqual(self.kp.find_entries(uuid=new.uuid, group=self.kp.root_group, recursive=False), [new])
+        self.assertEqual(self.kp.find_entries(uuid=new.uuid, group=group), [])
+        old_uuid, new.uuid = new.uuid, uuid.uuid4()
+        self.assertIsNone(self.kp.find_entries(uuid=old_uuid, first=True))
+        self.assertEqual(self.kp.find_entries(uuid=new.uuid, first=True), new)
+        self.kp.trash_entry(new)
+        self.assertEqual(self.kp.find_entries(uuid=new.uuid, group=self.kp.recyclebin_group), [new])
+        self.kp.delete_entry(new)
+        self.assertIsNone(self.kp.find_entries(uuid=new.uuid, first=True))
+
+        # history entries share the UUID of their entry
+        entry.save_history()
+        self.assertEqual(len(self.kp.find_entries(uuid=uu)), 1)
+        self.assertEqual(len(self.kp.find_entries(uuid=uu, history=True)), 2)
+
+        # elements changed through lxml are not returned
+        subgroup = self.kp.add_group(group, 'uuid_index_group')
+        subgroup._element.getparent().remove(subgroup._element)
+        self.assertIsNone(self.kp.find_groups(uuid=subgroup.uuid, first=True))
+        group._element.append(subgroup._element)
+        self.assertEqual(self.kp.find_groups(uuid=subgroup.uuid, first=True), subgroup)
+
+        # every element sharing a UUID is found
+        duplicate = self.kp.add_entry(self.kp.root_group, 'uuid_index_duplicate', 'user', 'pass')
+        duplicate.uuid = uu
+        expected = [entry._element, duplicate._element]
+        self.assertEqual([e._element for e in self.kp.find_entries(uuid=uu)], expected)
+        self.assertEqual(self.kp.find_entries(uuid=uu, first=True), entry)
+        self.assertEqual(self.kp.find_entries(uuid=uu, group=self.kp.root_group, recursive=False), [duplicate])
+        self.assertEqual(self.kp.find_entries(uuid=uu, group=group), [entry])
+        copy = deepcopy(entry._element)
+        group._element.append(copy)
+        self.kp._uuid_index = UUIDIndex()
+        expected.insert(1, copy)
+        self.assertEqual([e._element for e in self.kp.find_entries(uuid=uu)], expected)
+
+    def test_find_entries_field_index(self):
+        group = self.kp.find_groups(name='foobar_group', first=True)
+        searches = [
+            {'title': 'foobar_entry'},
+            {'title': 'foobar_entry', 'group': group},
+            {'title': 'foobar_entry', 'group': group, 'recursive': False},
+            {'title': 'foobar_entry', 'recursive': False},
+            {'title': 'foobar_entry', 'history': True},
+            {'title': 'foobar_entry', 'username': 'foobar_user'},
+            {'username': '^FOOBAR_USER$', 'regex': True, 'flags': 'i'},
+            {'username': '^foobar_user$', 'regex': True},
+            {'string': {'custom_field': 'custom field value'}},
+            {'title': 'nonexistent'},
+        ]
+        expected = [self.kp.find_entries(**kwargs) for kwargs in searches]
+        self.kp.add_field_index('title')
+        self.kp.add_field_index('username', casefold=True)
+        self.kp.add_field_index('custom_field')
+        for kwargs, results in zip(searches, expected):
+            found = self.kp.find_entries(**kwargs)
+            self.assertEqual([e._element for e in found], [e._element for e in results])
+            first = self.kp.find_entries(first=True, **kwargs)
+            self.assertEqual(first, results[0] if results else None)
+
+        # index hits do not search the tree
+        with mock.patch.object(self.kp, '_xpath', side_effect=AssertionError):
+            self.assertEqual(len(self.kp.find_entries(title='foobar_entry')), 3)
+
+        # added, changed, moved and deleted entries
+        entry = self.kp.add_entry(group, 'field_index_entry', 'field_index_user', 'pass')
+        self.assertEqual(self.kp.find_entries(title='field_index_entry'), [entry])
+        entry.title = 'field_index_renamed'
+        self.assertEqual(self.kp.find_entries(title='field_index_entry'), [])
+        self.assertEqual(self.kp.find_entries(title='field_index_renamed'), [entry])
+        entry.set_custom_property('custom_field', 'field index value')
+        self.assertEqual(self.kp.find_entries(string={'custom_field': 'field index value'}), [entry])
+        entry.delete_custom_property('custom_field')
+        self.assertEqual(self.kp.find_entries(string={'custom_field': 'field index value'}), [])
+        self.kp.move_entry(entry, self.kp.root_group)
+        self.assertEqual(self.kp.find_entries(title='field_index_renamed', group=group), [])
+        self.assertEqual(self.kp.find_entries(title='field_index_renamed', group=self.kp.root_group), [entry])
+        self.kp.delete_entry(entry)
+        self.assertEqual(self.kp.find_entries(title='field_index_renamed'), [])
+
+        self.kp.remove_field_index('title')
+        self.assertEqual(len(self.kp.find_entries(title='foobar_entry')), 3)
+
+    def test_find_entries_field_index_casefold(self):
+        # non-ASCII characters which re.IGNORECASE matches to ASCII letters
+        for title in ('İstanbul', 'ıs', 'ſecret', 'Kelvin', 'École', 'straße'):
+            self.kp.add_entry(self.kp.root_group, title, 'casefold_user', 'pass')
+        searches = [
+            '^istanbul$', '^ISTANBUL$', '^İSTANBUL$', '^IS$', '^secret$',
+            '^SECRET$', '^kelvin$', '^école$', '^ÉCOLE$', '^STRASSE$', '^strasse$',
+        ]
+        expected = [self.kp.find_entries(title=s, regex=True, flags='i') for s in searches]
+        self.assertEqual(sum(map(len, expected)), 9)
+        self.kp.add_field_index('title', casefold=True)
+        for search, results in zip(searches, expected):
+            found = self.kp.find_entries(title=search, regex=True, flags='i')
+            self.assertEqual(found, results, search)
+
+        # ASCII searches use the index
+        with mock.patch.object(self.kp, '_xpath', side_effect=AssertionError):
+            self.assertEqual(self.kp.find_entries(title='^istanbul$', regex=True, flags='i'), expected[0])
+
+    def test_find_entries_trigram_index(self):
+        group = self.kp.find_groups(name='foobar_group', first=True)
+        searches = [
+            {'title': 'foobar', 'regex': True},
+            {'title': '.*BAR_ent.*', 'regex': True, 'flags': 'i'},
+            {'title': '(?i)^FOO', 'regex': True},
+            {'title': 'foo(bar|baz)_entry', 'regex': True},
+            {'title': 'sub|foo', 'regex': True},
+            {'title': 'foobar_entry'},
+            {'title': 'foobar_entry', 'group': group, 'recursive': False},
+            {'url': r'example\.com', 'regex': True},
+            {'string': {'custom_field': 'field val'}, 'regex': True},
+            {'title': 'nonexistent', 'regex': True},
+        ]
+        expected = [self.kp.find_entries(**kwargs) for kwargs in searches]
+        self.kp.add_trigram_index('title')
+        self.kp.add_trigram_index('url')
+        self.kp.add_trigram_index('custom_field')
+        for kwargs, results in zip(searches, expected):
+            found = self.kp.find_entries(**kwargs)
+            self.assertEqual([e._element for e in found], [e._element for e in results])
+            first = self.kp.find_entries(first=True, **kwargs)
+            self.assertEqual(first, results[0] if results else None)
+
+        # index hits do not search the tree
+        with mock.patch.object(self.kp, '_xpath', side_effect=AssertionError):
+            self.assertEqual(self.kp.find_entries(title='bar_ent', regex=True, flags='i'), expected[1])
+
+        # added, changed and deleted entries
+        entry = self.kp.add_entry(group, 'trigram_entry', 'trigram_user', 'pass')
+        self.assertEqual(self.kp.find_entries(title='RAM_ENT', regex=True, flags='i'), [entry])
+        entry.title = 'renamed'
+        self.assertEqual(self.kp.find_entries(title='ram_ent', regex=True), [])
+        self.assertEqual(self.kp.find_entries(title='^renamed$', regex=True), [entry])
+        self.kp.delete_entry(entry)
+        self.assertEqual(self.kp.find_entries(title='renamed', regex=True), [])
+
+    def test_regex_substrings(self):
+        self.assertEqual(regex_substrings('.*foo.*'), ['foo'])
+        self.assertEqual(regex_substrings('foo(bar|baz)qux'), ['foo', 'qux'])
+        self.assertEqual(regex_substrings(r'abc*def\.com'), ['def.com'])
+        self.assertEqual(regex_substrings('foo|bar'), [])
+        self.assertEqual(regex_substrings('ab'), [])
+        self.assertEqual(regex_substrings('Straße', 'i'), ['Stra'])
+        self.assertEqual(regex_substrings('Straße', 'm'), [])
+        self.assertEqual(regex_substrings('(invalid'), [])
+
     def test_find_entries_by_tags(self):
         results = self.kp.find_entries(tags=['tag1', 'tag2'], first=True)
         self.assertIsInstance(results, Entry)
@@ -173,6 +367,63 @@ class EntryFindTests3(KDBX3Tests):
         results = self.kp.find_entries(title='foobar_entry', group=group)
         self.assertEqual(len(results), 2)
 
+    def test_find_entries_quoted_values(self):
+        # values are bound as XPath variables, quotes are not special
+        title = 'say "hi" it\'s'
+        entry = self.kp.add_entry(self.kp.root_group, title, 'user "quoted"', 'pass')
+        entry.set_custom_property('field "quoted"', 'it\'s "here"')
+        self.assertEqual(self.kp.find_entries(title=title, first=True), entry)
+        self.assertEqual(self.kp.find_entries(username='user "quoted"'), [entry])
+        self.assertEqual(
+            self.kp.find_entries(string={'field "quoted"': 'it\'s "here"'}),
+            [entry]
+        )
+        self.assertEqual(self.kp.find_entries(path=[title]), entry)
+        self.assertEqual(entry.get_custom_property('field "quoted"'), 'it\'s "here"')
+        self.assertEqual(self.kp.find_entries(title='"hi"', regex=True), [entry])
+
+    def test_find_entries_first(self):
+        group = self.kp.find_groups(name='foobar_group', first=True)
+        searches = [
+            {'title': 'foobar_entry'},
+            {'url': 'http://example.com'},
+            {'title': 'foobar_entry', 'history': True},
+            {'title': 'sub.*', 'regex': True},
+            {'tags': ['tag1']},
+            {'title': 'nonexistent'},
+            {'group': group, 'title': 'foobar_entry'},
+            {'group': group, 'recursive': False},
+            {'recursive': False},
+        ]
+        for kwargs in searches:
+            results = self.kp.find_entries(**kwargs)
+            result = self.kp.find_entries(first=True, **kwargs)
+            if results:
+                self.assertIs(result._element, results[0]._element)
+            else:
+                self.assertIsNone(result)
+
+        results = self.kp.find_groups(name='.*group.*', regex=True)
+        result = self.kp.find_groups(name='.*group.*', regex=True, first=True)
+        self.assertIs(result._element, results[0]._element)
+        results = self.kp.find_attachments(filename='.*', regex=True)
+        result = self.kp.find_attachments(filename='.*', regex=True, first=True)
+        self.assertIs(result._element, results[0]._element)
+
+        # only the returned match is wrapped
+        with mock.patch('pykeepass.pykeepass.Entry', wraps=Entry) as wrapped:
+            self.kp.find_entries(url='http://example.com', first=True)
+            self.kp.xpath('//Entry', first=True, cast=True)
+        self.assertEqual(wrapped.call_count, 2)
+
+    def test_find_entries_compiled_once(self):
+        compile_xpath.cache_clear()
+        for title in ('foobar_entry', 'root_entry', 'subentry'):
+            self.kp.find_entries(title=title, username='foobar_user')
+        info = compile_xpath.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+
     # ---------- History -----------
 
     def test_is_a_history_entry(self):
@@ -1125,6 +1376,37 @@ class CtxManagerTests(unittest.TestCase):
             results = kp.find_entries_by_username('foobar_user', first=True)
             self.assertEqual('foobar_user', results.username)
 
+class LazyImportTests(unittest.TestCase):
+    def imported(self, code, modules):
+        """Which of modules are imported after running code in a new interpreter"""
+        code += '\nimport sys; print(" ".join(m for m in {!r} if m in sys.modules))'.format(modules)
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=base_dir)
+        return output.decode().split()
+
+    def test_lazy_imports(self):
+        modules = ['lxml', 'construct', 'argon2', 'pykeepass.icons', 'pykeepass.kdbx_parsing.twofish']
+        self.assertEqual(self.imported('import pykeepass', modules), [])
+        self.assertEqual(
+            self.imported('from pykeepass import icons; icons.KEY', modules),
+            ['pykeepass.icons']
+        )
+        self.assertEqual(
+            self.imported("from pykeepass import PyKeePass; PyKeePass('test3.kdbx', 'password', 'test3.key')", modules),
+            ['lxml', 'construct']
+        )
+        self.assertEqual(
+            self.imported("from pykeepass import PyKeePass; PyKeePass('test4.kdbx', 'password', 'test4.key')", modules),
+            ['lxml', 'construct', 'argon2']
+        )
+        self.assertIn(
+            'pykeepass.kdbx_parsing.twofish',
+            self.imported("from pykeepass import PyKeePass; PyKeePass('test4_twofish.kdbx', 'password', 'test4.key')", modules),
+        )
+
+        with self.assertRaises(AttributeError):
+            import pykeepass
+            pykeepass.missing
+
 class PyKeePassTests3(KDBX3Tests):
     """Tests on PyKeePass class that don't involve attachments or finding entries/groups"""
 
@@ -1388,6 +1670,328 @@ class KDBXTests(unittest.TestCase):
                 )
 
 
+    def test_payload_checksum_error(self):
+        databases = [
+            ('test3.kdbx', 'test3.key'),
+            ('test4_aes_uncompressed.kdbx', None),
+        ]
+        for database, keyfile in databases:
+            keyfile = keyfile and base_dir / keyfile
+            # attachment spanning multiple payload blocks
+            kp = PyKeePass(base_dir / database, 'password', keyfile)
+            kp.add_binary(os.urandom(3 * 2**19))
+            stream = BytesIO()
+            kp.save(stream)
+            data = bytearray(stream.getvalue())
+
+            # streamed save and open of multiple blocks
+            stream_streamed = BytesIO()
+            kp.save(stream_streamed, streaming=True)
+            self.assertEqual(stream_streamed.getvalue(), data)
+            PyKeePass(BytesIO(data), 'password', keyfile, streaming=True)
+
+            data[-100] ^= 1
+            with self.assertRaisesRegex(PayloadChecksumError, 'block 1'):
+                PyKeePass(BytesIO(data), 'password', keyfile)
+            with self.assertRaisesRegex(PayloadChecksumError, 'block 1'):
+                PyKeePass(BytesIO(data), 'password', keyfile, streaming=True)
+
+    def test_unprotect(self):
+        key = os.urandom(32)
+        stream = ChaCha20Stream(lambda con: key, GreedyBytes)
+        cipher = stream.get_cipher(key)
+        values = ['password', 'pass\x01word', 'not base64', 'últimø']
+        root = etree.Element('Root')
+        for value in values:
+            elem = etree.SubElement(root, 'Value', Protected='True')
+            if value == 'not base64':
+                elem.text = 'abc'
+            else:
+                elem.text = base64.b64encode(cipher.encrypt(value.encode('utf-8')))
+
+        tree = stream._decode(etree.ElementTree(root), None, None)
+        self.assertEqual(
+            [elem.text for elem in tree.getroot()],
+            ['password', 'password', 'abc', 'últimø']
+        )
+
+    def test_unprotect_values(self):
+        key = os.urandom(32)
+        for stream in (ChaCha20Stream, Salsa20Stream):
+            cipher = stream.get_cipher(key)
+            values = []
+            offset = 0
+            for value in ('first', 'second', 'þriðja', 'fourth'):
+                ciphertext = cipher.encrypt(value.encode('utf-8'))
+                values.append((offset, base64.b64encode(ciphertext).decode()))
+                offset += len(ciphertext)
+
+            # out of keystream order, repeated and invalid values
+            values = [values[2], values[0], (values[3][0], 'abc'), values[3], values[2]]
+            self.assertEqual(
+                stream.unprotect_values(key, values),
+                ['þriðja', 'first', None, 'fourth', 'þriðja']
+            )
+
+    def test_verify_credentials(self):
+        # (database, password, keyfile, valid)
+        cases = [
+            ('test3.kdbx', 'password', 'test3.key', True),
+            ('test3.kdbx', 'invalid', 'test3.key', False),
+            ('test4.kdbx', 'password', 'test4.key', True),
+            ('test4.kdbx', 'invalid', 'test4.key', False),
+            ('test4.kdbx', 'password', 'test3.key', False),
+            ('test4_aes.kdbx', 'password', 'test4.key', True),
+            ('test4_chacha20.kdbx', 'password', 'test4.key', True),
+            ('test4_twofish.kdbx', 'password', 'test4.key', True),
+            ('test4_twofish.kdbx', 'invalid', 'test4.key', False),
+        ]
+        for database, password, keyfile, valid in cases:
+            self.assertEqual(
+                PyKeePass.verify_credentials(base_dir / database, password, base_dir / keyfile),
+                valid
+            )
+
+        # KDBX3 payloads with other ciphers
+        kp = PyKeePass(base_dir / 'test3.kdbx', 'password', base_dir / 'test3.key')
+        dynamic_header = kp.kdbx.header.value.dynamic_header
+        encryption_iv = dynamic_header.encryption_iv.data
+        for cipher_id, iv_length in [('chacha20', 12), ('twofish', 16)]:
+            dynamic_header.cipher_id.data = cipher_id
+            dynamic_header.encryption_iv.data = encryption_iv[:iv_length]
+            kp.kdbx.header.pop('data', None)
+            stream = BytesIO()
+            kp.save(stream)
+            for password, valid in [('password', True), ('invalid', False)]:
+                stream.seek(0)
+                self.assertEqual(
+                    PyKeePass.verify_credentials(stream, password, base_dir / 'test3.key'),
+                    valid
+                )
+
+        with open(base_dir / 'test3.kdbx', 'rb') as f:
+            self.assertTrue(PyKeePass.verify_credentials(f, 'password', base_dir / 'test3.key'))
+
+        with self.assertRaises(HeaderChecksumError):
+            PyKeePass.verify_credentials(base_dir / 'test3.key', 'password')
+
+    def test_probe_header(self):
+        databases = ['test3.kdbx', 'test4_aeskdf.kdbx', 'test4_argon2id.kdbx', 'test4_twofish.kdbx']
+        headers = probe_headers([base_dir / d for d in databases])
+        for database, header in zip(databases, headers):
+            kp = PyKeePass(base_dir / database, 'password', decrypt=False)
+            self.assertEqual(header, probe_header(base_dir / database))
+            self.assertEqual(header.version, kp.version)
+            self.assertEqual(header.encryption_algorithm, kp.encryption_algorithm)
+            self.assertEqual(header.kdf_algorithm, kp.kdf_algorithm)
+            self.assertEqual(header.salt, kp.database_salt)
+        self.assertEqual(headers[0].kdf_parameters, {'R': 100})
+        self.assertEqual(set(headers[2].kdf_parameters), {'I', 'M', 'P', 'V'})
+
+        with self.assertRaises(HeaderChecksumError):
+            probe_header(base_dir / 'test3.key')
+        headers = probe_headers([base_dir / 'test3.key', base_dir / 'test3.kdbx'], return_exceptions=True)
+        self.assertIsInstance(headers[0], HeaderChecksumError)
+        self.assertEqual(headers[1].version, (3, 1))
+
+    def test_open_streaming(self):
+        databases = [
+            ('test3.kdbx', 'test3.key'),
+            ('test4.kdbx', 'test4.key'),
+            ('test4_aes.kdbx', 'test4.key'),
+            ('test4_twofish.kdbx', 'test4.key'),
+            ('test4_chacha20_uncompressed.kdbx', None),
+            ('test4_twofish_uncompressed.kdbx', None),
+        ]
+        for database, keyfile in databases:
+            keyfile = keyfile and base_dir / keyfile
+            kp = PyKeePass(base_dir / database, 'password', keyfile)
+            kp_streamed = PyKeePass(base_dir / database, 'password', keyfile, streaming=True)
+            self.assertEqual(kp.xml(), kp_streamed.xml())
+            if kp.version >= (4, 0):
+                self.assertEqual(
+                    kp.kdbx.body.payload.inner_header,
+                    kp_streamed.kdbx.body.payload.inner_header
+                )
+
+            # streamed save writes the same file
+            stream, stream_streamed = BytesIO(), BytesIO()
+            kp.save(stream)
+            kp.save(stream_streamed, streaming=True)
+            self.assertEqual(stream.getvalue(), stream_streamed.getvalue())
+
+            # reloaded in streaming mode
+            with mock.patch.object(KDBX, 'parse_file', wraps=KDBX.parse_file) as parse_file:
+                kp_streamed.reload()
+            self.assertTrue(parse_file.call_args[1]['streaming'])
+            self.assertEqual(kp.xml(), kp_streamed.xml())
+
+        with self.assertRaises(CredentialsError):
+            PyKeePass(base_dir / 'test3.kdbx', 'invalid', base_dir / 'test3.key', streaming=True)
+
+        # corrupted payload block
+        with open(base_dir / 'test4_aes_uncompressed.kdbx', 'rb') as f:
+            data = bytearray(f.read())
+        data[-100] ^= 1
+        with self.assertRaises(PayloadChecksumError):
+            PyKeePass(BytesIO(data), 'password', streaming=True)
+
+    def test_open_decompress_while_parsing(self):
+        # decompressed payload is parsed piece by piece, never as a whole
+        with mock.patch('pykeepass.kdbx_parsing.common.zlib.decompress', side_effect=AssertionError):
+            for database, keyfile in (('test3.kdbx', 'test3.key'), ('test4.kdbx', 'test4.key')):
+                kp = PyKeePass(base_dir / database, 'password', base_dir / keyfile)
+                self.assertEqual(kp.root_group.name, 'Root')
+
+    def test_open_mmap(self):
+        databases = [
+            ('test3.kdbx', 'test3.key'),
+            ('test4.kdbx', 'test4.key'),
+            ('test4_twofish.kdbx', 'test4.key'),
+            ('test4_chacha20_uncompressed.kdbx', None),
+        ]
+        for database, keyfile in databases:
+            keyfile = keyfile and base_dir / keyfile
+            kp = PyKeePass(base_dir / database, 'password', keyfile)
+            for streaming in (False, True):
+                kp_mmap = PyKeePass(
+                    base_dir / database, 'password', keyfile,
+                    mmap=True, streaming=streaming
+                )
+                self.assertEqual(kp.xml(), kp_mmap.xml())
+
+        # KDBX3 payload is decrypted from the mapping without a copy
+        with MappedFile(base_dir / 'test3.kdbx') as f:
+            f.seek(-100, os.SEEK_END)
+            payload = GreedyView().parse_stream(f)
+            self.assertIsInstance(payload, memoryview)
+            self.assertEqual(len(payload), 100)
+            payload.release()
+
+        # mapping is released, so the file can be replaced
+        database_tmp = base_dir / 'test4_mmap_tmp.kdbx'
+        shutil.copy(base_dir / 'test4_aes_uncompressed.kdbx', database_tmp)
+        try:
+            kp = PyKeePass(database_tmp, 'password', mmap=True)
+            kp.save()
+            kp.reload()
+            self.assertEqual(kp.root_group.name, 'Root')
+
+            with open(database_tmp, 'r+b') as f:
+                f.seek(-100, os.SEEK_END)
+                byte = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([byte[0] ^ 1]))
+            with self.assertRaises(PayloadChecksumError):
+                PyKeePass(database_tmp, 'password', mmap=True)
+        finally:
+            os.remove(database_tmp)
+
+    def test_open_lazy_unprotect(self):
+        for database, keyfile in (('test3.kdbx', 'test3.key'), ('test4.kdbx', 'test4.key')):
+            kp = PyKeePass(base_dir / database, 'password', base_dir / keyfile)
+            kp_lazy = PyKeePass(
+                base_dir / database, 'password', base_dir / keyfile,
+                lazy_unprotect=True
+            )
+            lazy_xp = '//Value[@{}]'.format(lazy_offset)
+            lazy_count = len(kp_lazy.tree.xpath(lazy_xp))
+            self.assertGreater(lazy_count, 0)
+
+            # decrypted when read
+            entry = kp.find_entries(title='root_entry', first=True)
+            entry_lazy = kp_lazy.find_entries(title='root_entry', first=True)
+            self.assertEqual(entry.password, entry_lazy.password)
+            self.assertEqual(len(kp_lazy.tree.xpath(lazy_xp)), lazy_count - 1)
+            for entry in kp.entries:
+                entry_lazy = kp_lazy.find_entries(uuid=entry.uuid, first=True)
+                self.assertEqual(entry.custom_properties, entry_lazy.custom_properties)
+                self.assertEqual(entry.otp, entry_lazy.otp)
+
+            # decrypted when dumped
+            entry = kp.find_entries(title='foobar_entry', first=True)
+            entry_lazy = kp_lazy.find_entries(title='foobar_entry', first=True)
+            self.assertEqual(entry.dump_xml(), entry_lazy.dump_xml())
+            self.assertEqual(kp.root_group.dump_xml(), kp_lazy.root_group.dump_xml())
+
+            # decrypted when searched
+            self.assertEqual(
+                kp.find_entries(password='passw0rd'),
+                kp_lazy.find_entries(password='passw0rd')
+            )
+
+            # encrypted again when saved, without decrypting the tree
+            stream = BytesIO()
+            lazy_count = len(kp_lazy.tree.xpath(lazy_xp))
+            kp_lazy.save(stream)
+            self.assertEqual(len(kp_lazy.tree.xpath(lazy_xp)), lazy_count)
+            stream.seek(0)
+            kp_saved = PyKeePass(stream, 'password', base_dir / keyfile)
+            self.assertEqual(kp.xml(), kp_saved.xml())
+
+            # decrypted when exported
+            self.assertEqual(kp.xml(), kp_lazy.xml())
+            self.assertEqual(len(kp_lazy.tree.xpath(lazy_xp)), 0)
+
+    def test_save_protected_in_place(self):
+        kp = PyKeePass(base_dir / 'test4.kdbx', 'password', base_dir / 'test4.key')
+        xml = kp.xml()
+        kp.save(BytesIO())
+        self.assertEqual(kp.xml(), xml)
+
+        # protected values are restored if building fails
+        with mock.patch('pykeepass.kdbx_parsing.common.XMLStream._build', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                kp.save(BytesIO())
+        self.assertEqual(kp.xml(), xml)
+
+    def test_save_compression(self):
+        for database, keyfile in (('test3.kdbx', 'test3.key'), ('test4.kdbx', 'test4.key')):
+            keyfile = base_dir / keyfile
+            kp = PyKeePass(base_dir / database, 'password', keyfile)
+            kp.add_binary(os.urandom(2**12) + b'a' * 2**16)
+
+            sizes = {}
+            for compression in ('off', 'fast', 'default', 'max', 9, (6, zlib.Z_FILTERED), True, False):
+                stream = BytesIO()
+                kp.save(stream, compression=compression)
+                sizes[compression] = len(stream.getvalue())
+                stream.seek(0)
+                kp_saved = PyKeePass(stream, 'password', keyfile)
+                self.assertEqual(
+                    kp_saved.kdbx.header.value.dynamic_header.compression_flags.data.compression,
+                    compression not in ('off', False)
+                )
+                self.assertEqual(kp_saved.xml(), kp.xml())
+            self.assertLess(sizes['max'], sizes['off'])
+            self.assertLess(sizes['fast'], sizes['off'])
+            self.assertEqual(sizes['max'], sizes[9])
+            self.assertEqual(sizes[True], sizes['default'])
+            self.assertEqual(sizes[False], sizes['off'])
+
+            # header flag is kept when compression is not given
+            kp.save(BytesIO(), compression='off')
+            stream = BytesIO()
+            kp.save(stream)
+            self.assertEqual(len(stream.getvalue()), sizes['off'])
+
+            with self.assertRaises(ValueError):
+                kp.save(BytesIO(), compression='fastest')
+
+            # header is unchanged if saving fails
+            with mock.patch('pykeepass.kdbx_parsing.common.XMLStream._build', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    kp.save(BytesIO(), compression='max')
+            stream = BytesIO()
+            kp.save(stream)
+            self.assertEqual(len(stream.getvalue()), sizes['off'])
+
+        # compressed KDBX3 binaries
+        kp = PyKeePass(base_dir / 'test3.kdbx', 'password', base_dir / 'test3.key')
+        for compressed in (True, False, 'off', 'max', (1, zlib.Z_RLE)):
+            binary_id = kp.add_binary(b'a' * 100, compressed=compressed)
+            self.assertEqual(kp.binaries[binary_id], b'a' * 100)
+
     def test_open_no_decrypt(self):
         """Open database but do not decrypt payload.  Needed for reading header data for OTP tokens"""
 
@@ -1418,6 +2022,343 @@ class KDBXTests(unittest.TestCase):
             self.assertEqual(kp.encryption_algorithm, enc_alg)
             self.assertEqual(kp.version, version)
 
+class FastParseTests(unittest.TestCase):
+    def test_fixtures(self):
+        # (password, keyfile, transformed key) of databases which are not
+        # opened with just the password 'password'
+        credentials = {
+            'test3.kdbx': ('password', 'test3.key', None),
+            'test4_aes.kdbx': ('password', 'test4.key', None),
+            'test4_aeskdf.kdbx': ('password', 'test4.key', None),
+            'test4_chacha20.kdbx': ('password', 'test4.key', None),
+            'test4_twofish.kdbx': ('password', 'test4.key', None),
+            'test4_hex.kdbx': ('password', 'test4_hex.key', None),
+            'test4_keyx.kdbx': ('password', 'test4_keyx.keyx', None),
+            'test4.kdbx': ('password', 'test4.key', None),
+            'test4_blankpass.kdbx': ('', 'test4.key', None),
+            'test3_transformed.kdbx': (
+                None, None,
+                b'\xfb\xb1!\x0e0\x94\xd4\x868\xa5\x04\xe6T\x9b<\xf9+\xb8\x82EN\xbc\xbe\xbc\xc8\xd3\xbbf\xfb\xde\xff.'
+            ),
+            'test4_transformed.kdbx': (
+                None, None,
+                b'\x95\x0be\x9ca\x9e<\xe0\x07\x02\x7f\xc3\xd8\xa1\xa6&\x985\x8f!\xa6\x18k\x13\xa2\xd2\r=\xf3\xebd\xc5'
+            ),
+        }
+        # every database fixture
+        for database in sorted(path.name for path in base_dir.glob('*.kdbx')):
+            password, keyfile, transformed_key = credentials.get(database, ('password', None, None))
+            keyfile = keyfile and base_dir / keyfile
+            if transformed_key is None:
+                transformed_key = PyKeePass(base_dir / database, password, keyfile).transformed_key
+            kdbx_construct = KDBX.parse_file(
+                base_dir / database,
+                password=password,
+                keyfile=keyfile,
+                transformed_key=transformed_key,
+                decrypt=True,
+                fast_parse=False
+            )
+            for streaming in (False, True):
+                kdbx = KDBX.parse_file(
+                    base_dir / database,
+                    password=password,
+                    keyfile=keyfile,
+                    transformed_key=transformed_key,
+                    decrypt=True,
+                    streaming=streaming
+                )
+                self.assertEqual(kdbx.header, kdbx_construct.header)
+                self.assertEqual(repr(kdbx.header), repr(kdbx_construct.header))
+                if kdbx.header.value.major_version == 4:
+                    self.assertEqual(
+                        kdbx.body.payload.inner_header,
+                        kdbx_construct.body.payload.inner_header
+                    )
+                self.assertEqual(
+                    etree.tostring(kdbx.body.payload.xml),
+                    etree.tostring(kdbx_construct.body.payload.xml)
+                )
+
+    def test_fallback(self):
+        # unknown variant dictionary value type
+        kdf_parameters = (
+            b'\x00\x01' + b'\x99' + struct.pack('<I', 1) + b'X' +
+            struct.pack('<I', 2) + b'ab' + b'\x00'
+        )
+        data = (
+            b'\x0b' + struct.pack('<I', len(kdf_parameters)) + kdf_parameters +
+            b'\x00' + struct.pack('<I', 0)
+        )
+        header = kdbx4.DynamicHeader.parse(data)
+        self.assertEqual(header, kdbx4.DynamicHeader.parse(data, fast_parse=False))
+        self.assertIsNone(header.kdf_parameters.data.dict.X.value)
+
+        # stream which cannot seek is read again by construct.  Longer
+        # protected_stream_id data is only accepted by construct
+        data = (
+            b'\x01' + struct.pack('<I', 8) + struct.pack('<Q', 3) +
+            b'\x03' + struct.pack('<I', 2) + b'\x01a' +
+            b'\x00' + struct.pack('<I', 0) + b'rest'
+        )
+        for fast_parse in (True, False):
+            stream = BufferedReader(ChunkedStream([data[:3], data[3:]]))
+            inner_header = kdbx4.InnerHeader.parse_stream(stream, fast_parse=fast_parse)
+            self.assertEqual(inner_header.protected_stream_id.data, 'chacha20')
+            self.assertEqual(inner_header.binary[0].data, b'\x01a')
+            self.assertEqual(stream.read(), b'rest')
+
+        # construct reports errors
+        with self.assertRaises(StreamError):
+            kdbx3.DynamicHeader.parse(b'\x02\x10\x00abc')
+        with self.assertRaises(ChecksumError):
+            kdbx3.PayloadBlocks.parse(struct.pack('<I32sI', 1, bytes(32), 0))
+
+
+class TwofishTests(unittest.TestCase):
+
+    @unittest.skipIf(nptwofish is None, 'NumPy not installed')
+    def test_vectorized_decrypt(self):
+        key, iv = os.urandom(32), os.urandom(16)
+        ciphertext = os.urandom(16 * 100)
+        cipher = pytwofish.Twofish(key)
+        expected = b''
+        previous = iv
+        for i in range(0, len(ciphertext), 16):
+            block = ciphertext[i:i + 16]
+            expected += bytes(a ^ b for a, b in zip(cipher.decrypt(block), previous))
+            previous = block
+
+        decrypter = nptwofish.TwofishCBCDecrypter(cipher, iv)
+        # partial blocks are cached until the next call
+        self.assertEqual(
+            decrypter.decrypt(ciphertext[:700]) + decrypter.decrypt(ciphertext[700:]),
+            expected
+        )
+        self.assertEqual(
+            twofish.Twofish.new(key, mode=twofish.Twofish.MODE_CBC, IV=iv).decrypt(ciphertext),
+            expected
+        )
+
+    def test_encrypt(self):
+        key, iv = os.urandom(32), os.urandom(16)
+        plaintext = os.urandom(16 * 100)
+        cipher = pytwofish.Twofish(key)
+        expected = b''
+        previous = iv
+        for i in range(0, len(plaintext), 16):
+            block = bytes(a ^ b for a, b in zip(plaintext[i:i + 16], previous))
+            previous = cipher.encrypt(block)
+            expected += previous
+
+        cipher = twofish.Twofish.new(key, mode=twofish.Twofish.MODE_CBC, IV=iv)
+        # partial blocks are cached until the next call
+        self.assertEqual(
+            cipher.encrypt(plaintext[:700]) + cipher.encrypt(plaintext[700:]),
+            expected
+        )
+
+    def test_fallback(self):
+        key, iv = os.urandom(32), os.urandom(16)
+        plaintext = os.urandom(16 * 10)
+        ciphertext = twofish.Twofish.new(key, mode=twofish.Twofish.MODE_CBC, IV=iv).encrypt(plaintext)
+        with mock.patch('pykeepass.kdbx_parsing.twofish.nptwofish', None):
+            cipher = twofish.Twofish.new(key, mode=twofish.Twofish.MODE_CBC, IV=iv)
+            self.assertEqual(cipher.decrypt(ciphertext), plaintext)
+
+
+class CryptoBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = mock.patch.dict(
+            crypto._backends,
+            {algorithm: backends.copy() for algorithm, backends in crypto._backends.items()}
+        )
+        self.selected = mock.patch.dict(crypto._selected, clear=True)
+        self.backends.start()
+        self.selected.start()
+
+    def tearDown(self):
+        self.backends.stop()
+        self.selected.stop()
+
+    def test_register_backend(self):
+        calls = []
+        def factory(key, iv):
+            calls.append(key)
+            return crypto._backends['chacha20']['cryptodome'](key, iv)
+
+        crypto.register_backend('chacha20', 'test', factory)
+        crypto.use_backend('chacha20', 'test')
+        kp = PyKeePass(base_dir / 'test4.kdbx', 'password', base_dir / 'test4.key')
+        self.assertEqual(crypto.get_backend('chacha20'), 'test')
+        self.assertTrue(kp.find_entries(title='foobar_entry', first=True))
+        # payload and protected values
+        self.assertEqual(len(calls), 2)
+
+        with self.assertRaises(ValueError):
+            crypto.use_backend('chacha20', 'missing')
+        with self.assertRaises(ValueError):
+            crypto.register_backend('rot13', 'test', factory)
+
+    def test_select_backend(self):
+        def unavailable(key, iv):
+            import missing_cipher_module
+        def broken(key, iv):
+            cipher = mock.Mock()
+            cipher.encrypt.side_effect = lambda data: data
+            cipher.decrypt.side_effect = lambda data: b''
+            return cipher
+
+        def failing(key, iv):
+            raise OSError("cannot load cipher library")
+
+        crypto.register_backend('aes256', 'unavailable', unavailable)
+        crypto.register_backend('aes256', 'broken', broken)
+        crypto.register_backend('aes256', 'failing', failing)
+        with self.assertLogs('pykeepass.crypto', 'WARNING') as logs:
+            self.assertIn(crypto.get_backend('aes256'), ('cryptodome', 'cryptography'))
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('failing', logs.output[1])
+
+        crypto._backends['salsa20'].clear()
+        crypto.register_backend('salsa20', 'unavailable', unavailable)
+        crypto.register_backend('salsa20', 'unavailable2', unavailable)
+        with self.assertRaises(RuntimeError):
+            crypto.get_backend('salsa20')
+
+
+    @unittest.skipUnless(cryptography, 'cryptography not installed')
+    def test_cryptography_backends(self):
+        # (algorithm, key, iv, plaintext, ciphertext, keystream offset)
+        vectors = [
+            # NIST SP 800-38A F.2.5, CBC-AES256
+            ('aes256',
+             '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4',
+             '000102030405060708090a0b0c0d0e0f',
+             b'\x6b\xc1\xbe\xe2\x2e\x40\x9f\x96\xe9\x3d\x7e\x11\x73\x93\x17\x2a',
+             'f58c4c04d6e5f1ba779eabfb5f7bfbd6', 0),
+            # RFC 7539 2.4.2, which starts at block counter 1
+            ('chacha20',
+             '000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f',
+             '000000000000004a00000000',
+             b"Ladies and Gentlemen of the class of '99: If I could offer you "
+             b"only one tip for the future, sunscreen would be it.",
+             '6e2e359a2568f98041ba0728dd0d6981e97e7aec1d4360c20a27afccfd9fae0b'
+             'f91b65c5524733ab8f593dabcd62b3571639d624e65152ab8f530c359f0861d8'
+             '07ca0dbf500d6a6156a38e088a22b65e52bc514d16ccf806818ce91ab7793736'
+             '5af90bbf74a35be6b40b8eedf2785e42874d', 64),
+        ]
+        for algorithm, key, iv, plaintext, ciphertext, offset in vectors:
+            key, iv = bytes.fromhex(key), bytes.fromhex(iv)
+            for backend in ('cryptodome', 'cryptography'):
+                factory = crypto._backends[algorithm][backend]
+                encrypted = factory(key, iv).encrypt(bytes(offset) + plaintext)
+                self.assertEqual(encrypted[offset:].hex(), ciphertext, backend)
+
+            # cipher state is kept between calls
+            data = os.urandom(2**12)
+            reference = crypto._backends[algorithm]['cryptodome'](key, iv).encrypt(data)
+            cipher = crypto._backends[algorithm]['cryptography'](key, iv)
+            self.assertEqual(cipher.encrypt(data[:1024]) + cipher.encrypt(data[1024:]), reference)
+            cipher = crypto._backends[algorithm]['cryptography'](key, iv)
+            self.assertEqual(cipher.decrypt(reference[:2048]) + cipher.decrypt(reference[2048:]), data)
+
+        # databases open with the cryptography backends
+        for database in ('test4_aes.kdbx', 'test4_chacha20.kdbx'):
+            xml = {}
+            for backend in ('cryptodome', 'cryptography'):
+                crypto.use_backend('aes256', backend)
+                crypto.use_backend('chacha20', backend)
+                kp = PyKeePass(base_dir / database, 'password', base_dir / 'test4.key')
+                xml[backend] = kp.xml()
+            self.assertEqual(xml['cryptography'], xml['cryptodome'])
+
+class TransformedKeyCacheTests(unittest.TestCase):
+    """Tests on reusing transformed keys between opens"""
+
+    cache_file = base_dir / 'keycache_tmp'
+
+    def tearDown(self):
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+    def test_cache_hit(self):
+        for database, keyfile, kdf in [
+                ('test3.kdbx', 'test3.key', 'pykeepass.kdbx_parsing.kdbx3.aes_kdf'),
+                ('test4.kdbx', 'test4.key', 'argon2.low_level.hash_secret_raw')]:
+            cache = TransformedKeyCache()
+            kp = PyKeePass(base_dir / database, 'password', base_dir / keyfile, key_cache=cache)
+            self.assertEqual(len(cache), 1)
+            with mock.patch(kdf, side_effect=AssertionError("KDF was run")):
+                kp2 = PyKeePass(base_dir / database, 'password', base_dir / keyfile, key_cache=cache)
+                kp2.reload()
+            self.assertEqual(kp.transformed_key, kp2.transformed_key)
+
+            # different credentials are not served from cache, and keys
+            # derived from invalid credentials are not stored
+            with self.assertRaises(CredentialsError):
+                PyKeePass(base_dir / database, 'invalid', base_dir / keyfile, key_cache=cache)
+            self.assertFalse(
+                PyKeePass.verify_credentials(base_dir / database, 'invalid', base_dir / keyfile, key_cache=cache)
+            )
+            self.assertEqual(len(cache), 1)
+
+            cache = TransformedKeyCache()
+            self.assertTrue(
+                PyKeePass.verify_credentials(base_dir / database, 'password', base_dir / keyfile, key_cache=cache)
+            )
+            self.assertEqual(len(cache), 1)
+
+    def test_save_reuses_key(self):
+        shutil.copy(base_dir / 'test4.kdbx', base_dir / 'test4_tmp.kdbx')
+        try:
+            kp = PyKeePass(base_dir / 'test4_tmp.kdbx', 'password', base_dir / 'test4.key')
+            transformed_key = kp.transformed_key
+            with mock.patch('argon2.low_level.hash_secret_raw', side_effect=AssertionError("KDF was run")):
+                kp.save()
+                kp.save()
+                kp.reload()
+            self.assertEqual(kp.transformed_key, transformed_key)
+
+            # changing credentials derives a new key on the next save only
+            kp.password = 'f00bar'
+            kdf = argon2.low_level.hash_secret_raw
+            with mock.patch('argon2.low_level.hash_secret_raw', wraps=kdf) as m:
+                kp.save()
+                kp.save()
+                self.assertEqual(m.call_count, 1)
+            kp = PyKeePass(base_dir / 'test4_tmp.kdbx', 'f00bar', base_dir / 'test4.key')
+            self.assertNotEqual(kp.transformed_key, transformed_key)
+        finally:
+            os.remove(base_dir / 'test4_tmp.kdbx')
+
+    def test_eviction(self):
+        cache = TransformedKeyCache(maxsize=1)
+        cache.set(b'a', {'S': b'salt'}, b'key_a')
+        cache.set(b'b', {'S': b'salt'}, b'key_b')
+        self.assertIsNone(cache.get(b'a', {'S': b'salt'}))
+        self.assertEqual(cache.get(b'b', {'S': b'salt'}), b'key_b')
+        self.assertIsNone(cache.get(b'b', {'S': b'other salt'}))
+
+        cache = TransformedKeyCache(ttl=-1)
+        cache.set(b'a', {'S': b'salt'}, b'key_a')
+        self.assertIsNone(cache.get(b'a', {'S': b'salt'}))
+
+    def test_cache_file(self):
+        with self.assertRaises(ValueError):
+            TransformedKeyCache(filename=self.cache_file)
+
+        cache = TransformedKeyCache(filename=self.cache_file, secret='s3cret')
+        kp = PyKeePass(base_dir / 'test4.kdbx', 'password', base_dir / 'test4.key', key_cache=cache)
+        with open(self.cache_file, 'rb') as f:
+            self.assertNotIn(kp.transformed_key.hex().encode(), f.read())
+
+        cache = TransformedKeyCache(filename=self.cache_file, secret='s3cret')
+        self.assertEqual(len(cache), 1)
+        cache = TransformedKeyCache(filename=self.cache_file, secret='wrong')
+        self.assertEqual(len(cache), 0)
+
 if __name__ == '__main__':
     unittest.main()
 